@@ -20,6 +20,8 @@
 
 from sm_typing import override
 
+from concurrent.futures import ThreadPoolExecutor
+
 import SR
 import VDI
 import util
@@ -42,6 +44,8 @@ MAXPORT = 65535
 MAX_TIMEOUT = 15
 MAX_LUNID_TIMEOUT = 60
 ISCSI_PROCNAME = "iscsi_tcp"
+# Portals probed or logged in to at the same time
+MAX_PORTAL_WORKERS = 8
 
 
 class BaseISCSISR(SR.SR):
@@ -298,6 +302,47 @@ class BaseISCSISR(SR.SR):
                 pass
         self._devs = scsiutil.cacheSCSIidentifiers()
 
+    def _portalReachable(self, portal):
+        (target, port) = portal
+        try:
+            util._testHost(target, int(port), 'ISCSITarget')
+            return True
+        except:
+            return False
+
+    def _loginPortal(self, portal, iqn):
+        """Log in to the target through the portal, returning whether a
+        path was added"""
+        try:
+            (ipaddr, port) = iscsilib.parse_IP_port(portal)
+            if not self.multihomed and ipaddr != self.target:
+                return False
+            util._testHost(ipaddr, int(port), 'ISCSITarget')
+            util.SMlog("Logging in to [%s:%s]" % (ipaddr, port))
+            iscsilib.login(portal, iqn, self.chapuser,
+                           self.chappassword,
+                           self.incoming_chapuser,
+                           self.incoming_chappassword,
+                           self.mpath == "true")
+            return True
+        except Exception as e:
+            # Exceptions thrown in login are acknowledged,
+            # the rest of exceptions are ignored since some of the
+            # paths in multipath may not be reachable
+            if str(e).startswith('ISCSI login'):
+                raise
+            return False
+
+    def _logoutPortals(self, logins):
+        """Log out of the target through the (portal, iqn) of 'logins', the
+        errors are logged and ignored"""
+        for (portal, iqn) in logins:
+            try:
+                util.SMlog("Logging out of [%s] after a failed login" % portal)
+                iscsilib.logout(portal, iqn)
+            except:
+                util.logException("Failed to log out of %s" % portal)
+
     @override
     def attach(self, sr_uuid) -> None:
         self._mpathHandle()
@@ -319,17 +364,25 @@ class BaseISCSISR(SR.SR):
                 targetlist = self.dconf['multihomelist'].split(',')
             else:
                 targetlist = ['%s:%d' % (self.target, self.port)]
+            portals = [iscsilib.parse_IP_port(val) for val in targetlist]
             conn = False
-            for val in targetlist:
-                (target, port) = iscsilib.parse_IP_port(val)
-                try:
-                    util._testHost(target, int(port), 'ISCSITarget')
-                    self.target = target
-                    self.port = int(port)
-                    conn = True
-                    break
-                except:
-                    pass
+            # Probe all the portals at once, the first reachable one in
+            # the list is used: the probes of the next ones are not waited for
+            executor = ThreadPoolExecutor(max_workers=min(MAX_PORTAL_WORKERS, len(portals)))
+            probes = []
+            try:
+                probes = [executor.submit(self._portalReachable, portal)
+                          for portal in portals]
+                for (target, port), probe in zip(portals, probes):
+                    if probe.result():
+                        self.target = target
+                        self.port = int(port)
+                        conn = True
+                        break
+            finally:
+                for probe in probes:
+                    probe.cancel()
+                executor.shutdown(wait=False)
             if not conn:
                 raise xs_errors.XenError('ISCSITarget')
 
@@ -359,35 +412,42 @@ class BaseISCSISR(SR.SR):
                         self._scan_IQNs()
                         raise xs_errors.XenError('ISCSIDiscovery',
                                                  opterr='check target settings')
-                    for i in range(0, len(iqn_map)):
-                        (portal, tpgt, iqn) = iqn_map[i]
-                        try:
-                            (ipaddr, port) = iscsilib.parse_IP_port(portal)
-                            if not self.multihomed and ipaddr != self.target:
-                                continue
-                            util._testHost(ipaddr, int(port), 'ISCSITarget')
-                            util.SMlog("Logging in to [%s:%s]" % (ipaddr, port))
-                            iscsilib.login(portal, iqn, self.chapuser,
-                                           self.chappassword,
-                                           self.incoming_chapuser,
-                                           self.incoming_chappassword,
-                                           self.mpath == "true")
-                            npaths = npaths + 1
-                        except Exception as e:
-                            # Exceptions thrown in login are acknowledged,
-                            # the rest of exceptions are ignored since some of the
-                            # paths in multipath may not be reachable
-                            if str(e).startswith('ISCSI login'):
-                                raise
-                            else:
-                                pass
+                    executor = ThreadPoolExecutor(max_workers=min(MAX_PORTAL_WORKERS, len(iqn_map)))
+                    logins = []
+                    loggedIn = []
+                    try:
+                        logins = [(portal, iqn, executor.submit(self._loginPortal, portal, iqn))
+                                  for (portal, tpgt, iqn) in iqn_map]
+                        # Login failures are raised in the order of the portals
+                        for (portal, iqn, login) in logins:
+                            if login.result():
+                                npaths = npaths + 1
+                                loggedIn.append((portal, iqn))
+                    except:
+                        # Don't leave the sessions of the other portals open
+                        for (portal, iqn, login) in logins:
+                            login.cancel()
+                        executor.shutdown(wait=True)
+                        self._logoutPortals(
+                            [(portal, iqn) for (portal, iqn, login) in logins
+                             if not login.cancelled() and
+                             login.exception() is None and login.result()])
+                        raise
+                    finally:
+                        executor.shutdown()
 
                     if not iscsilib._checkTGT(self.targetIQN, tgt=self.target):
                         raise xs_errors.XenError('ISCSIDevice', \
                                                  opterr='during login')
 
-                    # Allow the devices to settle
-                    time.sleep(5)
+                    # The LUNs are scanned asynchronously after the logins:
+                    # wait for their devices to show up before letting udev
+                    # settle, or there may be no events queued yet
+                    sessionDevs = [os.path.join("/dev/iscsi", iqn, portal)
+                                   for (portal, iqn) in loggedIn]
+                    util.wait_for_event(
+                        lambda: all(os.path.exists(dev) for dev in sessionDevs), 5)
+                    util.udev_settle(5)
 
                 except util.CommandException as inst:
                     raise xs_errors.XenError('ISCSILogin', \
@@ -536,7 +596,7 @@ class BaseISCSISR(SR.SR):
             if not self.attached:
                 raise xs_errors.XenError('SRUnavailable')
             self.refresh()
-            time.sleep(2)  # it seems impossible to tell when a scan's finished
+            util.udev_settle(2)  # returns once the scanned devices are set up
             self._loadvdis()
             self.physical_utilisation = self.physical_size
             for uuid, vdi in self.vdis.items():
@@ -278,7 +278,7 @@ class FileSR(SR.SR):
 
         pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
         try:
-            self.vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid)
+            self.vhds = vhdutil.getAllVHDsCached(pattern, FileVDI.extractUuid)
         except util.CommandException as inst:
             raise xs_errors.XenError('SRScan', opterr="error VHD-scanning " \
                     "path %s (%s)" % (self.path, inst))
@@ -293,10 +293,14 @@ class FileSR(SR.SR):
             if self.vhds[uuid].error:
                 raise xs_errors.XenError('SRScan', opterr='uuid=%s' % uuid)
             self.vdis[uuid] = self.vdi(uuid)
-            # Get the key hash of any encrypted VDIs:
-            vhd_path = os.path.join(self.path, self.vhds[uuid].path)
-            key_hash = vhdutil.getKeyHash(vhd_path)
-            self.vdis[uuid].sm_config_override['key_hash'] = key_hash
+
+        # Get the key hash of any encrypted VDIs:
+        vhd_paths = dict((uuid, os.path.join(self.path, vhd.path))
+                         for uuid, vhd in self.vhds.items())
+        key_hashes = vhdutil.getKeyHashes(list(vhd_paths.values()))
+        for uuid, vhd_path in vhd_paths.items():
+            self.vdis[uuid].sm_config_override['key_hash'] = \
+                key_hashes[vhd_path]
 
         # raw VDIs and CBT log files
         files = util.ioretry(lambda: util.listdir(self.path))
@@ -545,11 +549,13 @@ class FileVDI(VDI.VDI):
                 return
 
             try:
-                # The VDI might be activated in R/W mode so the VHD footer
-                # won't be valid, use the back-up one instead.
-                diskinfo = util.ioretry(
-                    lambda: self._query_info(self.path, True),
-                    errlist=[errno.EIO, errno.ENOENT])
+                diskinfo = self._cached_info(self.path)
+                if not diskinfo:
+                    # The VDI might be activated in R/W mode so the VHD footer
+                    # won't be valid, use the back-up one instead.
+                    diskinfo = util.ioretry(
+                        lambda: self._query_info(self.path, True),
+                        errlist=[errno.EIO, errno.ENOENT])
 
                 if 'parent' in diskinfo:
                     self.parent = diskinfo['parent']
@@ -1003,6 +1009,18 @@ class FileVDI(VDI.VDI):
         diskinfo['hidden'] = txt[2].split()[1]
         return diskinfo
 
+    def _cached_info(self, path):
+        """Same as _query_info, from the VHD info cache"""
+        vhdInfo = vhdutil.getCachedVHDInfo(path)
+        if not vhdInfo:
+            return None
+        diskinfo = {}
+        diskinfo['size'] = vhdInfo.sizeVirt // (1024 * 1024)
+        if vhdInfo.parentUuid:
+            diskinfo['parent'] = vhdInfo.parentUuid
+        diskinfo['hidden'] = vhdInfo.hidden
+        return diskinfo
+
     def _create(self, size, path):
         cmd = [SR.TAPDISK_UTIL, "create", vhdutil.VDI_TYPE_VHD, size, path]
         text = util.pread(cmd)
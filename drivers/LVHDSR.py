@@ -1224,20 +1224,25 @@ class LVHDSR(SR.SR):
         delattr(self, "vdiInfo")
         delattr(self, "allVDIs")
 
-    def _updateSlavesPreClone(self, hostRefs, origOldLV):
+    def _callOnSlaves(self, hostRefs, args, action):
+        """Run the on-slave actions on all the hosts but the master at once.
+        The calls are not timed out: the callers undo what they did on the
+        slaves on failure, which must not race with a call still running"""
         masterRef = util.get_this_host_ref(self.session)
-        args = {"vgName": self.vgname,
-                "action1": "deactivateNoRefcount",
-                "lvName1": origOldLV}
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
-            util.SMlog("Deactivate VDI on %s" % hostRef)
-            rv = self.session.xenapi.host.call_plugin(hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
+        slaves = [hostRef for hostRef in hostRefs if hostRef != masterRef]
+        for rv in util.call_plugin_on_hosts(slaves, self.PLUGIN_ON_SLAVE,
+                                            "multi", args,
+                                            desc="%s on slave" % action):
             util.SMlog("call-plugin returned: %s" % rv)
             if not rv:
                 raise Exception('plugin %s failed' % self.PLUGIN_ON_SLAVE)
 
+    def _updateSlavesPreClone(self, hostRefs, origOldLV):
+        args = {"vgName": self.vgname,
+                "action1": "deactivateNoRefcount",
+                "lvName1": origOldLV}
+        self._callOnSlaves(hostRefs, args, "Deactivate VDI")
+
     def _updateSlavesOnClone(self, hostRefs, origOldLV, origLV,
             baseUuid, baseLV):
         """We need to reactivate the original LV on each slave (note that the
@@ -1250,18 +1255,8 @@ class LVHDSR(SR.SR):
                 "ns2": lvhdutil.NS_PREFIX_LVM + self.uuid,
                 "lvName2": baseLV,
                 "uuid2": baseUuid}
-
-        masterRef = util.get_this_host_ref(self.session)
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
-            util.SMlog("Updating %s, %s, %s on slave %s" % \
-                    (origOldLV, origLV, baseLV, hostRef))
-            rv = self.session.xenapi.host.call_plugin(
-                hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
-            util.SMlog("call-plugin returned: %s" % rv)
-            if not rv:
-                raise Exception('plugin %s failed' % self.PLUGIN_ON_SLAVE)
+        self._callOnSlaves(hostRefs, args, "Updating %s, %s, %s" %
+                           (origOldLV, origLV, baseLV))
 
     def _updateSlavesOnCBTClone(self, hostRefs, cbtlog):
         """Reactivate and refresh CBT log file on slaves"""
@@ -1270,17 +1265,7 @@ class LVHDSR(SR.SR):
                 "lvName1": cbtlog,
                 "action2": "refresh",
                 "lvName2": cbtlog}
-
-        masterRef = util.get_this_host_ref(self.session)
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
-            util.SMlog("Updating %s on slave %s" % (cbtlog, hostRef))
-            rv = self.session.xenapi.host.call_plugin(
-                hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
-            util.SMlog("call-plugin returned: %s" % rv)
-            if not rv:
-                raise Exception('plugin %s failed' % self.PLUGIN_ON_SLAVE)
+        self._callOnSlaves(hostRefs, args, "Updating %s" % cbtlog)
 
     def _updateSlavesOnRemove(self, hostRefs, baseUuid, baseLV):
         """Tell the slave we deleted the base image"""
@@ -1288,17 +1273,7 @@ class LVHDSR(SR.SR):
                 "action1": "cleanupLockAndRefcount",
                 "uuid1": baseUuid,
                 "ns1": lvhdutil.NS_PREFIX_LVM + self.uuid}
-
-        masterRef = util.get_this_host_ref(self.session)
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
-            util.SMlog("Cleaning locks for %s on slave %s" % (baseLV, hostRef))
-            rv = self.session.xenapi.host.call_plugin(
-                hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
-            util.SMlog("call-plugin returned: %s" % rv)
-            if not rv:
-                raise Exception('plugin %s failed' % self.PLUGIN_ON_SLAVE)
+        self._callOnSlaves(hostRefs, args, "Cleaning locks for %s" % baseLV)
 
     def _cleanup(self, skipLockCleanup=False):
         """delete stale refcounter, flag, and lock files"""
@@ -2131,18 +2106,21 @@ class LVHDVDI(VDI.VDI):
         if self.vdi_type == vhdutil.VDI_TYPE_VHD:
             vdiList = vhdutil.getParentChain(self.lvname,
                     lvhdutil.extractUuid, self.sr.vgname)
+        lvs = []
         for uuid, lvName in vdiList.items():
             binaryParam = binary
             if uuid != self.uuid:
                 binaryParam = False  # binary param only applies to leaf nodes
             if active:
-                self.sr.lvActivator.activate(uuid, lvName, binaryParam,
-                        persistent)
+                lvs.append((uuid, lvName, binaryParam))
             else:
                 # just add the LVs for deactivation in the final (cleanup)
                 # step. The LVs must not have been activated during the current
                 # operation
                 self.sr.lvActivator.add(uuid, lvName, binaryParam)
+        if lvs:
+            # the whole chain at once
+            self.sr.lvActivator.activateMany(lvs, persistent)
 
     def _failClone(self, uuid, jval, msg):
         try:
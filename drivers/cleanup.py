@@ -32,7 +32,10 @@ import traceback
 import base64
 import zlib
 import errno
+import math
+import heapq
 import stat
+import threading
 
 import XenAPI # pylint: disable=import-error
 import util
@@ -92,7 +95,21 @@ COALESCE_ERR_RATE_TAG = 'coalesce-error-rate'
 VAR_RUN = "/var/run/"
 SPEED_LOG_ROOT = VAR_RUN + "{uuid}.speed_log"
 
-N_RUNNING_AVERAGE = 10
+# Coalesce speed samples kept per SR, one "<speed> <time> <mode>" line each.
+# The live samples are the ones of the leaf-coalesces done with the VM paused
+N_SPEED_SAMPLES = 240
+SPEED_LIVE = "live"
+SPEED_OFFLINE = "offline"
+# The speed at a given time of day is predicted from the samples taken within
+# SPEED_HOUR_WINDOW hours of it if there are at least SPEED_MIN_SAMPLES
+SPEED_HOUR_WINDOW = 1
+SPEED_MIN_SAMPLES = 3
+# Weight of a sample relatively to the next (more recent) one
+SPEED_DECAY = 0.9
+# The predicted speed is the weighted mean minus that many standard deviations
+SPEED_CONFIDENCE = 2
+# A leaf-coalesce waits at most that many hours for a quieter time of day
+SPEED_MAX_DEFER_HOURS = 6
 
 NON_PERSISTENT_DIR = '/run/nonpersistent/sm'
 
@@ -226,6 +243,35 @@ class Util:
                 Util.logException("This exception has occured")
             os._exit(0)
 
+    @staticmethod
+    def runAbortableCmd(cmd, abortTest, pollInterval, timeOut):
+        """execute the command and return its stdout, killing it if abortTest
+        signals so. Unlike runAbortable, the calling process is not forked,
+        which makes it safe to call from any thread"""
+        startTime = _time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True,
+                                universal_newlines=True)
+        try:
+            while True:
+                try:
+                    (stdout, stderr) = proc.communicate(timeout=pollInterval)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if abortTest() or SIGTERM:
+                    raise AbortException("Aborting due to signal")
+                if timeOut and _time() - startTime > timeOut:
+                    raise util.SMException("Timed out")
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                proc.communicate()
+        if proc.returncode != 0:
+            Util.log("`%s`: %s" % (cmd, proc.returncode))
+            raise util.CommandException(proc.returncode, cmd, stderr.strip())
+        return stdout
+
     @staticmethod
     def num2str(number):
         for prefix in ("G", "M", "K"):
@@ -264,6 +310,16 @@ class Util:
             count += Util.numBits(val)
         return count
 
+    @staticmethod
+    def orBitmaps(bitmap1, bitmap2):
+        """return the bitmap produced by ORing the two bitmaps"""
+        if len(bitmap2) > len(bitmap1):
+            bitmap1, bitmap2 = bitmap2, bitmap1
+        merged = bytearray(bitmap1)
+        for i in range(len(bitmap2)):
+            merged[i] |= bitmap2[i]
+        return bytes(merged)
+
     @staticmethod
     def getThisScript():
         thisScript = util.get_real_path(__file__)
@@ -515,6 +571,7 @@ class VDI(object):
     DB_COALESCE = "coalesce"
     DB_LEAFCLSC = "leaf-coalesce"  # config key
     DB_GC_NO_SPACE = "gc_no_space"
+    DB_LEAFCLSC_DEFERRED = "leaf-coalesce-deferred"  # time of 1st deferral
     LEAFCLSC_DISABLED = "false"  # set by user; means do not leaf-coalesce
     LEAFCLSC_FORCE = "force"     # set by user; means skip snap-coalesce
     LEAFCLSC_OFFLINE = "offline"  # set here for informational purposes: means
@@ -537,7 +594,8 @@ class VDI(object):
             DB_LEAFCLSC: XAPI.CONFIG_OTHER,
             DB_ONBOOT: XAPI.CONFIG_ON_BOOT,
             DB_ALLOW_CACHING: XAPI.CONFIG_ALLOW_CACHING,
-            DB_GC_NO_SPACE: XAPI.CONFIG_SM
+            DB_GC_NO_SPACE: XAPI.CONFIG_SM,
+            DB_LEAFCLSC_DEFERRED: XAPI.CONFIG_SM
     }
 
     LIVE_LEAF_COALESCE_MAX_SIZE = 20 * 1024 * 1024  # bytes
@@ -774,6 +832,8 @@ class VDI(object):
         assert(not self.sr.vdis.get(uuid))
         self._clearRef()
         oldUuid = self.uuid
+        self.sr._invalidateScanCache(oldUuid)
+        self.sr._invalidateScanCache(uuid)
         self.uuid = uuid
         self.children = []
         # updating the children themselves is the responsibility of the caller
@@ -833,14 +893,22 @@ class VDI(object):
         VHD, but not the subsequent relinking. We'll do that as the next step,
         after reloading the entire SR in case things have changed while we
         were coalescing"""
+        self._doCoalesceOnto(self.parent)
+
+    def _doCoalesceOnto(self, ancestor) -> None:
+        """Coalesce self onto ancestor, along with the hidden VDIs between
+        them when ancestor is not the parent (see SR.getCoalesceRun)"""
         self.validate()
-        self.parent.validate(True)
-        self.parent._increaseSizeVirt(self.sizeVirt)
-        self.sr._updateSlavesOnResize(self.parent)
-        self._coalesceVHD(0)
-        self.parent.validate(True)
+        ancestor.validate(True)
+        ancestor._increaseSizeVirt(self.sizeVirt)
+        self.sr._updateSlavesOnResize(ancestor)
+        if ancestor is self.parent:
+            self._coalesceVHD(0)
+        else:
+            self._coalesceVHD(0, ancestor=ancestor)
+        ancestor.validate(True)
         #self._verifyContents(0)
-        self.parent.updateBlockInfo()
+        ancestor.updateBlockInfo()
 
     def _verifyContents(self, timeOut):
         Util.log("  Coalesce verification on %s" % self)
@@ -910,18 +978,26 @@ class VDI(object):
         if xcmsg:
             xapi.message.create(msg_name, "3", "SR", vdi.sr.uuid, msg_body)
 
-    def coalesce(self) -> int:
+    def coalesce(self, run=None) -> int:
         # size is returned in sectors
-        return vhdutil.coalesce(self.path) * 512
+        return vhdutil.coalesce(self.path, run=run) * 512
+
+    def coalesceOnto(self, ancestor, run=None) -> int:
+        return vhdutil.coalesce(self.path, ancestor.path, run=run) * 512
 
     @staticmethod
-    def _doCoalesceVHD(vdi):
+    def _doCoalesceVHD(vdi, ancestor=None, run=None):
+        """Return the start time, end time and size of the coalesce. It runs
+        in a child process, or vhd-util is run by run(cmd) when given"""
         try:
             startTime = time.time()
             vhdSize = vdi.getAllocatedSize()
-            coalesced_size = vdi.coalesce()
+            if ancestor:
+                coalesced_size = vdi.coalesceOnto(ancestor, run)
+            else:
+                coalesced_size = vdi.coalesce(run)
             endTime = time.time()
-            vdi.sr.recordStorageSpeed(startTime, endTime, coalesced_size)
+            return (startTime, endTime, coalesced_size)
         except util.CommandException as ce:
             # We use try/except for the following piece of code because it runs
             # in a separate process context and errors will not be caught and
@@ -935,6 +1011,41 @@ class VDI(object):
         except:
             raise
 
+    def _coalesceVHDInChild(self, abortTest, timeOut, ancestor):
+        """Coalesce in a child process, return the coalesce timing that it
+        sends back through a pipe (None if there is none)"""
+        resultRead, resultWrite = os.pipe()
+        os.set_blocking(resultRead, False)
+
+        def coalesceInChild():
+            result = VDI._doCoalesceVHD(self, ancestor)
+            os.write(resultWrite, ("%f %f %d" % result).encode())
+
+        try:
+            try:
+                Util.runAbortable(coalesceInChild, None, self.sr.uuid,
+                                  abortTest, VDI.POLL_INTERVAL, timeOut)
+            finally:
+                os.close(resultWrite)
+            try:
+                startTime, endTime, size = os.read(resultRead, 128).split()
+                return (float(startTime), float(endTime), int(size))
+            except (OSError, ValueError) as e:
+                Util.log("No coalesce timing from the child process: %s" % e)
+                return None
+        finally:
+            os.close(resultRead)
+
+    def _coalesceVHDInThread(self, abortTest, timeOut, ancestor):
+        """Coalesce from a worker thread of a parallel coalesce, which must
+        not fork: the child could block on a lock held by another thread.
+        vhd-util is run in a subprocess polled by the thread instead, the
+        other workers running in the meantime"""
+        run = lambda cmd: self.sr.runOutsideCoalesceMutex(
+            lambda: Util.runAbortableCmd(cmd, abortTest, VDI.POLL_INTERVAL,
+                                         timeOut))
+        return VDI._doCoalesceVHD(self, ancestor, run)
+
     def _vdi_is_raw(self, vdi_path):
         """
         Given path to vdi determine if it is raw
@@ -942,22 +1053,29 @@ class VDI(object):
         uuid = self.extractUuid(vdi_path)
         return self.sr.vdis[uuid].raw
 
-    def _coalesceVHD(self, timeOut):
+    def _coalesceVHD(self, timeOut, live=False, ancestor=None):
         Util.log("  Running VHD coalesce on %s" % self)
         abortTest = lambda: IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
         try:
             util.fistpoint.activate_custom_fn(
                 "cleanup_coalesceVHD_inject_failure",
                 util.inject_failure)
-            Util.runAbortable(lambda: VDI._doCoalesceVHD(self), None,
-                    self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
+            if self.sr.inParallelCoalesce():
+                result = self._coalesceVHDInThread(abortTest, timeOut,
+                                                   ancestor)
+            else:
+                result = self._coalesceVHDInChild(abortTest, timeOut,
+                                                  ancestor)
         except:
             #exception at this phase could indicate a failure in vhd coalesce
             # or a kill of vhd coalesce by runAbortable due to  timeOut
             # Try a repair and reraise the exception
             parent = ""
             try:
-                parent = self.getParent()
+                if ancestor:
+                    parent = ancestor.path
+                else:
+                    parent = self.getParent()
                 if not self._vdi_is_raw(parent):
                     # Repair error is logged and ignored. Error reraised later
                     util.SMlog('Coalesce failed on %s, attempting repair on ' \
@@ -969,18 +1087,25 @@ class VDI(object):
                            (parent, self.path, e))
             raise
 
+        if result:
+            startTime, endTime, size = result
+            self.sr.recordStorageSpeed(startTime, endTime, size, live)
+
         util.fistpoint.activate("LVHDRT_coalescing_VHD_data", self.sr.uuid)
 
-    def _relinkSkip(self) -> None:
-        """Relink children of this VDI to point to the parent of this VDI"""
+    def _relinkSkip(self, ancestor=None) -> None:
+        """Relink children of this VDI to point to the parent of this VDI, or
+        to ancestor after a multi-level coalesce"""
+        if ancestor is None:
+            ancestor = self.parent
         abortFlag = IPCFlag(self.sr.uuid)
         for child in self.children:
             if abortFlag.test(FLAG_TYPE_ABORT):
                 raise AbortException("Aborting due to signal")
             Util.log("  Relinking %s from %s to %s" % \
-                    (child, self, self.parent))
+                    (child, self, ancestor))
             util.fistpoint.activate("LVHDRT_relinking_grandchildren", self.sr.uuid)
-            child._setParent(self.parent)
+            child._setParent(ancestor)
         self.children = []
 
     def _reloadChildren(self, vdiSkip):
@@ -1043,6 +1168,7 @@ class VDI(object):
             self.parentUuid = ret
 
     def _setParent(self, parent) -> None:
+        self.sr._invalidateScanCache(self.uuid)
         vhdutil.setParent(self.path, parent.path, False)
         self.parent = parent
         self.parentUuid = parent.uuid
@@ -1066,6 +1192,7 @@ class VDI(object):
 
     def _setHidden(self, hidden=True) -> None:
         self._hidden = None
+        self.sr._invalidateScanCache(self.uuid)
         vhdutil.setHidden(self.path, hidden)
         self._hidden = hidden
 
@@ -1081,6 +1208,7 @@ class VDI(object):
         Util.log("  Expanding VHD virt size for VDI %s: %s -> %s" % \
                 (self, Util.num2str(self.sizeVirt), Util.num2str(size)))
 
+        self.sr._invalidateScanCache(self.uuid)
         msize = vhdutil.getMaxResizeSize(self.path) * 1024 * 1024
         if (size <= msize):
             vhdutil.setSizeVirtFast(self.path, size)
@@ -1111,16 +1239,22 @@ class VDI(object):
     def _queryVHDBlocks(self) -> bytes:
         return vhdutil.getBlockBitmap(self.path)
 
-    def _getCoalescedSizeData(self):
+    def _getCoalescedSizeData(self, ancestor=None):
         """Get the data size of the resulting VHD if we coalesce self onto
-        parent. We calculate the actual size by using the VHD block allocation
-        information (as opposed to just adding up the two VHD sizes to get an
-        upper bound)"""
+        parent, or onto ancestor along with the VDIs in between. We calculate
+        the actual size by using the VHD block allocation information (as
+        opposed to just adding up the VHD sizes to get an upper bound)"""
+        if ancestor is None:
+            ancestor = self.parent
         # make sure we don't use stale BAT info from vdi_rec since the child
         # was writable all this time
         self.delConfig(VDI.DB_VHD_BLOCKS)
         blocksChild = self.getVHDBlocks()
-        blocksParent = self.parent.getVHDBlocks()
+        vdi = self.parent
+        while vdi is not ancestor:
+            blocksChild = Util.orBitmaps(blocksChild, vdi.getVHDBlocks())
+            vdi = vdi.parent
+        blocksParent = ancestor.getVHDBlocks()
         numBlocks = Util.countBits(blocksChild, blocksParent)
         Util.log("Num combined blocks = %d" % numBlocks)
         sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
@@ -1128,11 +1262,16 @@ class VDI(object):
         return sizeData
 
     def _calcExtraSpaceForCoalescing(self) -> int:
-        sizeData = self._getCoalescedSizeData()
+        return self._calcExtraSpaceForCoalescingOnto(self.parent)
+
+    def _calcExtraSpaceForCoalescingOnto(self, ancestor) -> int:
+        """How much extra space in the SR will be required to coalesce self
+        onto ancestor"""
+        sizeData = self._getCoalescedSizeData(ancestor)
         sizeCoalesced = sizeData + vhdutil.calcOverheadBitmap(sizeData) + \
                 vhdutil.calcOverheadEmpty(self.sizeVirt)
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
-        return sizeCoalesced - self.parent.getSizeVHD()
+        return sizeCoalesced - ancestor.getSizeVHD()
 
     def _calcExtraSpaceForLeafCoalescing(self) -> int:
         """How much extra space in the SR will be required to
@@ -1298,15 +1437,17 @@ class LVHDVDI(VDI):
     def inflateFully(self):
         self.inflate(lvhdutil.calcSizeVHDLV(self.sizeVirt))
 
-    def inflateParentForCoalesce(self):
-        """Inflate the parent only as much as needed for the purposes of
-        coalescing"""
-        if self.parent.raw:
+    def inflateParentForCoalesce(self, ancestor=None):
+        """Inflate the parent (or ancestor) only as much as needed for the
+        purposes of coalescing"""
+        if ancestor is None:
+            ancestor = self.parent
+        if ancestor.raw:
             return
-        inc = self._calcExtraSpaceForCoalescing()
+        inc = self._calcExtraSpaceForCoalescingOnto(ancestor)
         if inc > 0:
             util.fistpoint.activate("LVHDRT_coalescing_before_inflate_grandparent", self.sr.uuid)
-            self.parent.inflate(self.parent.sizeLV + inc)
+            ancestor.inflate(ancestor.sizeLV + inc)
 
     @override
     def updateBlockInfo(self) -> Optional[str]:
@@ -1427,21 +1568,22 @@ class LVHDVDI(VDI):
             VDI.validate(self, fast)
 
     @override
-    def _doCoalesce(self) -> None:
+    def _doCoalesceOnto(self, ancestor) -> None:
         """LVHD parents must first be activated, inflated, and made writable"""
         try:
             self._activateChain()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, False)
-            self.parent.validate()
-            self.inflateParentForCoalesce()
-            VDI._doCoalesce(self)
+            self.sr.lvmCache.setReadonly(ancestor.fileName, False)
+            ancestor.validate()
+            self.inflateParentForCoalesce(ancestor)
+            VDI._doCoalesceOnto(self, ancestor)
         finally:
-            self.parent._loadInfoSizeVHD()
-            self.parent.deflate()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, True)
+            ancestor._loadInfoSizeVHD()
+            ancestor.deflate()
+            self.sr.lvmCache.setReadonly(ancestor.fileName, True)
 
     @override
     def _setParent(self, parent) -> None:
+        self.sr._invalidateScanCache(self.uuid)
         self._activate()
         if self.lvReadonly:
             self.sr.lvmCache.setReadonly(self.fileName, False)
@@ -1532,12 +1674,13 @@ class LVHDVDI(VDI):
         return VDI._queryVHDBlocks(self)
 
     @override
-    def _calcExtraSpaceForCoalescing(self) -> int:
-        if self.parent.raw:
+    def _calcExtraSpaceForCoalescingOnto(self, ancestor) -> int:
+        if ancestor.raw:
             return 0  # raw parents are never deflated in the first place
-        sizeCoalesced = lvhdutil.calcSizeVHDLV(self._getCoalescedSizeData())
+        sizeCoalesced = lvhdutil.calcSizeVHDLV(
+                self._getCoalescedSizeData(ancestor))
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
-        return sizeCoalesced - self.parent.sizeLV
+        return sizeCoalesced - ancestor.sizeLV
 
     @override
     def _calcExtraSpaceForLeafCoalescing(self) -> int:
@@ -1673,9 +1816,10 @@ class LinstorVDI(VDI):
         return super(LinstorVDI, self).pause(failfast)
 
     @override
-    def coalesce(self) -> int:
+    def coalesce(self, run=None) -> int:
         # Note: We raise `SMException` here to skip the current coalesce in case of failure.
         # Using another exception we can't execute the next coalesce calls.
+        # 'run' is never given: there is no parallel coalesce on LINSTOR.
         return self.sr._vhdutil.force_coalesce(self.path) * 512
 
     @override
@@ -1691,14 +1835,16 @@ class LinstorVDI(VDI):
         )
 
     @override
-    def _relinkSkip(self) -> None:
+    def _relinkSkip(self, ancestor=None) -> None:
+        if ancestor is None:
+            ancestor = self.parent
         abortFlag = IPCFlag(self.sr.uuid)
         for child in self.children:
             if abortFlag.test(FLAG_TYPE_ABORT):
                 raise AbortException('Aborting due to signal')
             Util.log(
                 '  Relinking {} from {} to {}'.format(
-                    child, self, self.parent
+                    child, self, ancestor
                 )
             )
 
@@ -1710,7 +1856,7 @@ class LinstorVDI(VDI):
                     vdi_uuid, timeout=self.VOLUME_LOCK_TIMEOUT
                 )
                 blktap2.VDI.tap_pause(session, sr_uuid, vdi_uuid)
-                child._setParent(self.parent)
+                child._setParent(ancestor)
             finally:
                 blktap2.VDI.tap_unpause(session, sr_uuid, vdi_uuid)
         self.children = []
@@ -1799,6 +1945,7 @@ class LinstorVDI(VDI):
         Util.log("  Expanding VHD virt size for VDI %s: %s -> %s" % \
                 (self, Util.num2str(self.sizeVirt), Util.num2str(size)))
 
+        self.sr._invalidateScanCache(self.uuid)
         msize = self.sr._vhdutil.get_max_resize_size(self.uuid) * 1024 * 1024
         if (size <= msize):
             self.sr._vhdutil.set_size_virt_fast(self.path, size)
@@ -1922,6 +2069,55 @@ class SR(object):
                 treeStr += self._getTreeStr(child, indent + VDI.STR_TREE_INDENT)
             return treeStr
 
+    class CoalesceIndex:
+        """The coalesce candidates of the SR in a heap, ordered by decreasing
+        height of their VHD tree, then by increasing extra space needed. The
+        space needed is only computed when a candidate first reaches the top
+        of the heap (until then it is infinite) and is kept afterwards, so
+        that it is computed at most once per candidate and tree"""
+
+        def __init__(self, vdis):
+            self.heap = []
+            self.candidates = set()
+            self.popped = []
+            treeHeights = {}
+            for vdi in vdis:
+                if not vdi.isCoalesceable():
+                    continue
+                Util.log("%s is coalescable" % vdi.uuid)
+                root = vdi.getTreeRoot()
+                if root not in treeHeights:
+                    treeHeights[root] = root.getTreeHeight()
+                self.heap.append([-treeHeights[root], float("inf"),
+                                  len(self.heap), vdi])
+                self.candidates.add(vdi)
+            heapq.heapify(self.heap)
+
+        def pop(self, skip):
+            """Pop the next candidate for which skip(vdi) is false, as a
+            (vdi, treeHeight, spaceNeeded) tuple, or None if there is none.
+            The popped candidates are put back by restore()"""
+            while self.heap:
+                entry = heapq.heappop(self.heap)
+                vdi = entry[3]
+                if skip(vdi):
+                    self.popped.append(entry)
+                    continue
+                if entry[1] == float("inf"):
+                    try:
+                        entry[1] = vdi._calcExtraSpaceForCoalescing()
+                    finally:
+                        heapq.heappush(self.heap, entry)
+                    continue
+                self.popped.append(entry)
+                return vdi, -entry[0], entry[1]
+            return None
+
+        def restore(self):
+            for entry in self.popped:
+                heapq.heappush(self.heap, entry)
+            self.popped = []
+
     TYPE_FILE = "file"
     TYPE_LVHD = "lvhd"
     TYPE_LINSTOR = "linstor"
@@ -1933,11 +2129,23 @@ class SR(object):
 
     SCAN_RETRY_ATTEMPTS = 3
 
+    # in an incremental scan, above this many changed VHDs a single batch scan
+    # of the whole SR is cheaper than querying the changed VHDs one by one
+    INCREMENTAL_SCAN_MAX_QUERIES = 16
+
+    # upper bound of KEY_MAX_PARALLEL_COALESCE
+    MAX_PARALLEL_COALESCE = 8
+
+    # upper bound of KEY_MAX_COALESCE_DEPTH
+    MAX_COALESCE_DEPTH = 32
+
     JRN_CLONE = "clone"  # journal entry type for the clone operation (from SM)
     TMP_RENAME_PREFIX = "OLD_"
 
     KEY_OFFLINE_COALESCE_NEEDED = "leaf_coalesce_need_offline"
     KEY_OFFLINE_COALESCE_OVERRIDE = "leaf_coalesce_offline_override"
+    KEY_MAX_PARALLEL_COALESCE = "max_parallel_coalesce"
+    KEY_MAX_COALESCE_DEPTH = "max_coalesce_depth"
 
     @staticmethod
     def getInstance(uuid, xapiSession, createLock=True, force=False):
@@ -1958,9 +2166,18 @@ class SR(object):
         self.name = ""
         self.vdis = {}
         self.vdiTrees = []
+        self._scanCache = {}
+        self._coalesceIndex = None
+        self._freeSpaceSample = None
+        self._speedLogSample = None
+        self._coalesceBudgets = {}
         self.journaler = None
         self.xapi = xapi
         self._locked = 0
+        # the SR lock is held by one thread at a time, _locked counts its
+        # nested acquires
+        self._lockMutex = threading.RLock()
+        self._lockOwner = None
         self._srLock = None
         if createLock:
             self._srLock = lock.Lock(vhdutil.LOCK_TYPE_SR, self.uuid)
@@ -1968,6 +2185,7 @@ class SR(object):
             Util.log("Requested no SR locking")
         self.name = self.xapi.srRecord["name_label"]
         self._failedCoalesceTargets = []
+        self._coalesceMutex = None
 
         if not self.xapi.isPluggedHere():
             if force:
@@ -2046,17 +2264,20 @@ class SR(object):
             return False
         return True
 
-    def scan(self, force=False) -> None:
+    def scan(self, force=False, incremental=False) -> None:
         """Scan the SR and load VDI info for each VDI. If called repeatedly,
-        update VDI objects if they already exist"""
+        update VDI objects if they already exist. In incremental mode, the VHD
+        info of the VDIs whose signature (LV attributes, file mtime...) did
+        not change since the previous scan is reused rather than read again"""
         pass
 
-    def scanLocked(self, force=False):
+    def scanLocked(self, force=False, incremental=False):
         self.lock()
         try:
-            self.scan(force)
+            self.scan(force, incremental)
         finally:
             self.unlock()
+        self._freeSpaceSample = None
 
     def getVDI(self, uuid):
         return self.vdis.get(uuid)
@@ -2076,8 +2297,21 @@ class SR(object):
         """Find a coalesceable VDI. Return a vdi that should be coalesced
         (choosing one among all coalesceable candidates according to some
         criteria) or None if there is no VDI that could be coalesced"""
+        candidates = self.findCoalesceables(1)
+        if candidates:
+            return candidates[0]
+        return None
+
+    def findCoalesceables(self, maxCount):
+        """Find up to maxCount coalesceable VDIs that can be coalesced at the
+        same time: each one in a different VHD tree, and with enough free
+        space in the SR for all of them. Return an empty list if there is no
+        VDI that could be coalesced. The free space is shared between the
+        chosen VDIs: each one gets the space it needs plus an equal part of
+        what is left, as the budget of its coalesce run (see getCoalesceRun)"""
 
         candidates = []
+        self._coalesceBudgets = {}
 
         srSwitch = self.xapi.srRecord["other_config"].get(VDI.DB_COALESCE)
         if srSwitch == "false":
@@ -2089,39 +2323,142 @@ class SR(object):
         for uuid in journals:
             vdi = self.getVDI(uuid)
             if vdi and vdi not in self._failedCoalesceTargets:
-                return vdi
+                return [vdi]
 
-        for vdi in self.vdis.values():
-            if vdi.isCoalesceable() and vdi not in self._failedCoalesceTargets:
-                candidates.append(vdi)
-                Util.log("%s is coalescable" % vdi.uuid)
+        index = self.getCoalesceIndex()
+        failed = index.candidates.intersection(self._failedCoalesceTargets)
+        self.xapi.update_task_progress("coalescable",
+                                       len(index.candidates) - len(failed))
 
-        self.xapi.update_task_progress("coalescable", len(candidates))
+        # pick them in the tallest trees first
+        freeSpace = self.getFreeSpaceSample()
+        spaceLeft = freeSpace
+        chosen = []
+        chosenTrees = set()
+        spaceNeededByVDI = {}
 
-        # pick one in the tallest tree
-        treeHeight = dict()
-        for c in candidates:
-            height = c.getTreeRoot().getTreeHeight()
-            if treeHeight.get(height):
-                treeHeight[height].append(c)
-            else:
-                treeHeight[height] = [c]
+        def skip(vdi):
+            return vdi in failed or vdi.getTreeRoot() in chosenTrees
 
-        freeSpace = self.getFreeSpace()
-        heights = list(treeHeight.keys())
-        heights.sort(reverse=True)
-        for h in heights:
-            for c in treeHeight[h]:
-                spaceNeeded = c._calcExtraSpaceForCoalescing()
-                if spaceNeeded <= freeSpace:
+        try:
+            while len(chosen) < maxCount:
+                candidate = index.pop(skip)
+                if not candidate:
+                    break
+                c, h, spaceNeeded = candidate
+                if spaceNeeded <= spaceLeft:
                     Util.log("Coalesce candidate: %s (tree height %d)" % (c, h))
                     self.clear_no_space_msg(c)
-                    return c
+                    chosen.append(c)
+                    chosenTrees.add(c.getTreeRoot())
+                    spaceNeededByVDI[c.uuid] = max(spaceNeeded, 0)
+                    spaceLeft -= max(spaceNeeded, 0)
+                elif spaceNeeded <= freeSpace:
+                    Util.log("Not enough space left to coalesce %s along "
+                             "with the other candidates" % c)
                 else:
                     self.no_space_candidates[c.uuid] = c
                     Util.log("No space to coalesce %s (free space: %d)" % \
                             (c, freeSpace))
-        return None
+        finally:
+            index.restore()
+        for c in chosen:
+            self._coalesceBudgets[c.uuid] = spaceNeededByVDI[c.uuid] + \
+                    spaceLeft // len(chosen)
+        return chosen
+
+    def getCoalesceIndex(self):
+        """The index of the coalesce candidates, built once per VHD tree
+        (see CoalesceIndex)"""
+        if self._coalesceIndex is None:
+            self._coalesceIndex = self.CoalesceIndex(self.vdis.values())
+        return self._coalesceIndex
+
+    def getFreeSpaceSample(self):
+        """getFreeSpace() sampled once per scan, for the candidate searches
+        that follow it"""
+        if self._freeSpaceSample is None:
+            self._freeSpaceSample = self.getFreeSpace()
+        return self._freeSpaceSample
+
+    def getSpeedLogSample(self):
+        """readSpeedLog() kept until this process records a new speed: the
+        candidate searches of a GC pass read the speed log only once"""
+        if self._speedLogSample is None:
+            self._speedLogSample = self.readSpeedLog() or []
+        return self._speedLogSample
+
+    def invalidateIndex(self):
+        """Drop the coalesce index and the free space sample after the VHD
+        trees changed"""
+        self._coalesceIndex = None
+        self._freeSpaceSample = None
+
+    def getMaxParallelCoalesce(self):
+        """The max number of VHD trees to coalesce at the same time, set with
+        the KEY_MAX_PARALLEL_COALESCE key of the SR other-config"""
+        val = self.getSwitch(SR.KEY_MAX_PARALLEL_COALESCE)
+        if not val:
+            return 1
+        try:
+            maxCount = int(val)
+        except ValueError:
+            Util.log("Invalid %s value: %s" %
+                     (SR.KEY_MAX_PARALLEL_COALESCE, val))
+            return 1
+        return max(1, min(maxCount, SR.MAX_PARALLEL_COALESCE))
+
+    def getMaxCoalesceDepth(self):
+        """The max number of hidden VHDs to coalesce onto their ancestor in a
+        single pass, set with the KEY_MAX_COALESCE_DEPTH key of the SR
+        other-config"""
+        val = self.getSwitch(SR.KEY_MAX_COALESCE_DEPTH)
+        if not val:
+            return 1
+        try:
+            maxDepth = int(val)
+        except ValueError:
+            Util.log("Invalid %s value: %s" %
+                     (SR.KEY_MAX_COALESCE_DEPTH, val))
+            return 1
+        return max(1, min(maxDepth, SR.MAX_COALESCE_DEPTH))
+
+    def getCoalesceRun(self, vdi, spaceBudget):
+        """Extend the coalesce of vdi to the run of coalesceable VDIs around
+        it, each one the only child of the next, up to getMaxCoalesceDepth()
+        VDIs. Return the lowest VDI of the run and the ancestor that the whole
+        run can be coalesced onto in one pass, which is the parent of vdi
+        when the run is vdi alone or needs more than spaceBudget"""
+        maxDepth = self.getMaxCoalesceDepth()
+        if maxDepth == 1:
+            return vdi, vdi.parent
+
+        def canJoin(other):
+            return other.isCoalesceable() and \
+                    other not in self._failedCoalesceTargets
+
+        bottom = vdi
+        top = vdi
+        depth = 1
+        while depth < maxDepth and len(bottom.children) == 1 and \
+                canJoin(bottom.children[0]):
+            bottom = bottom.children[0]
+            depth += 1
+        while depth < maxDepth and canJoin(top.parent) and \
+                not top.parent.parent.raw:
+            top = top.parent
+            depth += 1
+        if depth == 1:
+            return vdi, vdi.parent
+
+        ancestor = top.parent
+        spaceNeeded = bottom._calcExtraSpaceForCoalescingOnto(ancestor)
+        if spaceNeeded > spaceBudget:
+            Util.log("No space to coalesce %d VDIs from %s onto %s at once "
+                     "(space budget: %d)" % (depth, bottom, ancestor,
+                                             spaceBudget))
+            return vdi, vdi.parent
+        return bottom, ancestor
 
     def getSwitch(self, key):
         return self.xapi.srRecord["other_config"].get(key)
@@ -2156,7 +2493,9 @@ class SR(object):
 
         self.xapi.update_task_progress("coalescable", len(candidates))
 
-        freeSpace = self.getFreeSpace()
+        freeSpace = self.getFreeSpaceSample()
+        samples = self.getSpeedLogSample()
+        speed = self.predictStorageSpeed(samples, time.localtime().tm_hour)
         for candidate in candidates:
             # check the space constraints to see if leaf-coalesce is actually
             # feasible for this candidate
@@ -2164,8 +2503,10 @@ class SR(object):
             spaceNeededLive = spaceNeeded
             if spaceNeeded > freeSpace:
                 spaceNeededLive = candidate._calcExtraSpaceForLeafCoalescing()
-                if candidate.canLiveCoalesce(self.getStorageSpeed()):
+                if candidate.canLiveCoalesce(speed):
                     spaceNeeded = spaceNeededLive
+            elif self._deferLeafCoalesce(candidate, samples):
+                continue
 
             if spaceNeeded <= freeSpace:
                 Util.log("Leaf-coalesce candidate: %s" % candidate)
@@ -2208,17 +2549,82 @@ class SR(object):
         if dryRun:
             return
 
+        try:
+            self._tryCoalesce(vdi)
+        except AbortException:
+            self.cleanup()
+            raise
+        self.cleanup()
+
+    def coalesceParallel(self, vdiList, dryRun=False):
+        """Coalesce the VDIs (each one in a different VHD tree) onto their
+        parents at the same time, one thread per VDI. The threads take turns
+        on the SR object under _coalesceMutex, which they only release while
+        waiting for the VHD coalesce process (see runOutsideCoalesceMutex):
+        the journaling, relinking and scanning remain sequential"""
+        for vdi in vdiList:
+            Util.log("Coalescing %s -> %s" % (vdi, vdi.parent))
+        if dryRun:
+            return
+
+        errors = []
+
+        def worker(vdi):
+            with self._coalesceMutex:
+                try:
+                    self._tryCoalesce(vdi)
+                except Exception as e:
+                    if not isinstance(e, AbortException):
+                        Util.logException("coalesce")
+                    errors.append(e)
+
+        self._coalesceMutex = threading.Lock()
+        try:
+            threads = [threading.Thread(target=worker, args=(vdi,))
+                       for vdi in vdiList]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._coalesceMutex = None
+            self.cleanup()
+
+        for e in errors:
+            if isinstance(e, AbortException):
+                raise e
+        if errors:
+            raise errors[0]
+
+    def inParallelCoalesce(self):
+        return self._coalesceMutex is not None
+
+    def runOutsideCoalesceMutex(self, func):
+        """Run func, which must not touch the SR object, letting the other
+        workers of a parallel coalesce run in the meantime"""
+        if not self._coalesceMutex or \
+                self._lockOwner == threading.get_ident():
+            # the other workers would block on the SR lock we hold
+            return func()
+        self._coalesceMutex.release()
+        try:
+            return func()
+        finally:
+            self._coalesceMutex.acquire()
+
+    def _tryCoalesce(self, vdi):
+        """Coalesce vdi onto parent, recording it as a failed target unless
+        the coalesce was aborted"""
         try:
             self._coalesce(vdi)
         except util.SMException as e:
             if isinstance(e, AbortException):
-                self.cleanup()
                 raise
-            else:
-                self._failedCoalesceTargets.append(vdi)
-                Util.logException("coalesce")
-                Util.log("Coalesce failed, skipping")
-        self.cleanup()
+            self._failedCoalesceTargets.append(vdi)
+            Util.logException("coalesce")
+            Util.log("Coalesce failed, skipping")
+        finally:
+            self.invalidateIndex()
 
     def coalesceLeaf(self, vdi, dryRun=False):
         """Leaf-coalesce vdi onto parent"""
@@ -2232,9 +2638,11 @@ class SR(object):
                 # "vdi" object will no longer be valid after this call
                 self._coalesceLeaf(vdi)
             finally:
+                self.invalidateIndex()
                 vdi = self.getVDI(uuid)
                 if vdi:
                     vdi.delConfig(vdi.DB_LEAFCLSC)
+                    vdi.delConfig(vdi.DB_LEAFCLSC_DEFERRED)
         except AbortException:
             self.cleanup()
             raise
@@ -2268,6 +2676,7 @@ class SR(object):
 
     def deleteVDI(self, vdi) -> None:
         assert(len(vdi.children) == 0)
+        self.invalidateIndex()
         del self.vdis[vdi.uuid]
         if vdi.parent:
             vdi.parent.children.remove(vdi)
@@ -2327,16 +2736,22 @@ class SR(object):
         if not self._srLock:
             return
 
+        self._lockMutex.acquire()
         if self._locked == 0:
             abortFlag = IPCFlag(self.uuid)
-            for i in range(SR.LOCK_RETRY_ATTEMPTS_LOCK):
-                if self._srLock.acquireNoblock():
-                    self._locked += 1
-                    return
-                if abortFlag.test(FLAG_TYPE_ABORT):
-                    raise AbortException("Abort requested")
-                time.sleep(SR.LOCK_RETRY_INTERVAL)
-            raise util.SMException("Unable to acquire the SR lock")
+            try:
+                for i in range(SR.LOCK_RETRY_ATTEMPTS_LOCK):
+                    if self._srLock.acquireNoblock():
+                        self._locked += 1
+                        self._lockOwner = threading.get_ident()
+                        return
+                    if abortFlag.test(FLAG_TYPE_ABORT):
+                        raise AbortException("Abort requested")
+                    time.sleep(SR.LOCK_RETRY_INTERVAL)
+                raise util.SMException("Unable to acquire the SR lock")
+            except:
+                self._lockMutex.release()
+                raise
 
         self._locked += 1
 
@@ -2344,9 +2759,12 @@ class SR(object):
         if not self._srLock:
             return
         assert(self._locked > 0)
+        assert(self._lockOwner == threading.get_ident())
         self._locked -= 1
         if self._locked == 0:
+            self._lockOwner = None
             self._srLock.release()
+        self._lockMutex.release()
 
     def needUpdateBlockInfo(self) -> bool:
         for vdi in self.vdis.values():
@@ -2389,17 +2807,38 @@ class SR(object):
         return 0
 
     def _coalesce(self, vdi):
-        if self.journaler.get(vdi.JRN_RELINK, vdi.uuid):
+        relinkTarget = self.journaler.get(vdi.JRN_RELINK, vdi.uuid)
+        if relinkTarget:
             # this means we had done the actual coalescing already and just
-            # need to finish relinking and/or refreshing the children
+            # need to finish relinking and/or refreshing the children. After
+            # a multi-level coalesce the journal holds the ancestor uuid
             Util.log("==> Coalesce apparently already done: skipping")
+            if relinkTarget == "1":
+                ancestor = vdi.parent
+            else:
+                ancestor = self.getVDI(relinkTarget)
+                if not ancestor:
+                    raise util.SMException("Relink target %s of %s not found"
+                                           % (relinkTarget, vdi))
         else:
+            # the budget is set by findCoalesceables(), which a direct call
+            # may have skipped
+            spaceBudget = self._coalesceBudgets.pop(vdi.uuid, None)
+            if spaceBudget is None:
+                spaceBudget = self.getFreeSpace()
+            vdi, ancestor = self.getCoalesceRun(vdi, spaceBudget)
             # JRN_COALESCE is used to check which VDI is being coalesced in
             # order to decide whether to abort the coalesce. We remove the
             # journal as soon as the VHD coalesce step is done, because we
             # don't expect the rest of the process to take long
             self.journaler.create(vdi.JRN_COALESCE, vdi.uuid, "1")
-            vdi._doCoalesce()
+            if ancestor is vdi.parent:
+                vdi._doCoalesce()
+                relinkTarget = "1"
+            else:
+                Util.log("Coalescing %s -> %s in one pass" % (vdi, ancestor))
+                vdi._doCoalesceOnto(ancestor)
+                relinkTarget = ancestor.uuid
             self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
 
             util.fistpoint.activate("LVHDRT_before_create_relink_journal", self.uuid)
@@ -2408,20 +2847,28 @@ class SR(object):
             # like SM.clone from manipulating the VDIs we'll be relinking and
             # rescan the SR first in case the children changed since the last
             # scan
-            self.journaler.create(vdi.JRN_RELINK, vdi.uuid, "1")
+            self.journaler.create(vdi.JRN_RELINK, vdi.uuid, relinkTarget)
 
         self.lock()
         try:
-            vdi.parent._tagChildrenForRelink()
+            ancestor._tagChildrenForRelink()
             self.scan()
-            vdi._relinkSkip()
+            vdi._relinkSkip(ancestor)
         finally:
             self.unlock()
-            # Reload the children to leave things consistent
-            vdi.parent._reloadChildren(vdi)
+            # Reload the children to leave things consistent, skipping the
+            # coalesced VDIs
+            top = vdi
+            while top.parent and top.parent is not ancestor:
+                top = top.parent
+            ancestor._reloadChildren(top)
 
         self.journaler.remove(vdi.JRN_RELINK, vdi.uuid)
-        self.deleteVDI(vdi)
+        # the VDIs between vdi and ancestor are left without children too
+        while vdi and vdi is not ancestor and len(vdi.children) == 0:
+            parent = vdi.parent
+            self.deleteVDI(vdi)
+            vdi = parent
 
     class CoalesceTracker:
         GRACE_ITERATIONS = 2
@@ -2547,73 +2994,161 @@ class SR(object):
             speed = float(vhdSize) / float(total_time)
         return speed
 
-    def writeSpeedToFile(self, speed):
+    def writeSpeedToFile(self, speed, live=False):
         content = []
         speedFile = None
         path = SPEED_LOG_ROOT.format(uuid=self.uuid)
+        sample = "%s %d %s\n" % (speed, int(time.time()),
+                                  SPEED_LIVE if live else SPEED_OFFLINE)
         self.lock()
         try:
             Util.log("Writing to file: {myfile}".format(myfile=path))
             lines = ""
             if not os.path.isfile(path):
-                lines = str(speed) + "\n"
+                lines = sample
             else:
                 speedFile = open(path, "r+")
                 content = speedFile.readlines()
-                content.append(str(speed) + "\n")
-                if len(content) > N_RUNNING_AVERAGE:
-                    del content[0]
+                content.append(sample)
+                if len(content) > N_SPEED_SAMPLES:
+                    del content[:len(content) - N_SPEED_SAMPLES]
                 lines = "".join(content)
 
             util.atomicFileWrite(path, VAR_RUN, lines)
+            self._speedLogSample = None
         finally:
             if speedFile is not None:
                 speedFile.close()
             Util.log("Closing file: {myfile}".format(myfile=path))
             self.unlock()
 
-    def recordStorageSpeed(self, startTime, endTime, vhdSize):
+    def recordStorageSpeed(self, startTime, endTime, vhdSize, live=False):
         speed = self.calcStorageSpeed(startTime, endTime, vhdSize)
         if speed is None:
             return
 
-        self.writeSpeedToFile(speed)
+        self.writeSpeedToFile(speed, live)
 
-    def getStorageSpeed(self):
+    @staticmethod
+    def parseSpeedSample(line):
+        """Return the (speed, time, live) of a speed log line. The lines
+        written before the time and the mode were logged only have the
+        speed: their time is None and they are considered offline"""
+        fields = str(line).split()
+        if len(fields) == 1:
+            return (float(fields[0]), None, False)
+        if len(fields) != 3 or fields[2] not in (SPEED_LIVE, SPEED_OFFLINE):
+            raise ValueError("bad speed sample: %s" % line)
+        return (float(fields[0]), int(fields[1]), fields[2] == SPEED_LIVE)
+
+    def readSpeedLog(self):
+        """Return the samples of the speed log, oldest first, or None if
+        there are none"""
         speedFile = None
         path = SPEED_LOG_ROOT.format(uuid=self.uuid)
         self.lock()
         try:
-            speed = None
-            if os.path.isfile(path):
-                speedFile = open(path)
-                content = speedFile.readlines()
-                try:
-                    content = [float(i) for i in content]
-                except ValueError:
-                    Util.log("Something bad in the speed log:{log}".
-                             format(log=speedFile.readlines()))
-                    return speed
-
-                if len(content):
-                    speed = sum(content) / float(len(content))
-                    if speed <= 0:
-                        # Defensive, should be impossible.
-                        Util.log("Bad speed: {speed} calculated for SR: {uuid}".
-                             format(speed=speed, uuid=self.uuid))
-                        speed = None
-                else:
-                    Util.log("Speed file empty for SR: {uuid}".
-                             format(uuid=self.uuid))
-            else:
+            if not os.path.isfile(path):
                 Util.log("Speed log missing for SR: {uuid}".
                          format(uuid=self.uuid))
-            return speed
+                return None
+            speedFile = open(path)
+            content = speedFile.readlines()
+            try:
+                samples = [self.parseSpeedSample(i) for i in content]
+            except ValueError:
+                Util.log("Something bad in the speed log:{log}".
+                         format(log=content))
+                return None
+            if not samples:
+                Util.log("Speed file empty for SR: {uuid}".
+                         format(uuid=self.uuid))
+                return None
+            return samples
         finally:
             if not (speedFile is None):
                 speedFile.close()
             self.unlock()
 
+    def predictStorageSpeed(self, samples, hour):
+        """Predict a lower bound of the coalesce speed at the given hour of
+        the day: the recency-weighted mean of the most relevant samples minus
+        SPEED_CONFIDENCE standard deviations. The live samples taken around
+        that time of day are preferred. None if the speed is unknown or too
+        variable to be predicted"""
+        if not samples:
+            return None
+
+        def nearHour(sample):
+            if sample[1] is None:
+                return False
+            delta = abs(time.localtime(sample[1]).tm_hour - hour)
+            return min(delta, 24 - delta) <= SPEED_HOUR_WINDOW
+
+        near = [s for s in samples if nearHour(s)]
+        live = [s for s in samples if s[2]]
+        for pool in ([s for s in near if s[2]], near, live, samples):
+            if len(pool) >= SPEED_MIN_SAMPLES:
+                break
+        else:
+            pool = samples
+
+        weights = [SPEED_DECAY ** age for age in range(len(pool) - 1, -1, -1)]
+        total = sum(weights)
+        mean = sum(w * s[0] for w, s in zip(weights, pool)) / total
+        variance = sum(w * (s[0] - mean) ** 2
+                       for w, s in zip(weights, pool)) / total
+        speed = mean - SPEED_CONFIDENCE * math.sqrt(variance)
+        if speed <= 0:
+            Util.log("Speed too variable to be predicted for SR: {uuid} "
+                     "(mean {mean}, {count} samples)".
+                     format(uuid=self.uuid, mean=mean, count=len(pool)))
+            return None
+        return speed
+
+    def getStorageSpeed(self, hour=None):
+        """Return the coalesce speed to expect at the given hour of the day
+        (now by default), see predictStorageSpeed"""
+        if hour is None:
+            hour = time.localtime().tm_hour
+        return self.predictStorageSpeed(self.readSpeedLog(), hour)
+
+    def _deferLeafCoalesce(self, vdi, samples):
+        """Should the leaf-coalesce of the VDI wait for a quieter time of day?
+        That is the case when it could not be live-coalesced with the speed
+        predicted from the speed log samples for now, but could with the one
+        predicted for one of the next SPEED_MAX_DEFER_HOURS hours: this saves
+        snapshot-coalescing it. The time of the first deferral is kept in the
+        VDI config so that it is not deferred for longer than that in total"""
+        if not samples:
+            return False
+        now = time.localtime().tm_hour
+        if vdi.canLiveCoalesce(self.predictStorageSpeed(samples, now)):
+            return False
+        deferred = vdi.getConfig(VDI.DB_LEAFCLSC_DEFERRED)
+        if deferred:
+            try:
+                deferred = int(deferred)
+            except ValueError:
+                Util.log("Bad %s for %s: %s" %
+                         (VDI.DB_LEAFCLSC_DEFERRED, vdi, deferred))
+                return False
+            if time.time() - deferred >= SPEED_MAX_DEFER_HOURS * 60 * 60:
+                Util.log("Leaf-coalesce of %s deferred since %s, not "
+                         "deferring it anymore" % (vdi, time.ctime(deferred)))
+                return False
+        for delta in range(1, SPEED_MAX_DEFER_HOURS + 1):
+            hour = (now + delta) % 24
+            speed = self.predictStorageSpeed(samples, hour)
+            if speed and vdi.canLiveCoalesce(speed):
+                Util.log("Deferring leaf-coalesce of %s: the storage is "
+                         "expected to be faster at %d:00" % (vdi, hour))
+                if not deferred:
+                    vdi.setConfig(VDI.DB_LEAFCLSC_DEFERRED,
+                                  str(int(time.time())))
+                return True
+        return False
+
     def _snapshotCoalesce(self, vdi):
         # Note that because we are not holding any locks here, concurrent SM
         # operations may change this tree under our feet. In particular, vdi
@@ -2694,7 +3229,7 @@ class SR(object):
         if vdi.getConfig(vdi.DB_LEAFCLSC) == vdi.LEAFCLSC_FORCE:
             Util.log("Leaf-coalesce forced, will not use timeout")
             timeout = 0
-        vdi._coalesceVHD(timeout)
+        vdi._coalesceVHD(timeout, live=True)
         util.fistpoint.activate("LVHDRT_coaleaf_after_coalesce", self.uuid)
         vdi.parent.validate(True)
         #vdi._verifyContents(timeout / 2)
@@ -2776,6 +3311,40 @@ class SR(object):
                         self.vdis[uuid])
                 del self.vdis[uuid]
 
+    def _getReusableScanInfo(self, signatures):
+        """Return the scan info cached for the VDIs whose signature did not
+        change since the previous scan, or nothing if too many changed for an
+        incremental scan to be worth it"""
+        reusable = {}
+        for uuid, signature in signatures.items():
+            cached = self._scanCache.get(uuid)
+            if cached and cached[0] == signature:
+                reusable[uuid] = cached[1]
+        if len(signatures) - len(reusable) > self.INCREMENTAL_SCAN_MAX_QUERIES:
+            return {}
+        return reusable
+
+    def _updateScanCache(self, signatures, infos) -> None:
+        self._scanCache = {}
+        for uuid, info in infos.items():
+            if uuid in signatures:
+                self._scanCache[uuid] = (signatures[uuid], info)
+
+    def _invalidateScanCache(self, uuid) -> None:
+        """Make the next incremental scan read the VHD info of this VDI again.
+        Must be called whenever we change VHD metadata that the signature
+        does not account for"""
+        self._scanCache.pop(uuid, None)
+
+    def _isScanUnchanged(self, numInfos, numReused, uuidsPresent):
+        """Log how much of the previous scan was reused, and tell whether the
+        VDIs are exactly those of the previous scan, so that the current tree
+        can be kept as is"""
+        Util.log("Incremental scan: reused %d/%d VHD headers" % \
+                (numReused, numInfos))
+        return numReused == numInfos and len(self.vdiTrees) > 0 and \
+                set(uuidsPresent) == set(self.vdis.keys())
+
     def _handleInterruptedCoalesceLeaf(self) -> None:
         """An interrupted leaf-coalesce operation may leave the VHD tree in an
         inconsistent state. If the old-leaf VDI is still present, we revert the
@@ -2784,6 +3353,7 @@ class SR(object):
         pass
 
     def _buildTree(self, force):
+        self.invalidateIndex()
         self.vdiTrees = []
         for vdi in self.vdis.values():
             if vdi.parentUuid:
@@ -2820,10 +3390,25 @@ class FileSR(SR):
         self.journaler = fjournaler.Journaler(self.path)
 
     @override
-    def scan(self, force=False) -> None:
+    def scan(self, force=False, incremental=False) -> None:
         if not util.pathexists(self.path):
             raise util.SMException("directory %s not found!" % self.uuid)
-        vhds = self._scan(force)
+        signatures = self._getScanSignatures()
+        reusable = {}
+        if incremental:
+            reusable = self._getReusableScanInfo(signatures)
+        vhds = self._scan(force, list(signatures.keys()), reusable)
+        self._updateScanCache(signatures,
+                dict((k, v) for k, v in vhds.items() if not v.error))
+        uuidsPresent = list(vhds.keys())
+        rawList = [x for x in os.listdir(self.path) if x.endswith(vhdutil.FILE_EXTN_RAW)]
+        if incremental:
+            numReused = len([k for k, v in vhds.items() if reusable.get(k) is v])
+            uuidsAll = uuidsPresent + [FileVDI.extractUuid(x) for x in rawList]
+            if self._isScanUnchanged(len(vhds), numReused, uuidsAll):
+                self.logFilter.logState()
+                self._handleInterruptedCoalesceLeaf()
+                return
         for uuid, vhdInfo in vhds.items():
             vdi = self.getVDI(uuid)
             if not vdi:
@@ -2831,8 +3416,6 @@ class FileSR(SR):
                 vdi = FileVDI(self, uuid, False)
                 self.vdis[uuid] = vdi
             vdi.load(vhdInfo)
-        uuidsPresent = list(vhds.keys())
-        rawList = [x for x in os.listdir(self.path) if x.endswith(vhdutil.FILE_EXTN_RAW)]
         for rawName in rawList:
             uuid = FileVDI.extractUuid(rawName)
             uuidsPresent.append(uuid)
@@ -2935,11 +3518,14 @@ class FileSR(SR):
         return (len(name) == Util.UUID_LEN + len(self.CACHE_FILE_EXT)) and \
                 name.endswith(self.CACHE_FILE_EXT)
 
-    def _scan(self, force):
+    def _scan(self, force, uuids=None, reusable=None):
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
-            pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
-            vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid)
+            if reusable:
+                vhds = self._scanChanged(uuids, reusable)
+            else:
+                pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
+                vhds = vhdutil.getAllVHDsCached(pattern, FileVDI.extractUuid)
             for uuid, vhdInfo in vhds.items():
                 if vhdInfo.error:
                     error = True
@@ -2947,10 +3533,43 @@ class FileSR(SR):
             if not error:
                 return vhds
             Util.log("Scan error on attempt %d" % i)
+            # retry with a full scan
+            reusable = None
         if force:
             return vhds
         raise util.SMException("Scan error")
 
+    def _scanChanged(self, uuids, reusable):
+        """Query the VHDs that are not in 'reusable' one by one"""
+        vhds = dict()
+        for uuid in uuids:
+            if uuid in reusable:
+                vhds[uuid] = reusable[uuid]
+                continue
+            path = os.path.join(self.path, uuid + vhdutil.FILE_EXTN_VHD)
+            try:
+                vhds[uuid] = vhdutil.getVHDInfo(path, FileVDI.extractUuid)
+            except util.CommandException as e:
+                vhdInfo = vhdutil.VHDInfo(uuid)
+                vhdInfo.error = str(e)
+                vhds[uuid] = vhdInfo
+        return vhds
+
+    def _getScanSignatures(self):
+        """The signature of a VHD file changes whenever the file is written
+        to, and when another file is renamed to its name"""
+        signatures = {}
+        for name in os.listdir(self.path):
+            if not name.endswith(vhdutil.FILE_EXTN_VHD):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            signatures[FileVDI.extractUuid(name)] = \
+                    (st.st_ino, st.st_size, st.st_mtime_ns)
+        return signatures
+
     @override
     def deleteVDI(self, vdi) -> None:
         self._checkSlaves(vdi)
@@ -3111,8 +3730,24 @@ class LVHDSR(SR):
             self.cleanup()
 
     @override
-    def scan(self, force=False) -> None:
-        vdis = self._scan(force)
+    def scan(self, force=False, incremental=False) -> None:
+        vdis, numReused = self._scan(force, incremental)
+        if incremental and self._isScanUnchanged(len(vdis), numReused,
+                vdis.keys()):
+            for uuid, vdi in self.vdis.items():
+                # the VHD may have been written to, only its header is known
+                # not to have changed
+                vdi._sizeVHD = -1
+                vdi._sizeAllocated = -1
+                # the LV state comes from the refreshed LVM cache
+                vdiInfo = vdis[uuid]
+                vdi.sizeLV = vdiInfo.sizeLV
+                vdi.lvActive = vdiInfo.lvActive
+                vdi.lvOpen = vdiInfo.lvOpen
+                vdi.lvReadonly = vdiInfo.lvReadonly
+            self.logFilter.logState()
+            self._handleInterruptedCoalesceLeaf()
+            return
         for uuid, vdiInfo in vdis.items():
             vdi = self.getVDI(uuid)
             if not vdi:
@@ -3126,22 +3761,39 @@ class LVHDSR(SR):
         self.logFilter.logState()
         self._handleInterruptedCoalesceLeaf()
 
-    def _scan(self, force):
+    def _scan(self, force, incremental=False):
+        """Return the VDI info and how many VHD headers were reused from the
+        previous scan"""
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
             self.lvmCache.refresh()
-            vdis = lvhdutil.getVDIInfo(self.lvmCache)
+            signatures = self._getScanSignatures()
+            reusable = {}
+            if incremental:
+                reusable = self._getReusableScanInfo(signatures)
+            vdis = lvhdutil.getVDIInfo(self.lvmCache, reusable)
             for uuid, vdiInfo in vdis.items():
                 if vdiInfo.scanError:
                     error = True
                     break
             if not error:
-                return vdis
+                self._updateScanCache(signatures, vdis)
+                return vdis, len(reusable)
             Util.log("Scan error, retrying (%d)" % i)
+            # retry with a full scan
+            incremental = False
         if force:
-            return vdis
+            self._updateScanCache(signatures,
+                    dict((k, v) for k, v in vdis.items() if not v.scanError))
+            return vdis, 0
         raise util.SMException("Scan error")
 
+    def _getScanSignatures(self):
+        signatures = {}
+        for uuid, lvInfo in lvhdutil.getLVInfo(self.lvmCache).items():
+            signatures[uuid] = self.lvmCache.getSignature(lvInfo.name)
+        return signatures
+
     @override
     def _removeStaleVDIs(self, uuidsPresent) -> None:
         for uuid in list(self.vdis.keys()):
@@ -3332,8 +3984,8 @@ class LVHDSR(SR):
             Util.log("Updating %s, %s, %s on slave %s" % \
                     (tmpName, child.fileName, parent.fileName,
                      self.xapi.getRecordHost(slave)['hostname']))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
+        for text in util.call_plugin_on_hosts(
+                slaves, self.xapi.PLUGIN_ON_SLAVE, "multi", args):
             Util.log("call-plugin returned: '%s'" % text)
 
     @override
@@ -3355,8 +4007,8 @@ class LVHDSR(SR):
             Util.log("Updating %s to %s on slave %s" % \
                     (oldNameLV, vdi.fileName,
                      self.xapi.getRecordHost(slave)['hostname']))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
+        for text in util.call_plugin_on_hosts(
+                slaves, self.xapi.PLUGIN_ON_SLAVE, "multi", args):
             Util.log("call-plugin returned: '%s'" % text)
 
     @override
@@ -3393,7 +4045,21 @@ class LinstorSR(SR):
         return self._linstor.max_volume_size_allowed
 
     @override
-    def scan(self, force=False) -> None:
+    def getMaxCoalesceDepth(self):
+        # the volumes are coalesced with force_coalesce, which has no
+        # multi-level mode
+        return 1
+
+    @override
+    def getMaxParallelCoalesce(self):
+        # force_coalesce may run on another host, it cannot be run by the
+        # parallel coalesce workers (see VDI._coalesceVHDInThread)
+        return 1
+
+    @override
+    def scan(self, force=False, incremental=False) -> None:
+        # the VHD info is fetched from the LINSTOR volumes in one go, there is
+        # no cheap signature to tell which ones changed: always do a full scan
         all_vdi_info = self._scan(force)
         for uuid, vdiInfo in all_vdi_info.items():
             # When vdiInfo is None, the VDI is RAW.
@@ -3472,6 +4138,16 @@ class LinstorSR(SR):
 
         all_volume_info = self._linstor.get_volumes_with_info()
         volumes_metadata = self._linstor.get_volumes_with_metadata()
+
+        # Read the VHD headers in bulk, the volumes that can't be read this
+        # way are read one by one below.
+        all_vhd_info = self._vhdutil.get_vhd_info_many([
+            vdi_uuid for vdi_uuid in all_volume_info
+            if not vdi_uuid.startswith('DELETED_') and
+            volumes_metadata.get(vdi_uuid, {}).get(VDI_TYPE_TAG) ==
+            vhdutil.VDI_TYPE_VHD
+        ])
+
         for vdi_uuid, volume_info in all_volume_info.items():
             try:
                 volume_metadata = volumes_metadata[vdi_uuid]
@@ -3504,7 +4180,9 @@ class LinstorSR(SR):
                     # Always RAW!
                     info = None
                 elif vdi_type == vhdutil.VDI_TYPE_VHD:
-                    info = self._vhdutil.get_vhd_info(vdi_uuid)
+                    info = all_vhd_info.get(vdi_uuid)
+                    if not info:
+                        info = self._vhdutil.get_vhd_info(vdi_uuid)
                 else:
                     # Ensure it's not a VHD...
                     try:
@@ -3768,7 +4446,10 @@ def _gcLoop(sr, dryRun=False, immediate=False):
             if not sr.xapi.isPluggedHere():
                 Util.log("SR no longer attached, exiting")
                 break
-            sr.scanLocked()
+            # The loop scans only look for work to do and can reuse the VHD
+            # info of the VDIs that did not change. Everything that deletes or
+            # relinks VHDs rescans the SR fully under the SR lock first
+            sr.scanLocked(incremental=True)
             if not sr.hasWork():
                 Util.log("No work, exiting")
                 break
@@ -3785,7 +4466,7 @@ def _gcLoop(sr, dryRun=False, immediate=False):
                 sr.cleanupCoalesceJournals()
                 # Create the init file here in case startup is waiting on it
                 _create_init_file(sr.uuid)
-                sr.scanLocked()
+                sr.scanLocked(incremental=True)
                 sr.updateBlockInfo()
 
                 howmany = len(sr.findGarbage())
@@ -3793,18 +4474,23 @@ def _gcLoop(sr, dryRun=False, immediate=False):
                     Util.log("Found %d orphaned vdis" % howmany)
                     sr.lock()
                     try:
+                        sr.scan()
                         sr.garbageCollect(dryRun)
                     finally:
                         sr.unlock()
                     sr.xapi.srUpdate()
 
-                candidate = sr.findCoalesceable()
-                if candidate:
+                candidates = sr.findCoalesceables(
+                    sr.getMaxParallelCoalesce())
+                if candidates:
                     util.fistpoint.activate(
                         "LVHDRT_finding_a_suitable_pair", sr.uuid)
-                    sr.coalesce(candidate, dryRun)
+                    if len(candidates) == 1:
+                        sr.coalesce(candidates[0], dryRun)
+                    else:
+                        sr.coalesceParallel(candidates, dryRun)
                     sr.xapi.srUpdate()
-                    coalesced += 1
+                    coalesced += len(candidates)
                     continue
 
                 candidate = sr.findLeafCoalesceable()
@@ -4107,16 +4793,15 @@ def get_state(srUuid):
 
 def should_preempt(session, srUuid):
     sr = SR.getInstance(srUuid, session)
+    # there is one entry per VDI being coalesced, several ones with parallel
+    # coalesce (see SR.coalesceParallel)
     entries = sr.journaler.getAll(VDI.JRN_COALESCE)
     if len(entries) == 0:
         return False
-    elif len(entries) > 1:
-        raise util.SMException("More than one coalesce entry: " + str(entries))
     sr.scanLocked()
-    coalescedUuid = entries.popitem()[0]
     garbage = sr.findGarbage()
     for vdi in garbage:
-        if vdi.uuid == coalescedUuid:
+        if vdi.uuid in entries:
             return True
     return False
 
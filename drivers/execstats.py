@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+#
+# Copyright (C) Vates SAS
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# External command statistics: util.doexec appends the binary, duration
+# and return code of each command it runs to a shared log, and the CLI
+# gives the call count and latency percentiles of each binary:
+#
+#   sm-exec-stats enable|disable|reset|show
+#
+# Nothing is recorded unless the statistics directory exists (see enable).
+#
+
+import errno
+import os
+import sys
+
+STATS_DIR = "/var/run/sm/execstats"
+CALLS_FILE = "calls"
+# the log is rotated once, the CLI reads both files
+MAX_CALLS_SIZE = 4 * 1024 * 1024
+
+PERCENTILES = [50, 90, 99]
+
+# return code recorded for the commands killed after a timeout
+RC_TIMEOUT = -errno.ETIMEDOUT
+
+_enabled = None
+
+
+def isEnabled():
+    """The state is read once per process"""
+    global _enabled
+    if _enabled is None:
+        _enabled = os.path.isdir(STATS_DIR)
+    return _enabled
+
+
+def record(binary, duration, rc):
+    """Record a command of @binary that ran @duration seconds. Errors are
+    ignored: the statistics must never break the commands"""
+    if not isEnabled():
+        return
+    path = os.path.join(STATS_DIR, CALLS_FILE)
+    line = "%s %f %d\n" % (os.path.basename(binary), duration, rc)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode())
+            if os.fstat(fd).st_size > MAX_CALLS_SIZE:
+                os.rename(path, path + ".1")
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+#
+# Aggregation
+#
+class BinaryStats:
+    def __init__(self, binary):
+        self.binary = binary
+        self.durations = []
+        self.failures = 0
+        self.timeouts = 0
+
+    def percentile(self, p):
+        durations = sorted(self.durations)
+        return durations[min(len(durations) - 1, len(durations) * p // 100)]
+
+
+def readCalls():
+    lines = []
+    path = os.path.join(STATS_DIR, CALLS_FILE)
+    for name in (path + ".1", path):
+        try:
+            with open(name) as f:
+                lines.extend(f.readlines())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return lines
+
+
+def aggregate(lines):
+    """Return the BinaryStats of each binary found in the call @lines"""
+    stats = dict()
+    for line in lines:
+        try:
+            binary, duration, rc = line.split()
+            duration, rc = float(duration), int(rc)
+        except ValueError:
+            # truncated by a rotation
+            continue
+        binaryStats = stats.get(binary)
+        if binaryStats is None:
+            binaryStats = stats[binary] = BinaryStats(binary)
+        binaryStats.durations.append(duration)
+        if rc == RC_TIMEOUT:
+            binaryStats.timeouts += 1
+        elif rc:
+            binaryStats.failures += 1
+    return stats
+
+
+def show(out=sys.stdout):
+    stats = aggregate(readCalls())
+    # most time consuming first
+    for binaryStats in sorted(stats.values(),
+                              key=lambda s: -sum(s.durations)):
+        out.write("%s: %d calls, %d failed, %d timed out, total %.3fs\n" %
+                  (binaryStats.binary, len(binaryStats.durations),
+                   binaryStats.failures, binaryStats.timeouts,
+                   sum(binaryStats.durations)))
+        out.write("  %s, max %.3fs\n" % (", ".join(
+            "p%d %.3fs" % (p, binaryStats.percentile(p))
+            for p in PERCENTILES), max(binaryStats.durations)))
+
+
+def reset():
+    path = os.path.join(STATS_DIR, CALLS_FILE)
+    for name in (path, path + ".1"):
+        try:
+            os.unlink(name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def usage():
+    print("Usage: %s enable|disable|reset|show" % sys.argv[0])
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        usage()
+    cmd = sys.argv[1]
+    if cmd == "enable":
+        os.makedirs(STATS_DIR, exist_ok=True)
+    elif cmd == "disable":
+        if os.path.isdir(STATS_DIR):
+            reset()
+            os.rmdir(STATS_DIR)
+    elif cmd == "reset":
+        reset()
+    elif cmd == "show":
+        show()
+    else:
+        usage()
@@ -18,7 +18,6 @@ INITIATORNAME_FILE = '/etc/iscsi/initiatorname.iscsi'
 import util
 import os
 import scsiutil
-import time
 import socket
 import re
 import shutil
@@ -407,11 +406,7 @@ def restart_daemon():
 
 def wait_for_devs(targetIQN, portal):
     path = os.path.join("/dev/iscsi", targetIQN, portal)
-    for i in range(0, 15):
-        if os.path.exists(path):
-            return True
-        time.sleep(1)
-    return False
+    return util.wait_for_event(lambda: os.path.exists(path), 15)
 
 
 def refresh_luns(targetIQN, portal):
@@ -422,7 +417,9 @@ def refresh_luns(targetIQN, portal):
         f = open('/sys/class/scsi_host/host%s/scan' % id, 'w')
         f.write('- - -\n')
         f.close()
-        time.sleep(2)  # FIXME
+        # Wait for the devices of the scanned LUNs before letting udev settle
+        util.wait_for_path(os.path.join(path, "LUN*"), 2)
+        util.udev_settle(2)
     except:
         pass
 
@@ -459,10 +456,8 @@ def get_path_safe(targetIQN, portal, lun):
     """Gets the path of a specified LUN, and ensures that it exists.
     Raises an exception if it hasn't appeared after the timeout"""
     path = get_path(targetIQN, portal, lun)
-    for i in range(0, 15):
-        if os.path.exists(path):
-            return path
-        time.sleep(1)
+    if util.wait_for_event(lambda: os.path.exists(path), 15):
+        return path
     raise xs_errors.XenError('ISCSIDevice', \
                        opterr='LUN failed to appear at path %s' % path)
 
@@ -22,6 +22,7 @@ import base64
 import errno
 import json
 import socket
+import threading
 import time
 import util
 import vhdutil
@@ -110,22 +111,32 @@ def linstorhostcall(local_method, remote_method):
             remote_args.update(**kwargs)
             remote_args = {str(key): str(value) for key, value in remote_args.items()}
 
+            def call(target_host, host_ref):
+                response = call_remote_method(
+                    self._session, host_ref, remote_method, device_path, remote_args
+                )
+                log_successful_call(target_host, device_path, vdi_uuid, remote_method, response)
+                ret = response_parser(self, vdi_uuid, response)
+                self._set_route(vdi_uuid, device_path, host_ref)
+                return ret
+
+            host_ref_routed = self._volume_cache.get(('route', vdi_uuid))
+            if host_ref_routed:
+                try:
+                    return call('last used host', host_ref_routed)
+                except Exception as e:
+                    self._invalidate_volume_routes(vdi_uuid)
+                    log_failed_call('last used host', 'attached node', device_path, vdi_uuid, remote_method, e)
+
             try:
-                host_ref_attached = next(iter(util.get_hosts_attached_on(self._session, [vdi_uuid])))
+                host_ref_attached = next(iter(self._get_hosts_attached_on(vdi_uuid)))
                 if host_ref_attached:
-                    response = call_remote_method(
-                        self._session, host_ref_attached, remote_method, device_path, remote_args
-                    )
-                    log_successful_call('attached node', device_path, vdi_uuid, remote_method, response)
-                    return response_parser(self, vdi_uuid, response)
+                    return call('attached node', host_ref_attached)
             except Exception as e:
                 log_failed_call('attached node', 'master', device_path, vdi_uuid, remote_method, e)
 
             try:
-                master_ref = util.get_master_ref(self._session)
-                response = call_remote_method(self._session, master_ref, remote_method, device_path, remote_args)
-                log_successful_call('master', device_path, vdi_uuid, remote_method, response)
-                return response_parser(self, vdi_uuid, response)
+                return call('master', self._get_master_ref())
             except Exception as e:
                 log_failed_call('master', 'primary', device_path, vdi_uuid, remote_method, e)
 
@@ -134,9 +145,7 @@ def linstorhostcall(local_method, remote_method):
             if primary_hostname:
                 try:
                     host_ref = self._get_readonly_host(vdi_uuid, device_path, {primary_hostname})
-                    response = call_remote_method(self._session, host_ref, remote_method, device_path, remote_args)
-                    log_successful_call('primary', device_path, vdi_uuid, remote_method, response)
-                    return response_parser(self, vdi_uuid, response)
+                    return call('primary', host_ref)
                 except Exception as remote_e:
                     self._raise_openers_exception(device_path, remote_e)
             else:
@@ -151,9 +160,7 @@ def linstorhostcall(local_method, remote_method):
 
                 try:
                     host = self._get_readonly_host(vdi_uuid, device_path, nodes)
-                    response = call_remote_method(self._session, host, remote_method, device_path, remote_args)
-                    log_successful_call('another node', device_path, vdi_uuid, remote_method, response)
-                    return response_parser(self, vdi_uuid, response)
+                    return call('another node', host)
                 except Exception as remote_e:
                     self._raise_openers_exception(device_path, remote_e)
 
@@ -168,17 +175,61 @@ def linstormodifier():
 
             ret = func(*args, **kwargs)
             self._linstor.invalidate_resource_cache()
+            volume_uuid = self._volume_uuids_by_path.get(args[1])
+            if volume_uuid:
+                self._invalidate_volume_routes(volume_uuid)
             return ret
         return wrapper
     return decorated
 
 
+class RoutingCache:
+    """
+    Cache of values that are expensive to get (XAPI and DRBD openers queries)
+    and that rarely change, each value being kept `ttl` seconds.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}
+
+    def get(self, key, load=None):
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self._ttl:
+            return entry[1]
+        if load is None:
+            return None
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries = {}
+
+
 class LinstorVhdUtil:
     MAX_SIZE = 2 * 1024 * 1024 * 1024 * 1024  # Max VHD size.
 
+    # Pool hosts and master.
+    POOL_CACHE_TTL = 60
+
+    # Host where each volume was last read, hosts where it is attached and
+    # DRBD openers. Invalidated when the volume is modified using this object
+    # and when a call to the cached host fails.
+    VOLUME_CACHE_TTL = 30
+
     def __init__(self, session, linstor):
         self._session = session
         self._linstor = linstor
+        self._pool_cache = RoutingCache(self.POOL_CACHE_TTL)
+        self._volume_cache = RoutingCache(self.VOLUME_CACHE_TTL)
+        self._volume_uuids_by_path = {}
 
     def create_chain_paths(self, vdi_uuid, readonly=False):
         # OPTIMIZE: Add a limit_to_first_allocated_block param to limit vhdutil calls.
@@ -249,18 +300,100 @@ class LinstorVhdUtil:
 
     @linstorhostcall(vhdutil.getVHDInfo, 'getVHDInfo')
     def _get_vhd_info(self, vdi_uuid, response):
-        obj = json.loads(response)
+        return self._parse_vhd_info(vdi_uuid, json.loads(response))
 
-        vhd_info = vhdutil.VHDInfo(vdi_uuid)
-        vhd_info.sizeVirt = obj['sizeVirt']
-        vhd_info.sizePhys = obj['sizePhys']
-        if 'parentPath' in obj:
-            vhd_info.parentPath = obj['parentPath']
-            vhd_info.parentUuid = obj['parentUuid']
-        vhd_info.hidden = obj['hidden']
-        vhd_info.path = obj['path']
+    def get_vhd_info_many(self, vdi_uuids, include_parent=True):
+        """
+        Get the VHD info of many volumes using one plugin call per host
+        instead of one per volume: the volumes are grouped by a host that can
+        read them and the hosts are called concurrently.
+        The volumes that can't be read this way are not in the result, the
+        caller can retry them one by one using `get_vhd_info`.
+        :param list(str) vdi_uuids: The volumes to read.
+        :return: The VHD info by volume UUID.
+        :rtype: dict(str, VHDInfo)
+        """
 
-        return vhd_info
+        try:
+            volumes_by_host = self._group_volumes_by_host(vdi_uuids)
+        except Exception as e:
+            util.SMlog('Unable to group volumes by host: {}'.format(e))
+            return {}
+
+        remote_args = {
+            'groupName': self._linstor.group_name,
+            'includeParent': str(include_parent)
+        }
+
+        # The volume names are resolved here: the threads only get plain
+        # data, the KV store of the LINSTOR volume manager is not shared.
+        requests = []
+        for host_ref, host_vdi_uuids in volumes_by_host.items():
+            try:
+                paths = dict(
+                    (
+                        self._linstor.build_device_path(
+                            self._linstor.get_volume_name(vdi_uuid)
+                        ),
+                        vdi_uuid
+                    ) for vdi_uuid in host_vdi_uuids
+                )
+            except Exception as e:
+                util.SMlog('Failed to get device paths of {} volumes: {}'.format(
+                    len(host_vdi_uuids), e
+                ))
+                continue
+            requests.append((host_ref, paths))
+        responses = [None] * len(requests)
+
+        def read_on_host(index, session):
+            host_ref, paths = requests[index]
+            try:
+                responses[index] = json.loads(call_remote_method(
+                    session, host_ref, 'getVHDInfoMany', None,
+                    dict(remote_args, devicePaths=json.dumps(list(paths)))
+                ))
+            except Exception as e:
+                util.SMlog('Failed to get VHD info of {} volumes on {}: {}'.format(
+                    len(paths), host_ref, e
+                ))
+
+        def read_on_host_in_thread(index):
+            # A XAPI session can't be shared between threads.
+            try:
+                session = util.get_localAPI_session()
+            except Exception as e:
+                util.SMlog('Failed to get VHD info on {}: {}'.format(
+                    requests[index][0], e
+                ))
+                return
+            try:
+                read_on_host(index, session)
+            finally:
+                session.xenapi.session.logout()
+
+        threads = []
+        for index in range(1, len(requests)):
+            thread = threading.Thread(
+                target=read_on_host_in_thread, args=(index,)
+            )
+            thread.start()
+            threads.append(thread)
+        if requests:
+            read_on_host(0, self._session)
+        for thread in threads:
+            thread.join()
+
+        all_vhd_info = {}
+        for (host_ref, paths), response in zip(requests, responses):
+            if response is None:
+                continue
+            for path, obj in response.items():
+                vdi_uuid = paths[path]
+                all_vhd_info[vdi_uuid] = self._parse_vhd_info(vdi_uuid, obj)
+                self._set_route(vdi_uuid, path, host_ref)
+
+        return all_vhd_info
 
     @linstorhostcall(vhdutil.hasParent, 'hasParent')
     def has_parent(self, vdi_uuid, response):
@@ -457,12 +590,97 @@ class LinstorVhdUtil:
     # Helpers.
     # --------------------------------------------------------------------------
 
+    def _parse_vhd_info(self, vdi_uuid, obj):
+        vhd_info = vhdutil.VHDInfo(vdi_uuid)
+        vhd_info.sizeVirt = obj['sizeVirt']
+        vhd_info.sizePhys = obj['sizePhys']
+        if 'parentPath' in obj:
+            vhd_info.parentPath = obj['parentPath']
+            vhd_info.parentUuid = obj['parentUuid']
+        vhd_info.hidden = obj['hidden']
+        vhd_info.path = obj['path']
+
+        return vhd_info
+
+    def _group_volumes_by_host(self, vdi_uuids):
+        """
+        Find a host that can read each volume, in the same order of preference
+        as `linstorhostcall`: the host where the volume is in use, the master
+        if it has an up to date diskful copy, or another host having one.
+        Volumes without any of these are left out.
+        :return: The volume UUIDs by host ref.
+        :rtype: dict(str, list(str))
+        """
+
+        master_ref = self._get_master_ref()
+        host_refs = self._get_host_refs()
+
+        volumes_by_host = {}
+        for vdi_uuid in vdi_uuids:
+            nodes, in_use_by = \
+                self._linstor.find_up_to_date_diskful_nodes(vdi_uuid)
+            if in_use_by in host_refs:
+                host_ref = host_refs[in_use_by]
+            else:
+                candidates = [
+                    host_refs[node] for node in sorted(nodes)
+                    if node in host_refs
+                ]
+                if not candidates:
+                    util.SMlog('No host found to read {}'.format(vdi_uuid))
+                    continue
+                if master_ref in candidates:
+                    host_ref = master_ref
+                else:
+                    host_ref = candidates[0]
+            volumes_by_host.setdefault(host_ref, []).append(vdi_uuid)
+
+        # The master first: it is called using the current session.
+        return dict(sorted(
+            volumes_by_host.items(), key=lambda item: item[0] != master_ref
+        ))
+
     def _extract_uuid(self, device_path):
         # TODO: Remove new line in the vhdutil module. Not here.
         return self._linstor.get_volume_uuid_from_device_path(
             device_path.rstrip('\n')
         )
 
+    def _get_host_refs(self):
+        """
+        :return: The host refs by hostname.
+        :rtype: dict(str, str)
+        """
+        return self._pool_cache.get('hosts', lambda: dict(
+            (host_record['hostname'], host_ref) for host_ref, host_record
+            in self._session.xenapi.host.get_all_records().items()
+        ))
+
+    def _get_master_ref(self):
+        return self._pool_cache.get(
+            'master', lambda: util.get_master_ref(self._session)
+        )
+
+    def _get_hosts_attached_on(self, vdi_uuid):
+        return self._volume_cache.get(
+            ('attached', vdi_uuid),
+            lambda: list(util.get_hosts_attached_on(self._session, [vdi_uuid]))
+        )
+
+    def _get_volume_openers(self, volume_uuid):
+        return self._volume_cache.get(
+            ('openers', volume_uuid),
+            lambda: self._linstor.get_volume_openers(volume_uuid)
+        )
+
+    def _set_route(self, volume_uuid, device_path, host_ref):
+        self._volume_uuids_by_path[device_path] = volume_uuid
+        self._volume_cache.put(('route', volume_uuid), host_ref)
+
+    def _invalidate_volume_routes(self, volume_uuid):
+        for key in ('route', 'attached', 'openers'):
+            self._volume_cache.invalidate((key, volume_uuid))
+
     def _get_readonly_host(self, vdi_uuid, device_path, node_names):
         """
         When vhd-util is called to fetch VDI info we must find a
@@ -479,9 +697,8 @@ class LinstorVhdUtil:
                 .format(vdi_uuid, device_path)
             )
 
-        hosts = self._session.xenapi.host.get_all_records()
-        for host_ref, host_record in hosts.items():
-            if host_record['hostname'] in node_names:
+        for hostname, host_ref in self._get_host_refs().items():
+            if hostname in node_names:
                 return host_ref
 
         raise xs_errors.XenError(
@@ -561,7 +778,7 @@ class LinstorVhdUtil:
         # B. Execute the command on another host.
         # B.1. Get host list.
         try:
-            hosts = self._session.xenapi.host.get_all_records()
+            host_refs = self._get_host_refs()
         except Exception as e:
             raise xs_errors.XenError(
                 'VDIUnavailable',
@@ -580,6 +797,7 @@ class LinstorVhdUtil:
         volume_uuid = self._linstor.get_volume_uuid_from_device_path(
             device_path
         )
+        self._volume_uuids_by_path[device_path] = volume_uuid
         parent_volume_uuid = None
         if use_parent:
             parent_volume_uuid = self.get_parent(volume_uuid)
@@ -589,7 +807,7 @@ class LinstorVhdUtil:
         # B.3. Call!
         def remote_call():
             try:
-                all_openers = self._linstor.get_volume_openers(openers_uuid)
+                all_openers = self._get_volume_openers(openers_uuid)
             except Exception as e:
                 raise xs_errors.XenError(
                     'VDIUnavailable',
@@ -602,21 +820,23 @@ class LinstorVhdUtil:
                 if not openers:
                     continue
 
-                try:
-                    host_ref = next(ref for ref, rec in hosts.items() if rec['hostname'] == hostname)
-                except StopIteration:
+                host_ref = host_refs.get(hostname)
+                if not host_ref:
                     continue
 
                 no_host_found = False
                 try:
                     return call_remote_method(self._session, host_ref, remote_method, device_path, remote_args)
                 except Exception:
-                    pass
+                    # The openers may have changed since they were cached.
+                    self._invalidate_volume_routes(openers_uuid)
 
             if no_host_found:
                 try:
                     return local_method(device_path, *args, **kwargs)
                 except Exception as e:
+                    # Maybe the volume was opened since the openers were cached.
+                    self._invalidate_volume_routes(openers_uuid)
                     self._raise_openers_exception(device_path, e)
 
             raise xs_errors.XenError(
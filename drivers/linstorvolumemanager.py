@@ -301,8 +301,8 @@ class LinstorVolumeManager(object):
         '_linstor', '_logger', '_redundancy',
         '_base_group_name', '_group_name', '_ha_group_name',
         '_volumes', '_storage_pools', '_storage_pools_time',
-        '_kv_cache', '_resource_cache', '_volume_info_cache',
-        '_kv_cache_dirty', '_resource_cache_dirty', '_volume_info_cache_dirty'
+        '_kv_cache', '_kv_cache_dirty',
+        '_resource_snapshot', '_resource_generation'
     )
 
     DEV_ROOT_PATH = DRBD_BY_RES_PATH
@@ -383,6 +383,53 @@ class LinstorVolumeManager(object):
                 self.diskful
             )
 
+    class ResourceSnapshot(object):
+        """
+        Resources and resource states of the SR read using a single
+        `resource_list` request, and the data computed from them.
+        A snapshot is never modified, a new one is built when the resources
+        change (see `generation`).
+        """
+
+        __slots__ = (
+            'generation',      # Value of the resource generation counter
+                               # of the manager at creation.
+            'resources',
+            'resource_states',
+            'volumes_info',    # Lazily built by `_get_volumes_info`.
+            '_states_by_name'
+        )
+
+        def __init__(self, generation, resource_list):
+            self.generation = generation
+            self.resources = resource_list.resources
+            self.resource_states = resource_list.resource_states
+            self.volumes_info = None
+            self._states_by_name = None
+
+        def get_resource_states(self, resource_name):
+            """
+            Give the states of a resource on each node.
+            :param str resource_name: The resource to use.
+            :return: The resource states.
+            :rtype: list
+            """
+
+            if self._states_by_name is None:
+                states_by_name = {}
+                for resource_state in self.resource_states:
+                    states_by_name.setdefault(
+                        resource_state.name, []
+                    ).append(resource_state)
+                self._states_by_name = states_by_name
+            return self._states_by_name.get(resource_name, [])
+
+        @override
+        def __repr__(self) -> str:
+            return 'ResourceSnapshot({}, {} resources)'.format(
+                self.generation, len(self.resources)
+            )
+
     # --------------------------------------------------------------------------
 
     def __init__(
@@ -423,10 +470,8 @@ class LinstorVolumeManager(object):
         # To increate performance and limit request count to LINSTOR services,
         # we use caches.
         self._kv_cache = self._create_kv_cache()
-        self._resource_cache = None
-        self._resource_cache_dirty = True
-        self._volume_info_cache = None
-        self._volume_info_cache_dirty = True
+        self._resource_snapshot = None
+        self._resource_generation = 0
         self._build_volumes(repair=repair)
 
     @property
@@ -509,7 +554,7 @@ class LinstorVolumeManager(object):
         # Paths: /res_name/vol_number/size
         sizes = {}
 
-        for resource in self._get_resource_cache().resources:
+        for resource in self.get_resource_snapshot().resources:
             if resource.name not in sizes:
                 current = sizes[resource.name] = {}
             else:
@@ -814,7 +859,7 @@ class LinstorVolumeManager(object):
 
         node_name = socket.gethostname()
 
-        for resource in self._get_resource_cache().resources:
+        for resource in self.get_resource_snapshot().resources:
             if resource.name == volume_name and resource.node_name == node_name:
                 if linstor.consts.FLAG_TIE_BREAKER in resource.flags:
                     return
@@ -1425,12 +1470,8 @@ class LinstorVolumeManager(object):
         in_use_by = None
         node_names = set()
 
-        resource_states = filter(
-            lambda resource_state: resource_state.name == volume_name,
-            self._get_resource_cache().resource_states
-        )
-
-        for resource_state in resource_states:
+        for resource_state in \
+                self.get_resource_snapshot().get_resource_states(volume_name):
             volume_state = resource_state.volume_states[0]
             if volume_state.disk_state == 'UpToDate':
                 node_names.add(resource_state.node_name)
@@ -1439,6 +1480,24 @@ class LinstorVolumeManager(object):
 
         return (node_names, in_use_by)
 
+    def get_resource_snapshot(self):
+        """
+        Give a consistent view of the resources of the SR. The same object
+        is returned until the resources are modified using this manager or
+        until `invalidate_resource_cache` is called.
+        :return: The current snapshot.
+        :rtype: ResourceSnapshot
+        """
+
+        snapshot = self._resource_snapshot
+        if snapshot is None or \
+                snapshot.generation != self._resource_generation:
+            snapshot = self._resource_snapshot = self.ResourceSnapshot(
+                self._resource_generation,
+                self._linstor.resource_list_raise()
+            )
+        return snapshot
+
     def invalidate_resource_cache(self):
         """
         If resources are impacted by external commands like vhdutil,
@@ -1659,7 +1718,7 @@ class LinstorVolumeManager(object):
         :rtype: dict(str, list)
         """
         resources = {}
-        resource_list = self._get_resource_cache()
+        resource_list = self.get_resource_snapshot()
         volume_names = self.get_volumes_with_name()
         for resource in resource_list.resources:
             if resource.name not in resources:
@@ -1986,10 +2045,8 @@ class LinstorVolumeManager(object):
         instance._volumes = set()
         instance._storage_pools_time = 0
         instance._kv_cache = instance._create_kv_cache()
-        instance._resource_cache = None
-        instance._resource_cache_dirty = True
-        instance._volume_info_cache = None
-        instance._volume_info_cache_dirty = True
+        instance._resource_snapshot = None
+        instance._resource_generation = 0
         return instance
 
     @classmethod
@@ -2047,19 +2104,8 @@ class LinstorVolumeManager(object):
             self._kv_cache = self._create_kv_cache()
         return self._kv_cache
 
-    def _create_resource_cache(self):
-        self._resource_cache = self._linstor.resource_list_raise()
-        self._resource_cache_dirty = False
-        return self._resource_cache
-
-    def _get_resource_cache(self):
-        if self._resource_cache_dirty:
-            self._resource_cache = self._create_resource_cache()
-        return self._resource_cache
-
     def _mark_resource_cache_as_dirty(self):
-        self._resource_cache_dirty = True
-        self._volume_info_cache_dirty = True
+        self._resource_generation += 1
 
     # --------------------------------------------------------------------------
 
@@ -2093,13 +2139,13 @@ class LinstorVolumeManager(object):
                 resource_names.add(dfn.name)
         return resource_names
 
-    def _get_volumes_info(self, volume_name=None):
-        all_volume_info = {}
-
-        if not self._volume_info_cache_dirty:
-            return self._volume_info_cache
+    def _get_volumes_info(self):
+        snapshot = self.get_resource_snapshot()
+        if snapshot.volumes_info is not None:
+            return snapshot.volumes_info
 
-        for resource in self._get_resource_cache().resources:
+        all_volume_info = {}
+        for resource in snapshot.resources:
             if resource.name not in all_volume_info:
                 current = all_volume_info[resource.name] = self.VolumeInfo(
                     resource.name
@@ -2141,9 +2187,7 @@ class LinstorVolumeManager(object):
             current.allocated_size *= 1024
             current.virtual_size *= 1024
 
-        self._volume_info_cache_dirty = False
-        self._volume_info_cache = all_volume_info
-
+        snapshot.volumes_info = all_volume_info
         return all_volume_info
 
     def _get_volume_node_names_and_size(self, volume_name):
@@ -2365,7 +2409,7 @@ class LinstorVolumeManager(object):
         resource = next(filter(
             lambda resource: resource.node_name == node_name and
             resource.name == volume_name,
-            self._get_resource_cache().resources
+            self.get_resource_snapshot().resources
         ), None)
 
         if not resource:
@@ -2407,10 +2451,8 @@ class LinstorVolumeManager(object):
                 )
 
         # Maybe the resource is blocked in primary mode. DRBD/LINSTOR issue?
-        resource_states = filter(
-            lambda resource_state: resource_state.name == resource_name,
-            self._get_resource_cache().resource_states
-        )
+        resource_states = \
+            self.get_resource_snapshot().get_resource_states(resource_name)
 
         # Mark only after computation of states.
         self._mark_resource_cache_as_dirty()
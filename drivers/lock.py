@@ -18,12 +18,17 @@
 
 from sm_typing import Dict
 
+from collections import OrderedDict
 import os
 import errno
+import time
 import flock
+import lockstats
 import util
 
 VERBOSE = True
+# Log each opening and closing of a lock file
+VERBOSE_OPEN = False
 
 # Still just called "running" for backwards compatibility
 LOCK_TYPE_GC_RUNNING = "running"
@@ -39,8 +44,15 @@ class Lock(object):
 
     BASE_DIR = "/var/lock/sm"
 
+    # Lock files kept open by this process. The least recently used ones
+    # are closed when there are more, if they are not held: they are
+    # reopened by their next acquisition.
+    MAX_OPEN_LOCKS = 256
+
     INSTANCES: Dict[str, 'LockImplementation'] = {}
     BASE_INSTANCES: Dict[str, 'LockImplementation'] = {}
+    # lock path -> open instance, least recently used first
+    OPEN_INSTANCES: 'OrderedDict[str, LockImplementation]' = OrderedDict()
 
     def __new__(cls, name, ns=None, *args, **kwargs):
         if ns:
@@ -54,6 +66,22 @@ class Lock(object):
             instances[name] = LockImplementation(name, ns)
         return instances[name]
 
+    @staticmethod
+    def _registerOpen(instance):
+        """Mark @instance as the most recently used open lock and close the
+        least recently used ones if there are too many"""
+        Lock.OPEN_INSTANCES[instance.lockpath] = instance
+        Lock.OPEN_INSTANCES.move_to_end(instance.lockpath)
+        excess = len(Lock.OPEN_INSTANCES) - Lock.MAX_OPEN_LOCKS
+        if excess <= 0:
+            return
+        for lock in list(Lock.OPEN_INSTANCES.values()):
+            if lock is not instance and not lock.held():
+                lock._close()
+                excess -= 1
+                if excess <= 0:
+                    break
+
     def acquire(self):
         raise NotImplementedError("Lock methods implemented in LockImplementation")
 
@@ -83,6 +111,7 @@ class Lock(object):
         """
         Lock.INSTANCES = {}
         Lock.BASE_INSTANCES = {}
+        Lock.OPEN_INSTANCES = OrderedDict()
 
     @staticmethod
     def cleanup(name, ns=None):
@@ -97,6 +126,7 @@ class Lock(object):
 
         ns = Lock._mknamespace(ns)
         path = os.path.join(Lock.BASE_DIR, ns, name)
+        Lock.OPEN_INSTANCES.pop(path, None)
         if os.path.exists(path):
             Lock._unlink(path)
 
@@ -152,6 +182,7 @@ class LockImplementation(object):
 
     def __init__(self, name, ns=None):
         self.lockfile = None
+        self.lock = None
 
         self.ns = Lock._mknamespace(ns)
 
@@ -192,13 +223,25 @@ class LockImplementation(object):
             break
 
         fd = self.lockfile.fileno()
-        self.lock = flock.WriteLock(fd)
+        if self.lock is None:
+            self.lock = flock.WriteLock(fd)
+        else:
+            # reopened after being closed while not held
+            self.lock.fd = fd
+        Lock._registerOpen(self)
 
     def _open_lockfile(self) -> None:
         """Provide a seam, so extreme situations could be tested"""
-        util.SMlog("lock: opening lock file %s" % self.lockpath)
+        if VERBOSE_OPEN:
+            util.SMlog("lock: opening lock file %s" % self.lockpath)
         self.lockfile = open(self.lockpath, "w+")
 
+    def _ensureOpen(self):
+        if self.lockfile is None:
+            self._open()
+        elif Lock.OPEN_INSTANCES.get(self.lockpath) is self:
+            Lock.OPEN_INSTANCES.move_to_end(self.lockpath)
+
     def _close(self):
         """Close the lock, which implies releasing the lock."""
         if self.lockfile is not None:
@@ -207,8 +250,11 @@ class LockImplementation(object):
                 self.count = 0
                 self.release()
             self.lockfile.close()
-            util.SMlog("lock: closed %s" % self.lockpath)
+            if VERBOSE_OPEN:
+                util.SMlog("lock: closed %s" % self.lockpath)
             self.lockfile = None
+            if Lock.OPEN_INSTANCES.get(self.lockpath) is self:
+                del Lock.OPEN_INSTANCES[self.lockpath]
 
     __del__ = _close
 
@@ -226,10 +272,13 @@ class LockImplementation(object):
         lot. If so, not to collide. Coarse log statements should be ok
         and aid debugging."""
         if not self.held():
+            self._ensureOpen()
+            start = time.monotonic()
             if not self.lock.trylock():
                 util.SMlog("Failed to lock %s on first attempt, " % self.lockpath
                        + "blocked by PID %d" % self.lock.test())
                 self.lock.lock()
+            lockstats.recordAcquired(self.lockpath, time.monotonic() - start)
             if VERBOSE:
                 util.SMlog("lock: acquired %s" % self.lockpath)
         self.count += 1
@@ -237,8 +286,11 @@ class LockImplementation(object):
     def acquireNoblock(self):
         """Acquire lock if possible, or return false if lock already held"""
         if not self.held():
+            self._ensureOpen()
             exists = os.path.exists(self.lockpath)
             ret = self.lock.trylock()
+            if ret:
+                lockstats.recordAcquired(self.lockpath, 0)
             if VERBOSE:
                 util.SMlog("lock: tried lock %s, acquired: %s (exists: %s)" % \
                         (self.lockpath, ret, exists))
@@ -263,5 +315,6 @@ class LockImplementation(object):
             return
 
         self.lock.unlock()
+        lockstats.recordReleased(self.lockpath)
         if VERBOSE:
             util.SMlog("lock: released %s" % self.lockpath)
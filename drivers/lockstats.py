@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+#
+# Copyright (C) Vates SAS
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Lock contention statistics: lock.Lock and Fairlock append an event to a
+# shared log each time a lock is acquired (with the time spent waiting for
+# it and the code location that asked for it) and released (with the time
+# it was held). The CLI aggregates the log of all the processes:
+#
+#   sm-lock-stats enable|disable|reset|show
+#
+# Nothing is recorded unless the statistics directory exists (see enable).
+# This module must only depend on the standard library and sm_typing: it is
+# imported by fairlock, which util indirectly imports.
+#
+
+from sm_typing import Dict, override
+
+import errno
+import os
+import sys
+import time
+
+STATS_DIR = "/var/run/sm/lockstats"
+EVENTS_FILE = "events"
+# the log is rotated once, the CLI reads both files
+MAX_EVENTS_SIZE = 4 * 1024 * 1024
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+# callers in these files are skipped to find the code location of an
+# acquisition
+SKIPPED_FILES = ("lock.py", "fairlock.py", "lockstats.py", "contextlib.py")
+
+_enabled = None
+# lock name -> monotonic time of the acquisition, for this process
+_acquired: Dict[str, float] = dict()
+
+
+def isEnabled():
+    """The state is read once per process"""
+    global _enabled
+    if _enabled is None:
+        _enabled = os.path.isdir(STATS_DIR)
+    return _enabled
+
+
+def _getTag():
+    frame = sys._getframe(1)
+    while frame and os.path.basename(frame.f_code.co_filename) in \
+            SKIPPED_FILES:
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return "%s:%s:%d" % (os.path.basename(frame.f_code.co_filename),
+                         frame.f_code.co_name, frame.f_lineno)
+
+
+def _write(line):
+    """Lines are written with a single O_APPEND write so that the events of
+    concurrent processes are never interleaved. Errors are ignored: the
+    statistics must never break the locking"""
+    path = os.path.join(STATS_DIR, EVENTS_FILE)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode())
+            st = os.fstat(fd)
+            if st.st_size > MAX_EVENTS_SIZE:
+                # Another process may have rotated the log since it was
+                # opened: only rename the path if it is still this file
+                if os.path.samestat(st, os.stat(path)):
+                    os.rename(path, path + ".1")
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def recordAcquired(name, wait):
+    """Record that the lock was acquired after waiting @wait seconds"""
+    if not isEnabled():
+        return
+    _acquired[name] = time.monotonic()
+    _write("A %f %s %d %f %s\n" % (time.time(), name, os.getpid(), wait,
+                                   _getTag()))
+
+
+def recordReleased(name):
+    if not isEnabled():
+        return
+    start = _acquired.pop(name, None)
+    if start is None:
+        return
+    _write("R %f %s %d %f\n" % (time.time(), name, os.getpid(),
+                                time.monotonic() - start))
+
+
+#
+# Aggregation
+#
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value < bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @override
+    def __str__(self) -> str:
+        buckets = []
+        for i, count in enumerate(self.counts):
+            if not count:
+                continue
+            if i < len(BUCKETS):
+                buckets.append("<%gs: %d" % (BUCKETS[i], count))
+            else:
+                buckets.append(">=%gs: %d" % (BUCKETS[-1], count))
+        return "total %.3fs, max %.3fs [%s]" % (self.total, self.max,
+                                               ", ".join(buckets))
+
+
+class LockStats:
+    def __init__(self, name):
+        self.name = name
+        self.wait = Histogram()
+        self.hold = Histogram()
+        # pid -> (code location, time of the acquisition)
+        self.holders = dict()
+
+    @property
+    def count(self):
+        return sum(self.wait.counts)
+
+
+def readEvents():
+    lines = []
+    path = os.path.join(STATS_DIR, EVENTS_FILE)
+    for name in (path + ".1", path):
+        try:
+            with open(name) as f:
+                lines.extend(f.readlines())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return lines
+
+
+def aggregate(lines):
+    """Return the LockStats of each lock found in the event @lines"""
+    stats = dict()
+    for line in lines:
+        fields = line.split()
+        try:
+            kind, timestamp, name, pid, duration = fields[:5]
+            timestamp, pid, duration = float(timestamp), int(pid), \
+                float(duration)
+        except ValueError:
+            # truncated by a rotation
+            continue
+        lockStats = stats.get(name)
+        if lockStats is None:
+            lockStats = stats[name] = LockStats(name)
+        if kind == "A":
+            lockStats.wait.add(duration)
+            tag = fields[5] if len(fields) > 5 else "?"
+            lockStats.holders[pid] = (tag, timestamp)
+        elif kind == "R":
+            lockStats.hold.add(duration)
+            lockStats.holders.pop(pid, None)
+    return stats
+
+
+def _isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def show(out=sys.stdout):
+    stats = aggregate(readEvents())
+    now = time.time()
+    # most waited for first
+    for lockStats in sorted(stats.values(), key=lambda s: -s.wait.total):
+        out.write("%s: acquired %d times\n" % (lockStats.name,
+                                              lockStats.count))
+        out.write("  wait: %s\n" % lockStats.wait)
+        out.write("  hold: %s\n" % lockStats.hold)
+        for pid, (tag, since) in sorted(lockStats.holders.items()):
+            if _isAlive(pid):
+                out.write("  held by PID %d (%s) for %.3fs\n" %
+                          (pid, tag, now - since))
+
+
+def reset():
+    path = os.path.join(STATS_DIR, EVENTS_FILE)
+    for name in (path, path + ".1"):
+        try:
+            os.unlink(name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def usage():
+    print("Usage: %s enable|disable|reset|show" % sys.argv[0])
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        usage()
+    cmd = sys.argv[1]
+    if cmd == "enable":
+        os.makedirs(STATS_DIR, exist_ok=True)
+    elif cmd == "disable":
+        if os.path.isdir(STATS_DIR):
+            reset()
+            os.rmdir(STATS_DIR)
+    elif cmd == "reset":
+        reset()
+    elif cmd == "show":
+        show()
+    else:
+        usage()
@@ -120,8 +120,11 @@ def getLVInfo(lvmCache, lvName=None):
     return lvs
 
 
-def getVDIInfo(lvmCache):
-    """Load VDI info (both LV and if the VDI is not raw, VHD info)"""
+def getVDIInfo(lvmCache, reuse=None):
+    """Load VDI info (both LV and if the VDI is not raw, VHD info). The VHD
+    info of the VDIs in 'reuse' (uuid -> VDIInfo from a previous call) is
+    taken from there instead: the headers of the other VHDs are then read one
+    by one rather than with a scan of the whole VG"""
     vdis = {}
     lvs = getLVInfo(lvmCache)
 
@@ -141,14 +144,26 @@ def getVDIInfo(lvmCache):
         vdis[uuid] = vdiInfo
 
     if haveVHDs:
-        pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
-        vhds = vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
-        uuids = vdis.keys()
+        if reuse:
+            vhds = _getChangedVHDs(lvmCache, vdis, reuse)
+        else:
+            pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
+            vhds = vhdutil.getAllVHDs(pattern, extractUuid, lvmCache.vgName)
+        uuids = list(vdis.keys())
+        refreshed = False
         for uuid in uuids:
             vdi = vdis[uuid]
             if vdi.vdiType == vhdutil.VDI_TYPE_VHD:
-                if not vhds.get(uuid):
-                    lvmCache.refresh()
+                if reuse and uuid in reuse:
+                    vdi.sizeVirt = reuse[uuid].sizeVirt
+                    vdi.parentUuid = reuse[uuid].parentUuid
+                    vdi.hidden = reuse[uuid].hidden
+                elif not vhds.get(uuid):
+                    # one refresh tells about all the LVs removed since the
+                    # LV list was read
+                    if not refreshed:
+                        lvmCache.refresh()
+                        refreshed = True
                     if lvmCache.checkLV(vdi.lvName):
                         util.SMlog("*** VHD info missing: %s" % uuid)
                         vdis[uuid].scanError = True
@@ -165,6 +180,23 @@ def getVDIInfo(lvmCache):
     return vdis
 
 
+def _getChangedVHDs(lvmCache, vdis, reuse):
+    """Read the VHD headers of the VHD VDIs that are not in 'reuse'"""
+    vhds = dict()
+    for uuid, vdi in vdis.items():
+        if vdi.vdiType != vhdutil.VDI_TYPE_VHD or uuid in reuse:
+            continue
+        try:
+            vhdInfo = vhdutil.getVHDInfoLVM(vdi.lvName, extractUuid,
+                    lvmCache.vgName)
+        except util.CommandException as e:
+            util.SMlog("WARN: vhd scan of %s failed: %s" % (vdi.lvName, e))
+            continue
+        if vhdInfo:
+            vhds[vhdInfo.uuid] = vhdInfo
+    return vhds
+
+
 def inflate(journaler, srUuid, vdiUuid, size):
     """Expand a VDI LV (and its VHD) to 'size'. If the LV is already bigger
     than that, it's a no-op. Does not change the virtual size of the VDI"""
@@ -308,9 +340,11 @@ def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
             "uuid3": vdiUuid,
             "ns3": NS_PREFIX_LVM + srUuid,
             "lvName3": lvName}
-    for slave in slaves:
-        util.SMlog("Refreshing %s on slave %s" % (lvName, slave))
-        text = session.xenapi.host.call_plugin(slave, "on-slave", "multi", args)
+    # A refresh can be repeated: a call that timed out is not a problem
+    for text in util.call_plugin_on_hosts(
+            slaves, "on-slave", "multi", args,
+            timeout=util.PLUGIN_CALL_TIMEOUT,
+            desc="Refreshing %s on slave" % lvName):
         util.SMlog("call-plugin returned: '%s'" % text)
 
 
@@ -61,6 +61,24 @@ class LVActivator:
         self.lvActivations[persistent][binary][uuid] = lvName
         self.lvmCache.activate(self.ns, uuid, lvName, binary)
 
+    def activateMany(self, lvs, persistent=False):
+        """Like activate() for each of the (uuid, lvName, binary) of 'lvs',
+        with a single LVM command. The activations are only recorded once
+        they all succeeded: LVMCache.activateMany() rolls back on failure"""
+        toActivate = []
+        for (uuid, lvName, binary) in lvs:
+            if self.lvActivations[persistent][binary].get(uuid):
+                if persistent:
+                    raise LVManagerException("Double persistent activation: "
+                                             "%s" % uuid)
+                continue
+            toActivate.append((uuid, lvName, binary))
+        if not toActivate:
+            return
+        self.lvmCache.activateMany(self.ns, toActivate)
+        for (uuid, lvName, binary) in toActivate:
+            self.lvActivations[persistent][binary][uuid] = lvName
+
     def activateEnforce(self, uuid, lvName, lvPath):
         """incrementing the refcount is not enough to keep an LV activated if
         another party is unaware of refcounting. For example, blktap does 
@@ -89,25 +107,40 @@ class LVActivator:
         # this is the cleanup step that will be performed even if the original
         # operation failed - don't throw exceptions here
         success = True
+        lvs = []
         for persistent in [self.TEMPORARY, self.PERSISTENT]:
             for binary in [self.NORMAL, self.BINARY]:
-                uuids = list(self.lvActivations[persistent][binary].keys())
-                for uuid in uuids:
-                    try:
-                        self.deactivate(uuid, binary, persistent)
-                    except:
-                        success = False
-                        util.logException("_deactivateAll")
+                for uuid, lvName in \
+                        self.lvActivations[persistent][binary].items():
+                    self._closeFile(uuid, lvName)
+                    lvs.append((uuid, lvName, binary, persistent))
+        if not lvs:
+            return success
+        try:
+            failed = self.lvmCache.deactivateMany(
+                self.ns, [(uuid, lvName, binary)
+                          for (uuid, lvName, binary, _) in lvs])
+        except:
+            util.logException("_deactivateAll")
+            return False
+        for (uuid, lvName, binary, persistent) in lvs:
+            if uuid in failed:
+                success = False
+            else:
+                del self.lvActivations[persistent][binary][uuid]
         return success
 
     def deactivate(self, uuid, binary, persistent=False):
         lvName = self.lvActivations[persistent][binary][uuid]
+        self._closeFile(uuid, lvName)
+        self.lvmCache.deactivate(self.ns, uuid, lvName, binary)
+        del self.lvActivations[persistent][binary][uuid]
+
+    def _closeFile(self, uuid, lvName):
         if self.openFiles.get(uuid):
             self.openFiles[uuid].close()
             del self.openFiles[uuid]
             self.lvmCache.changeOpen(lvName, -1)
-        self.lvmCache.deactivate(self.ns, uuid, lvName, binary)
-        del self.lvActivations[persistent][binary][uuid]
 
     def persist(self):
         """Only commit LV chain activations when all LVs have been successfully
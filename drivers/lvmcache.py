@@ -16,13 +16,26 @@
 # LVM cache (for minimizing the number of lvs commands)
 #
 
+import json
 import os
 import util
 import lvutil
 import lvhdutil
+import lvmcached
 from lock import Lock
 from refcounter import RefCounter
 
+# the only "lvs" columns that the cache needs
+LVS_FIELDS = "lv_name,lv_size,lv_attr,lv_uuid,lv_tags"
+
+
+def readLVs(vgName):
+    """Run "lvs" on the VG and return the rows of its report"""
+    cmd = [lvutil.CMD_LVS, "--reportformat", "json", "--units", "b",
+           "--nosuffix", "-o", LVS_FIELDS, "/dev/%s" % vgName]
+    text = lvutil.cmd_lvm(cmd)
+    return [lv for report in json.loads(text)["report"] for lv in report["lv"]]
+
 
 class LVInfo:
     def __init__(self, name):
@@ -31,12 +44,13 @@ class LVInfo:
         self.active = False
         self.open = 0
         self.readonly = False
+        self.lvUuid = ""
         self.tags = []
 
     def toString(self):
-        return "%s, size=%d, active=%s, open=%s, ro=%s, tags=%s" % \
+        return "%s, size=%d, active=%s, open=%s, ro=%s, uuid=%s, tags=%s" % \
                 (self.name, self.size, self.active, self.open, self.readonly, \
-                self.tags)
+                self.lvUuid, self.tags)
 
 
 def lazyInit(op):
@@ -69,37 +83,36 @@ class LVMCache:
         self.initialized = False
         util.SMlog("LVMCache created for %s" % vgName)
 
-    def refresh(self):
-        """Get the LV information for the VG using "lvs" """
+    def refresh(self, direct=False):
+        """Get the LV information for the VG from lvmcached if it is running,
+        using "lvs" otherwise (or with 'direct')"""
         util.SMlog("LVMCache: refreshing")
-        #cmd = lvutil.cmd_lvm([lvutil.CMD_LVS, "--noheadings", "--units",
-        #                    "b", "-o", "+lv_tags", self.vgPath])
-        #text = util.pread2(cmd)
-
-        cmd = [lvutil.CMD_LVS, "--noheadings", "--units",
-                               "b", "-o", "+lv_tags", self.vgPath]
-
-        text = lvutil.cmd_lvm(cmd)
+        lvs = None
+        if not direct:
+            lvs = lvmcached.getLVs(self.vgName)
+        if lvs is None:
+            lvs = readLVs(self.vgName)
         self.lvs.clear()
         self.tags.clear()
-        for line in text.split('\n'):
-            if not line:
-                continue
-            fields = line.split()
-            lvName = fields[0]
-            lvInfo = LVInfo(lvName)
-            lvInfo.size = int(fields[3].replace("B", ""))
-            lvInfo.active = (fields[2][4] == 'a')
-            if (fields[2][5] == 'o'):
-                lvInfo.open = 1
-            lvInfo.readonly = (fields[2][1] == 'r')
-            self.lvs[lvName] = lvInfo
-            if len(fields) >= 5:
-                tags = fields[4].split(',')
-                for tag in tags:
-                    self._addTag(lvName, tag)
+        for lv in lvs:
+            self._addLV(lv)
         self.initialized = True
 
+    def _addLV(self, lv):
+        lvName = lv["lv_name"]
+        attr = lv["lv_attr"]
+        lvInfo = LVInfo(lvName)
+        lvInfo.size = int(lv["lv_size"])
+        lvInfo.active = (attr[4] == 'a')
+        if attr[5] == 'o':
+            lvInfo.open = 1
+        lvInfo.readonly = (attr[1] == 'r')
+        lvInfo.lvUuid = lv["lv_uuid"]
+        self.lvs[lvName] = lvInfo
+        if lv["lv_tags"]:
+            for tag in lv["lv_tags"].split(','):
+                self._addTag(lvName, tag)
+
     #
     # lvutil functions
     #
@@ -152,6 +165,29 @@ class LVMCache:
         finally:
             lock.release()
 
+    @lazyInit
+    def activateMany(self, ns, lvs):
+        """Like activate() for each of the (ref, lvName, binary) of 'lvs', but
+        with a single LVM command for all the LVs that need to be activated"""
+        locks = self._lockAll(ns, lvs)
+        try:
+            taken = []
+            toActivate = []
+            try:
+                for (ref, lvName, binary) in lvs:
+                    count = RefCounter.get(ref, binary, ns)
+                    taken.append((ref, binary))
+                    if count == 1:
+                        toActivate.append(lvName)
+                if toActivate:
+                    self.activateNoRefcountMany(toActivate)
+            except util.CommandException:
+                for (ref, binary) in taken:
+                    RefCounter.put(ref, binary, ns)
+                raise
+        finally:
+            self._unlockAll(locks)
+
     @lazyInit
     def deactivate(self, ns, ref, lvName, binary):
         lock = Lock(ref, ns)
@@ -160,47 +196,106 @@ class LVMCache:
             count = RefCounter.put(ref, binary, ns)
             if count > 0:
                 return
-            refreshed = False
-            while True:
-                lvInfo = self.getLVInfo(lvName)
-                if len(lvInfo) != 1:
-                    raise util.SMException("LV info not found for %s" % ref)
-                info = lvInfo[lvName]
-                if info.open:
-                    if refreshed:
-                        # should never happen in normal conditions but in some
-                        # failure cases the recovery code may not be able to
-                        # determine what the correct refcount should be, so it
-                        # is not unthinkable that the value might be out of
-                        # sync
-                        util.SMlog("WARNING: deactivate: LV %s open" % lvName)
-                        return
-                    # check again in case the cached value is stale
-                    self.refresh()
-                    refreshed = True
-                else:
-                    break
-            try:
-                self.deactivateNoRefcount(lvName)
-            except util.CommandException:
-                self.refresh()
-                if self.getLVInfo(lvName):
-                    util.SMlog("LV %s could not be deactivated" % lvName)
-                    if lvInfo[lvName].active:
-                        util.SMlog("Reverting the refcount change")
-                        RefCounter.get(ref, binary, ns)
-                    raise
-                else:
-                    util.SMlog("LV %s not found" % lvName)
+            self._deactivateUnused(ns, ref, lvName, binary)
         finally:
             lock.release()
 
+    @lazyInit
+    def deactivateMany(self, ns, lvs):
+        """Like deactivate() for each of the (ref, lvName, binary) of 'lvs', but
+        with a single LVM command for all the unused LVs that are not open.
+        The LVs are handled independently: return the refs of the ones that
+        could not be deactivated (the errors are logged)"""
+        failed = []
+        locks = self._lockAll(ns, lvs)
+        try:
+            unused = []
+            for (ref, lvName, binary) in lvs:
+                try:
+                    if RefCounter.put(ref, binary, ns) == 0:
+                        unused.append((ref, lvName, binary))
+                except Exception:
+                    util.logException("LVMCache.deactivateMany")
+                    failed.append(ref)
+            if unused:
+                # like _deactivateUnused, don't trust a cached open flag
+                self.refresh(direct=True)
+            closed = [lv for lv in unused if self.lvs.get(lv[1]) and
+                      not self.lvs[lv[1]].open]
+            others = [lv for lv in unused if lv not in closed]
+            if closed:
+                try:
+                    self.deactivateNoRefcountMany([lv[1] for lv in closed])
+                except util.CommandException:
+                    util.SMlog("Deactivating %d LVs at once failed, "
+                               "retrying one by one" % len(closed))
+                    others = unused
+            for (ref, lvName, binary) in others:
+                try:
+                    self._deactivateUnused(ns, ref, lvName, binary)
+                except Exception:
+                    util.logException("LVMCache.deactivateMany")
+                    failed.append(ref)
+        finally:
+            self._unlockAll(locks)
+        return failed
+
+    def _deactivateUnused(self, ns, ref, lvName, binary):
+        """Deactivate the LV whose refcount just dropped to 0"""
+        refreshed = False
+        while True:
+            lvInfo = self.getLVInfo(lvName)
+            if len(lvInfo) != 1:
+                raise util.SMException("LV info not found for %s" % ref)
+            info = lvInfo[lvName]
+            if info.open:
+                if refreshed:
+                    # should never happen in normal conditions but in some
+                    # failure cases the recovery code may not be able to
+                    # determine what the correct refcount should be, so it
+                    # is not unthinkable that the value might be out of
+                    # sync
+                    util.SMlog("WARNING: deactivate: LV %s open" % lvName)
+                    return
+                # check again in case the cached value is stale (the
+                # open count of an LV is not tracked by lvmcached)
+                self.refresh(direct=True)
+                refreshed = True
+            else:
+                break
+        try:
+            self.deactivateNoRefcount(lvName)
+        except util.CommandException:
+            self.refresh(direct=True)
+            if self.getLVInfo(lvName):
+                util.SMlog("LV %s could not be deactivated" % lvName)
+                if lvInfo[lvName].active:
+                    util.SMlog("Reverting the refcount change")
+                    RefCounter.get(ref, binary, ns)
+                raise
+            else:
+                util.SMlog("LV %s not found" % lvName)
+
     @lazyInit
     def activateNoRefcount(self, lvName, refresh=False):
         path = self._getPath(lvName)
         lvutil.activateNoRefcount(path, refresh)
         self.lvs[lvName].active = True
 
+    @lazyInit
+    def activateNoRefcountMany(self, lvNames):
+        lvutil.activateNoRefcountMany([self._getPath(lvName)
+                                       for lvName in lvNames])
+        for lvName in lvNames:
+            self.lvs[lvName].active = True
+
+    @lazyInit
+    def deactivateNoRefcountMany(self, lvNames):
+        lvutil.deactivateNoRefcountMany([self._getPath(lvName)
+                                         for lvName in lvNames])
+        for lvName in lvNames:
+            self.lvs[lvName].active = False
+
     @lazyInit
     def deactivateNoRefcount(self, lvName):
         path = self._getPath(lvName)
@@ -286,9 +381,36 @@ class LVMCache:
     def is_active(self, lvname):
         return self.lvs[lvname].active
 
+    @lazyInit
+    def getSignature(self, lvName):
+        """Return a value that changes whenever the LV is recreated, resized
+        or retagged (but not when it is renamed or (de)activated)"""
+        lvInfo = self.lvs[lvName]
+        return (lvInfo.lvUuid, lvInfo.size, tuple(sorted(lvInfo.tags)))
+
     #
     # private
     #
+    @staticmethod
+    def _lockAll(ns, lvs):
+        """Lock the refcounts of the (ref, lvName, binary) of 'lvs', in a
+        consistent order to avoid deadlocks"""
+        locks = []
+        try:
+            for ref in sorted(set(lv[0] for lv in lvs)):
+                lock = Lock(ref, ns)
+                lock.acquire()
+                locks.append(lock)
+        except:
+            LVMCache._unlockAll(locks)
+            raise
+        return locks
+
+    @staticmethod
+    def _unlockAll(locks):
+        for lock in reversed(locks):
+            lock.release()
+
     def _getPath(self, lvName):
         return os.path.join(self.vgPath, lvName)
 
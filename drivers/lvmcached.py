@@ -0,0 +1,322 @@
+#!/usr/bin/python3
+#
+# Copyright (C) Vates SAS
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# LVM metadata cache daemon: keeps the LV list and the stats of the VGs in
+# memory and serves them over a unix socket, so that the SM processes do not
+# have to run "lvs"/"vgs" (which re-read the metadata of all the PVs) every
+# time. The daemon is optional: the client functions return None when it is
+# not running and the callers then run the LVM commands themselves.
+#
+# A cached VG is reloaded when:
+# - the location of the metadata text in the metadata area of one of its PVs
+#   changed, i.e. the VG metadata was committed (from any host),
+# - the daemon is kicked through its FIFO: after every LVM command that is not
+#   read-only (see lvutil.cmd_lvm) and on device-mapper udev events.
+#
+
+import errno
+import json
+import mmap
+import os
+import select
+import socket
+import struct
+import sys
+
+import util
+import lvutil
+import lvmcache
+
+API_SOCKET = "/var/run/lvmcached-api.sock"
+# named after the kickpipe convention (/var/run/<name>.sock)
+KICK_FIFO = "/var/run/lvmcached.sock"
+
+# the daemon may have to run LVM commands before it replies
+CLIENT_TIMEOUT = 30
+SERVER_TIMEOUT = 5
+
+VGS_FIELDS = "vg_name,vg_size,vg_free,vg_seqno,pv_name"
+
+SECTOR_SIZE = 512
+LABEL_SCAN_SECTORS = 4
+LABEL_ID = b"LABELONE"
+MDA_MAGIC = b" LVM2 x[5A%r0N*>"
+
+
+#
+# Client side
+#
+def _request(request):
+    """Send a request to the daemon and return its reply, or None if the
+    daemon is not running"""
+    if not os.path.exists(API_SOCKET):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+    try:
+        sock.connect(API_SOCKET)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        reply = _recvLine(sock)
+    except OSError as e:
+        util.SMlog("lvmcached: request %s failed: %s" % (request, e))
+        return None
+    finally:
+        sock.close()
+    if not reply:
+        return None
+    reply = json.loads(reply)
+    if "error" in reply:
+        raise util.CommandException(reply["error"], "lvmcached",
+                                    reply["reason"])
+    return reply
+
+
+def _recvLine(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def getLVs(vgName):
+    """Return the rows of the lvs report of the VG (see lvmcache.readLVs), or
+    None if the daemon is not running"""
+    reply = _request({"op": "lvs", "vg": vgName})
+    if reply is None:
+        return None
+    return reply["lvs"]
+
+
+def getVGStats(vgName):
+    """Return the (size, free space) of the VG in bytes, or None if the
+    daemon is not running"""
+    reply = _request({"op": "vgs", "vg": vgName})
+    if reply is None:
+        return None
+    return (reply["size"], reply["free"])
+
+
+def invalidate():
+    """Tell the daemon that the LVM state changed. This never blocks, and
+    the daemon handles it before any request received after it"""
+    try:
+        fd = os.open(KICK_FIFO, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        # no FIFO, or no daemon reading it
+        return
+    try:
+        os.write(fd, b"\0")
+    except OSError as e:
+        # EAGAIN: the FIFO is full of kicks not handled yet
+        if e.errno != errno.EAGAIN:
+            util.SMlog("lvmcached: kick failed: %s" % e)
+    finally:
+        os.close(fd)
+
+
+#
+# Metadata change detection
+#
+def _pread(fd, size, offset):
+    """Read through a sector-aligned buffer, as required by O_DIRECT. The fd
+    must not be shared: os.preadv needs python 3.7, so this seeks first"""
+    buf = mmap.mmap(-1, size)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        count = os.readv(fd, [buf])
+        return bytes(buf[:count])
+    finally:
+        buf.close()
+
+
+def _open(path):
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+    return os.open(path, os.O_RDONLY)
+
+
+def readMetadataLocation(pvPath):
+    """Return the location (offset, size, checksum) of the current metadata
+    text in the first metadata area of the PV, which changes whenever the VG
+    metadata is committed. None if it cannot be read"""
+    try:
+        fd = _open(pvPath)
+    except OSError:
+        return None
+    try:
+        data = _pread(fd, LABEL_SCAN_SECTORS * SECTOR_SIZE, 0)
+        for sector in range(LABEL_SCAN_SECTORS):
+            label = sector * SECTOR_SIZE
+            if data[label:label + 8] == LABEL_ID:
+                break
+        else:
+            return None
+        # pv_header: UUID (32 bytes), device size, then the lists of data
+        # areas and of metadata areas (offset, size), each terminated by a
+        # null entry
+        (pvHeader,) = struct.unpack_from("<I", data, label + 20)
+        offset = label + pvHeader + 40
+        areas = []
+        for _ in range(2):
+            areas = []
+            while True:
+                area = struct.unpack_from("<QQ", data, offset)
+                offset += 16
+                if not area[0]:
+                    break
+                areas.append(area)
+        if not areas:
+            return None
+        header = _pread(fd, SECTOR_SIZE, areas[0][0])
+        if header[4:20] != MDA_MAGIC:
+            return None
+        return list(struct.unpack_from("<QQI", header, 40))
+    except (OSError, struct.error):
+        return None
+    finally:
+        os.close(fd)
+
+
+def _getGeneration(pvs):
+    generation = []
+    for pv in pvs:
+        location = readMetadataLocation(pv)
+        if location is None:
+            return None
+        generation.append(location)
+    return generation
+
+
+#
+# Daemon side
+#
+class VGState:
+    def __init__(self, generation, size, free, pvs, lvs):
+        self.generation = generation
+        self.size = size
+        self.free = free
+        self.pvs = pvs
+        self.lvs = lvs
+
+
+class LVMCacheDaemon:
+    def __init__(self):
+        self.vgs = dict()
+        self.kickFd = -1
+
+    def invalidate(self):
+        # the PV lists are kept for the consistency check of the next loads
+        for state in self.vgs.values():
+            state.generation = None
+
+    def getVG(self, vgName):
+        state = self.vgs.get(vgName)
+        if state and state.generation is not None and \
+                _getGeneration(state.pvs) == state.generation:
+            return state
+        state = self._loadVG(vgName, state.pvs if state else None)
+        self.vgs[vgName] = state
+        return state
+
+    @staticmethod
+    def _readVGRows(vgName):
+        cmd = [lvutil.CMD_VGS, "--reportformat", "json", "--units", "b",
+               "--nosuffix", "-o", VGS_FIELDS, vgName]
+        return json.loads(lvutil.cmd_lvm(cmd))["report"][0]["vg"]
+
+    def _loadVG(self, vgName, pvs):
+        """The VG is only cached if its metadata did not change while it was
+        being read. On the first load, the PVs are listed first so that the
+        VG can be cached right away"""
+        if not pvs:
+            pvs = [row["pv_name"] for row in self._readVGRows(vgName)]
+        before = _getGeneration(pvs)
+        rows = self._readVGRows(vgName)
+        lvs = lvmcache.readLVs(vgName)
+        pvs = [row["pv_name"] for row in rows]
+        after = _getGeneration(pvs)
+        if before != after:
+            after = None
+        return VGState(after, int(rows[0]["vg_size"]), int(rows[0]["vg_free"]),
+                       pvs, lvs)
+
+    def handle(self, request):
+        op = request.get("op")
+        try:
+            if op == "lvs":
+                return {"lvs": self.getVG(request["vg"]).lvs}
+            if op == "vgs":
+                state = self.getVG(request["vg"])
+                return {"size": state.size, "free": state.free}
+        except util.CommandException as e:
+            return {"error": e.code, "reason": e.reason}
+        return {"error": errno.EINVAL, "reason": "unknown request %s" % op}
+
+    def _handleKicks(self):
+        try:
+            kicked = os.read(self.kickFd, 4096)
+        except BlockingIOError:
+            return
+        if kicked:
+            self.invalidate()
+
+    def _serveClient(self, conn):
+        conn.settimeout(SERVER_TIMEOUT)
+        try:
+            request = json.loads(_recvLine(conn))
+            # what happened before the request was sent must be visible
+            self._handleKicks()
+            conn.sendall(json.dumps(self.handle(request)).encode() + b"\n")
+        except (OSError, ValueError) as e:
+            util.SMlog("lvmcached: failed to serve a request: %s" % e)
+        finally:
+            conn.close()
+
+    def serve(self):
+        if not os.path.exists(KICK_FIFO):
+            os.mkfifo(KICK_FIFO, 0o600)
+        # opened read-write so that it never reports EOF
+        self.kickFd = os.open(KICK_FIFO, os.O_RDWR | os.O_NONBLOCK)
+        if os.path.exists(API_SOCKET):
+            os.unlink(API_SOCKET)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(API_SOCKET)
+        os.chmod(API_SOCKET, 0o600)
+        server.listen(16)
+        util.SMlog("lvmcached: serving on %s" % API_SOCKET)
+        while True:
+            readable = select.select([server, self.kickFd], [], [])[0]
+            if self.kickFd in readable:
+                self._handleKicks()
+            if server in readable:
+                conn = server.accept()[0]
+                self._serveClient(conn)
+
+
+if __name__ == "__main__":
+    util.SMlog("lvmcached: starting")
+    try:
+        LVMCacheDaemon().serve()
+    except Exception:
+        util.logException("lvmcached")
+        sys.exit(1)
@@ -29,6 +29,7 @@ import xml.dom.minidom
 from lvhdutil import VG_LOCATION, VG_PREFIX
 from constants import EXT_PREFIX
 import lvmcache
+import lvmcached
 import srmetadata
 
 MDVOLUME_NAME = 'MGT'
@@ -71,6 +72,8 @@ LV_COMMANDS = frozenset({CMD_LVS, CMD_LVDISPLAY, CMD_LVCREATE, CMD_LVREMOVE,
 DM_COMMANDS = frozenset({CMD_DMSETUP})
 
 LVM_COMMANDS = VG_COMMANDS.union(PV_COMMANDS, LV_COMMANDS, DM_COMMANDS)
+# the commands after which lvmcached does not need to reload the VGs
+LVM_READONLY_COMMANDS = frozenset({CMD_VGS, CMD_PVS, CMD_LVS, CMD_LVDISPLAY})
 
 LVM_LOCK = 'lvm'
 
@@ -183,7 +186,11 @@ def cmd_lvm(cmd, pread_func=util.pread2, *args):
 
     with Fairlock("devicemapper"):
         start_time = time.time()
-        stdout = pread_func([os.path.join(LVM_BIN, lvm_cmd)] + lvm_args, * args)
+        try:
+            stdout = pread_func([os.path.join(LVM_BIN, lvm_cmd)] + lvm_args, * args)
+        finally:
+            if lvm_cmd not in LVM_READONLY_COMMANDS:
+                lvmcached.invalidate()
         end_time = time.time()
 
     if (end_time - start_time > MAX_OPERATION_DURATION):
@@ -211,7 +218,8 @@ class LVInfo:
 
 def _checkVG(vgname):
     try:
-        cmd_lvm([CMD_VGS, "--readonly", vgname])
+        if lvmcached.getVGStats(vgname) is None:
+            cmd_lvm([CMD_VGS, "--readonly", vgname])
         return True
     except:
         return False
@@ -244,11 +252,15 @@ def _getLVsize(path):
 
 def _getVGstats(vgname):
     try:
-        text = cmd_lvm([CMD_VGS, "--noheadings", "--nosuffix",
-                        "--units", "b", vgname],
-                        pread_func=util.pread).split()
-        size = int(text[5])
-        freespace = int(text[6])
+        stats = lvmcached.getVGStats(vgname)
+        if stats:
+            (size, freespace) = stats
+        else:
+            text = cmd_lvm([CMD_VGS, "--noheadings", "--nosuffix",
+                            "--units", "b", vgname],
+                            pread_func=util.pread).split()
+            size = int(text[5])
+            freespace = int(text[6])
         utilisation = size - freespace
         stats = {}
         stats['physical_size'] = size
@@ -675,6 +687,31 @@ def activateNoRefcount(path, refresh):
         os.environ['LVM_SYSTEM_DIR'] = DEF_LVM_CONF
 
 
+@lvmretry
+def _activateMany(paths):
+    cmd = [CMD_LVCHANGE, "-ay"] + paths
+    cmd_lvm(cmd)
+    for path in paths:
+        if not _checkActive(path):
+            raise util.CommandException(-1, str(cmd),
+                                        "LV %s not activated" % path)
+
+
+def activateNoRefcountMany(paths):
+    """Activate several LVs of a VG with a single "lvchange" (i.e. reading
+    the VG metadata once)"""
+    _activateMany(paths)
+
+
+def deactivateNoRefcountMany(paths):
+    """Deactivate several LVs of a VG with a single "lvchange". Unlike
+    deactivateNoRefcount(), a failure is not retried: the caller should then
+    deactivate the LVs one by one"""
+    _deactivate(paths)
+    for path in paths:
+        _lvmBugCleanup(path)
+
+
 def deactivateNoRefcount(path):
     # LVM has a bug where if an "lvs" command happens to run at the same time
     # as "lvchange -an", it might hold the device in use and cause "lvchange
@@ -685,7 +722,7 @@ def deactivateNoRefcount(path):
     # "lvchange -an" returns success.
     for i in range(LVM_FAIL_RETRIES):
         try:
-            _deactivate(path)
+            _deactivate([path])
             break
         except util.CommandException:
             if i >= LVM_FAIL_RETRIES - 1:
@@ -695,15 +732,15 @@ def deactivateNoRefcount(path):
 
 
 @lvmretry
-def _deactivate(path):
+def _deactivate(paths):
     # Records what is using the LVM path in case there is an issue.
     # In most cases this should be nothing.
     try:
-        (rc, stdout, stderr) = util.doexec(['/usr/sbin/fuser', "-v", path])
-        util.SMlog(f"fuser {path} => {rc} / '{stdout}' / '{stderr}'")
+        (rc, stdout, stderr) = util.doexec(['/usr/sbin/fuser', "-v"] + paths)
+        util.SMlog(f"fuser {' '.join(paths)} => {rc} / '{stdout}' / '{stderr}'")
     except:
         pass
-    text = cmd_lvm([CMD_LVCHANGE, "-an", path])
+    text = cmd_lvm([CMD_LVCHANGE, "-an"] + paths)
 
 
 def _checkActive(path):
@@ -19,6 +19,10 @@ from sm_typing import override
 
 import util
 import re
+import json
+import socket
+import struct
+import threading
 import time
 from fairlock import Fairlock
 
@@ -31,15 +35,115 @@ class MPathCLIFail(Exception):
     def __str__(self) -> str:
         return "MPath CLI failed"
 
-mpathcmd = ["/usr/sbin/multipathd", "-k"]
+# abstract unix socket of the multipathd control interface (libmpathcmd)
+MPATHD_SOCKET = "\0/org/kernel/linux/storage/multipathd"
+# some commands, like show topology, walk all the maps before replying
+MPATHD_TIMEOUT = 30
+
+
+class MPathdClient:
+    """Client of the multipathd control socket. A packet is its length, as a
+    native size_t, followed by the NUL-terminated command or reply text. The
+    connection is kept open across commands, and several commands can be
+    sent before reading their replies"""
+
+    LENGTH = struct.Struct("@N")
+
+    def __init__(self, address=MPATHD_SOCKET, timeout=MPATHD_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _send(self, cmd):
+        data = cmd.encode() + b"\0"
+        self.sock.sendall(self.LENGTH.pack(len(data)) + data)
+
+    def _recvAll(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("multipathd closed the connection")
+            data += chunk
+        return data
+
+    def _recv(self):
+        (size,) = self.LENGTH.unpack(self._recvAll(self.LENGTH.size))
+        return self._recvAll(size).rstrip(b"\0").decode(errors="replace")
+
+    def _exchange(self, cmds):
+        for cmd in cmds:
+            self._send(cmd)
+        return [self._recv() for _ in cmds]
+
+    def query(self, cmds):
+        """Send the commands in one go and return their replies. A connection
+        left over from a previous command may have been closed by a restart of
+        multipathd: it is opened again once"""
+        with self.lock:
+            reused = self.sock is not None
+            try:
+                if not reused:
+                    self.connect()
+                try:
+                    return self._exchange(cmds)
+                except OSError:
+                    self.close()
+                    if not reused:
+                        raise
+                self.connect()
+                return self._exchange(cmds)
+            except OSError as e:
+                self.close()
+                util.SMlog("mpath cmd %s failed: %s" % (cmds, e))
+                raise MPathCLIFail()
+
+
+# one connection per process
+client = MPathdClient()
+
+
+def query(*cmds):
+    """Run multipathd commands and return their replies, as a list when there
+    are several commands"""
+    util.SMlog("mpath cmd: %s" % ", ".join(cmds))
+    with Fairlock("devicemapper"):
+        replies = client.query(cmds)
+    if len(cmds) == 1:
+        return replies[0]
+    return replies
+
+
+def query_json(cmd):
+    """Run a multipathd command with JSON output and return the decoded
+    reply, or None if multipathd did not reply in JSON"""
+    reply = query(cmd)
+    if not reply.lstrip().startswith("{"):
+        return None
+    try:
+        return json.loads(reply)
+    except ValueError:
+        return None
 
 
 def mpexec(cmd):
-    util.SMlog("mpath cmd: %s" % cmd)
-    with Fairlock("devicemapper"):
-        (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
-    if stdout != "multipathd> ok\nmultipathd> " \
-            and stdout != "multipathd> " + cmd + "\nok\nmultipathd> ":
+    if query(cmd).strip() != "ok":
         raise MPathCLIFail
 
 
@@ -51,6 +155,10 @@ def remove_path(path):
     mpexec("remove path %s" % path)
 
 
+def add_map(m):
+    mpexec("add map %s" % m)
+
+
 def remove_map(m):
     mpexec("remove map %s" % m)
 
@@ -63,15 +171,13 @@ def reconfigure():
     mpexec("reconfigure")
 
 regex = re.compile(r"[0-9]+:[0-9]+:[0-9]+:[0-9]+\s*([a-z]*)")
-regex2 = re.compile(r"multipathd>(\s*[^:]*:)?\s+(.*)")
 regex3 = re.compile("switchgroup")
 
 
 def is_working():
     cmd = "help"
     try:
-        (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
-        m = regex3.search(stdout)
+        m = regex3.search(query(cmd))
         if m:
             return True
         else:
@@ -80,16 +186,17 @@ def is_working():
         return False
 
 
+def _lines(reply):
+    return [line for line in reply.split('\n') if line.strip()]
+
+
 def do_get_topology(cmd):
-    util.SMlog("mpath cmd: %s" % cmd)
-    with Fairlock("devicemapper"):
-        (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
+    try:
+        stdout = query(cmd)
+    except MPathCLIFail:
+        return []
     util.SMlog("mpath output: %s" % stdout)
-    lines = stdout.split('\n')[:-1]
-    if len(lines):
-        m = regex2.search(lines[0])
-        lines[0] = str(m.group(2))
-    return lines
+    return _lines(stdout)
 
 
 def get_topology(scsi_id):
@@ -102,7 +209,30 @@ def get_all_topologies():
     return do_get_topology(cmd)
 
 
+def map_paths(m):
+    """All the paths of a map from the JSON output, across path groups"""
+    return [p for pg in m.get("path_groups", []) for p in pg.get("paths", [])]
+
+
+def get_all_maps():
+    """Get the maps with their path groups and paths from the JSON output of
+    multipathd, or None if it is not available"""
+    try:
+        reply = query_json("show maps json")
+    except MPathCLIFail:
+        return None
+    if reply is None or "maps" not in reply:
+        return None
+    return reply["maps"]
+
+
 def list_paths(scsi_id):
+    try:
+        reply = query_json("show map %s json" % scsi_id)
+    except MPathCLIFail:
+        reply = None
+    if reply is not None and "map" in reply:
+        return [p["dev"] for p in map_paths(reply["map"])]
     lines = get_topology(scsi_id)
     matches = []
     for line in lines:
@@ -114,11 +244,16 @@ def list_paths(scsi_id):
 
 def list_maps():
     cmd = "list maps"
-    util.SMlog("mpath cmd: %s" % cmd)
-    with Fairlock("devicemapper"):
-        (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
+    try:
+        stdout = query(cmd)
+    except MPathCLIFail:
+        return []
     util.SMlog("mpath output: %s" % stdout)
-    return [x.split(' ')[0] for x in stdout.split('\n')[2:-1]]
+    lines = _lines(stdout)
+    # skip the "name sysfs uuid" header
+    if lines and lines[0].split()[0] == "name":
+        lines = lines[1:]
+    return [x.split(' ')[0] for x in lines]
 
 
 def ensure_map_gone(scsi_id):
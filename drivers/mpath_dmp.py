@@ -168,10 +168,14 @@ def _refresh_DMP(sid, npaths):
     if not _is_valid_multipath_device(sid):
         return
     path = os.path.join(DEVMAPPERPATH, sid)
-    # If the mapper path doesn't exist force a reload in multipath
+    # If the mapper path doesn't exist ask multipathd to add the map, or
+    # force a reload in multipath if that fails
     if not os.path.exists(path):
-        with Fairlock("devicemapper"):
-            util.retry(lambda: util.pread2(['/usr/sbin/multipath', '-r', sid]), maxretry=3, period=4)
+        try:
+            mpath_cli.add_map(sid)
+        except mpath_cli.MPathCLIFail:
+            with Fairlock("devicemapper"):
+                util.retry(lambda: util.pread2(['/usr/sbin/multipath', '-r', sid]), maxretry=3, period=4)
         util.wait_for_path(path, 30)
     if not os.path.exists(path):
         raise xs_errors.XenError('MultipathMapperPathMissing',
@@ -41,6 +41,10 @@ SCSIid = 'NOTSUPPLIED'
 XAPI_HEALTH_CHECK = '/opt/xensource/libexec/xapi-health-check'
 
 cached_DM_maj = None
+# checker states of the paths that are not up
+PATH_DOWN = ['faulty', 'shaky', 'failed']
+# SCSIid -> (active, total) paths of all the maps, see get_all_path_counts
+path_counts = None
 
 def get_dm_major():
     global cached_DM_maj
@@ -89,7 +93,7 @@ def match_pathup(s):
     match = re.match(r'.*\d+:\d+:\d+:\d+\s+\S+\s+\S+\s+\S+\s+(\S+)', s)
     if match:
         path_status = match.group(1)
-        if path_status in ['faulty', 'shaky', 'failed']:
+        if path_status in PATH_DOWN:
             return False
     return True
 
@@ -98,7 +102,45 @@ def _tostring(l):
     return str(l)
 
 
+def match_map(s):
+    """Return the SCSIid of the map whose topology starts at line s, named
+    either after its WWID or with an alias followed by the WWID"""
+    match = re.match(r'^(\S+)\s+(?:\((\S+)\)\s+)?dm-\d+\s', s)
+    if match:
+        return match.group(2) or match.group(1)
+    return None
+
+
+def get_all_path_counts():
+    """Get the (active, total) path counts of every multipath map at once,
+    from a single 'show maps json' of multipathd, or 'show topology' when the
+    JSON output is not available"""
+    maps = mpath_cli.get_all_maps()
+    if maps is not None:
+        counts = {}
+        for m in maps:
+            paths = mpath_cli.map_paths(m)
+            active = [p for p in paths if p.get("chk_st") not in PATH_DOWN]
+            counts[m["uuid"]] = (len(active), len(paths))
+        return counts
+
+    counts = {}
+    current = None
+    for line in mpath_cli.get_all_topologies():
+        SCSIid = match_map(line)
+        if SCSIid:
+            current = SCSIid
+            counts.setdefault(current, [0, 0])
+        elif current is not None and match_dmpLUN(line):
+            counts[current][1] += 1
+            if match_pathup(line):
+                counts[current][0] += 1
+    return dict((k, (v[0], v[1])) for k, v in counts.items())
+
+
 def get_path_count(SCSIid):
+    if path_counts is not None and SCSIid in path_counts:
+        return path_counts[SCSIid]
     count = 0
     total = 0
     lines = mpath_cli.get_topology(SCSIid)
@@ -203,6 +245,38 @@ def check_devconfig(devconfig, sm_config, config, remove, add, mpath_status=None
             else:
                 update_config(key, i, config[key], remove, add, mpath_status)
 
+class ConfigUpdate(object):
+    """Collect the remove/add calls made on an other-config map and only
+    write to XAPI the keys whose value actually changes"""
+
+    def __init__(self, config):
+        self.config = config
+        self.changes = {}
+
+    def remove(self, key):
+        self.changes[key] = None
+
+    def add(self, key, val):
+        self.changes[key] = val
+
+    def commit(self, remove, add):
+        for key, val in self.changes.items():
+            current = self.config.get(key)
+            if val == current:
+                continue
+            if current is not None:
+                remove(key)
+            if val is not None:
+                add(key, val)
+        self.changes = {}
+
+
+def get_supported_SRs(session):
+    """Get the records of the SRs of the supported types in one call"""
+    where = " or ".join('field "type" = "%s"' % t for t in supported)
+    return session.xenapi.SR.get_all_records_where(where)
+
+
 def check_xapi_is_enabled():
     """Check XAPI health status"""
     def _run_command(command, timeout):
@@ -247,6 +321,12 @@ if __name__ == '__main__':
     except:
         mpath_enabled = False
 
+    # Take the path counts of all the maps in one go
+    try:
+        path_counts = get_all_path_counts()
+    except:
+        util.SMlog("MPATH: Failure getting the topology, querying maps one by one")
+
     # Check root disk if multipathed
     try:
         def _remove(key):
@@ -257,7 +337,9 @@ if __name__ == '__main__':
             session.xenapi.host.add_to_other_config(localhost, key, val)
         config = session.xenapi.host.get_other_config(localhost)
         maps = mpath_cli.list_maps()
-        check_root_disk(config, maps, _remove, _add)
+        update = ConfigUpdate(config)
+        check_root_disk(config, maps, update.remove, update.add)
+        update.commit(_remove, _add)
 
     except:
         util.SMlog("MPATH: Failure updating Host.other-config:mpath-boot db")
@@ -265,6 +347,7 @@ if __name__ == '__main__':
 
     try:
         pbds = session.xenapi.PBD.get_all_records_where("field \"host\" = \"%s\"" % localhost)
+        srs = get_supported_SRs(session)
     except:
         mpc_exit(session, -1)
 
@@ -280,11 +363,13 @@ if __name__ == '__main__':
             record = pbds[pbd]
             config = record['other_config']
             SR = record['SR']
-            srtype = session.xenapi.SR.get_type(SR)
-            if srtype in supported:
+            if SR in srs:
                 devconfig = record["device_config"]
-                sm_config = session.xenapi.SR.get_sm_config(SR)
-                check_devconfig(devconfig, sm_config, config, remove, add, mpath_status)
+                sm_config = srs[SR]['sm_config']
+                update = ConfigUpdate(config)
+                check_devconfig(devconfig, sm_config, config, update.remove,
+                                update.add, mpath_status)
+                update.commit(remove, add)
         mpath_status = mpath_status if mpath_enabled else {}
         util.atomicFileWrite(MPATH_FILE_NAME, MPATHS_DIR, json.dumps(mpath_status))
         os.chmod(MPATH_FILE_NAME, 0o0644)
@@ -430,15 +430,13 @@ def refresh_HostID(HostID, fullrescan):
                 f = open(path, 'w')
                 f.write('%s\n' % scanstring)
                 f.close()
-                if len(li):
-                    # Channels already exist, allow some time for
-                    # undiscovered LUNs/channels to appear
-                    time.sleep(2)
             except:
                 pass
         # Host Bus scan issued, now try to detect channels
         if util.wait_for_path("/sys/class/scsi_disk/%s*" % HostID, 5):
-            # At least one LUN is mapped
+            # At least one LUN is mapped, allow udev to set up the
+            # devices of the undiscovered LUNs/channels
+            util.udev_settle(2)
             LUNs = glob.glob('/sys/class/scsi_disk/%s*' % HostID)
             li = []
             for l in LUNs:
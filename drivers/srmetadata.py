@@ -16,7 +16,7 @@
 # Functions to read and write SR metadata
 #
 
-from sm_typing import ClassVar, override
+from sm_typing import Any, ClassVar, Dict, override
 
 from abc import abstractmethod
 
@@ -25,6 +25,8 @@ from io import SEEK_SET
 import util
 import metadata
 import os
+import re
+import heapq
 import xs_errors
 import lvutil
 import xml.sax.saxutils
@@ -39,6 +41,12 @@ import xml.sax.saxutils
 # case they take two sectors each. VDI information might mark the VDI as
 # having been deleted, in which case the sectors used to contain this info can
 # potentially be reused when a new VDI is subsequently added.
+#
+# In the indexed layout (minor version MD_MINOR_INDEXED), the last sector of
+# each VDI slot starts with the UUID and the deleted flag of the VDI, so that
+# the slots can be indexed by UUID without parsing their XML. Such metadata is
+# still readable with the previous layout, and metadata in the previous layout
+# is converted in place the first time a VDI is added, updated or deleted.
 
 # String data in this module takes the form of normal Python unicode `str`
 # instances, or UTF-8 encoded `bytes`, depending on circumstance. In `dict`
@@ -82,6 +90,12 @@ METADATA_UPDATE_OBJECT_TYPE_TAG = 'objtype'
 METADATA_OBJECT_TYPE_SR = 'sr'
 METADATA_OBJECT_TYPE_VDI = 'vdi'
 METADATA_BLK_SIZE = 512
+MD_MINOR_INDEXED = 3
+SLOT_KEY_RE = re.compile(rb"<uuid>([^<]*)</uuid><deleted>([01])</deleted>")
+
+# VDI slots already parsed by this process, by content
+PARSED_SLOTS_CACHE_SIZE = 4096
+_parsedSlots: Dict[bytes, Dict[str, Any]] = {}
 
 
 # ----------------- # General helper functions - begin # -----------------
@@ -244,6 +258,20 @@ def updateLengthInHeader(fd, length, major=metadata.MD_MAJOR, \
         raise
 
 
+def parseVdiSlot(slot):
+    """Return the VDI information of a VDI slot. The result is a copy that the
+    caller may modify"""
+    vdi_info_map = _parsedSlots.get(slot)
+    if vdi_info_map is None:
+        parsable_metadata = \
+            buildParsableMetadataXML(slot.replace(b'\x00', b''))
+        vdi_info_map = metadata._parseXML(parsable_metadata)[VDI_TAG]
+        if len(_parsedSlots) >= PARSED_SLOTS_CACHE_SIZE:
+            _parsedSlots.clear()
+        _parsedSlots[slot] = vdi_info_map
+    return dict(vdi_info_map)
+
+
 def getMetadataLength(fd):
     try:
         sector1 = \
@@ -257,6 +285,16 @@ def getMetadataLength(fd):
 
 
 # ----------------- # General helper functions - end # -----------------
+class VdiSlotIndex:
+    """Offsets of the VDI slots of the metadata: by VDI UUID for the slots in
+    use, and a heap of the deleted ones"""
+
+    def __init__(self, length, offsets, deleted):
+        self.length = length
+        self.offsets = offsets
+        self.deleted = deleted
+
+
 class MetadataHandler:
 
     VDI_INFO_SIZE_IN_SECTORS: ClassVar[int]
@@ -266,6 +304,7 @@ class MetadataHandler:
 
         self.fd = None
         self.path = path
+        self.index = None
         if self.path is not None:
             self.fd = open_file(self.path, write)
 
@@ -390,25 +429,64 @@ class MetadataHandler:
                 opterr='%s' % str(e))
 
     # common functions
+    def getIndex(self):
+        """Return the index of the VDI slots, converting the metadata to the
+        indexed layout first if needed"""
+        if self.index is None:
+            self.index = self.readIndex()
+            if self.index is None:
+                util.SMlog("Converting metadata %s to the indexed layout" %
+                           self.path)
+                md = self.getMetadataInternal({'includeDeletedVdis': 1})
+                self.writeMetadataInternal(md['sr_info'], md['vdi_info'])
+                self.index = self.readIndex()
+        return self.index
+
+    def readIndex(self):
+        """Index the VDI slots, or return None if the metadata is not in the
+        indexed layout"""
+        hdr = unpackHeader(file_read_wrapper(self.fd, 0, SECTOR_SIZE).strip())
+        length = int(hdr[1])
+        if (int(hdr[2]), int(hdr[3])) < (metadata.MD_MAJOR, MD_MINOR_INDEXED):
+            return None
+
+        md = file_read_wrapper(self.fd, 0, length)
+        offsets = {}
+        deleted = []
+        for offset in range(SECTOR_SIZE * SR_INFO_SIZE_IN_SECTORS, length,
+                            self.vdi_info_size):
+            # The key of the slot starts its last sector
+            match = SLOT_KEY_RE.match(
+                md, offset + self.vdi_info_size - SECTOR_SIZE)
+            if not match:
+                # Written with the previous layout
+                util.SMlog("VDI slot at offset %d is not indexed" % offset)
+                return None
+            if match.group(2) == b'1':
+                deleted.append(offset)
+            else:
+                offsets[from_utf8(match.group(1))] = offset
+        return VdiSlotIndex(length, offsets, deleted)
+
+    def updateLength(self, index, length):
+        index.length = length
+        updateLengthInHeader(self.fd, length, minor=MD_MINOR_INDEXED)
+
     def deleteVdi(self, vdi_uuid, offset=0):
         util.SMlog("Entering deleteVdi")
         try:
-            md = self.getMetadataInternal({'vdi_uuid': vdi_uuid})
-            if 'offset' not in md:
+            index = self.getIndex()
+            if vdi_uuid not in index.offsets:
                 util.SMlog("Metadata for VDI %s not present, or already removed, " \
                     "no further deletion action required." % vdi_uuid)
                 return
 
-            md['vdi_info'][md['offset']][VDI_DELETED_TAG] = '1'
-            self.updateVdi(md['vdi_info'][md['offset']])
-
-            try:
-                mdlength = getMetadataLength(self.fd)
-                if (mdlength - md['offset']) == self.vdi_info_size:
-                    updateLengthInHeader(self.fd,
-                                         mdlength - self.vdi_info_size)
-            except:
-                raise
+            self.updateVdi({UUID_TAG: vdi_uuid, VDI_DELETED_TAG: '1'})
+            offset = index.offsets.pop(vdi_uuid)
+            if (index.length - offset) == self.vdi_info_size:
+                self.updateLength(index, offset)
+            else:
+                heapq.heappush(index.deleted, offset)
         except Exception as e:
             raise Exception("VDI delete operation failed for " \
                                 "parameters: %s, %s. Error: %s" % \
@@ -444,26 +522,20 @@ class MetadataHandler:
         util.SMlog("Entering addVdiInternal")
         try:
             Dict[VDI_DELETED_TAG] = '0'
-            mdlength = getMetadataLength(self.fd)
-            md = self.getMetadataInternal({'firstDeleted': 1, 'includeDeletedVdis': 1})
-            if 'foundDeleted' not in md:
-                md['offset'] = mdlength
-                (md['lower'], md['upper']) = \
-                    getBlockAlignedRange(mdlength, self.vdi_info_size)
-            # If this has created a new VDI, update metadata length
-            if 'foundDeleted' in md:
-                value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, md['offset'])
+            index = self.getIndex()
+            # Reuse the first deleted slot if any
+            if index.deleted:
+                offset = index.deleted[0]
             else:
-                value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, mdlength)
+                offset = index.length
 
-            file_write_wrapper(self.fd, md['lower'], value)
+            file_write_wrapper(self.fd, offset, self.getVdiInfo(Dict))
 
-            if 'foundDeleted' in md:
-                updateLengthInHeader(self.fd, mdlength)
+            if index.deleted:
+                heapq.heappop(index.deleted)
             else:
-                updateLengthInHeader(self.fd, mdlength + self.vdi_info_size)
+                self.updateLength(index, offset + self.vdi_info_size)
+            index.offsets[Dict[UUID_TAG]] = offset
             return True
         except Exception as e:
             util.SMlog("Exception adding vdi with info: %s. Error: %s" % \
@@ -511,10 +583,8 @@ class MetadataHandler:
 
             # Now look at the VDI objects
             while offset < upper:
-                vdi_info = metadataxml[offset:offset + self.vdi_info_size]
-                vdi_info = vdi_info.replace(b'\x00', b'')
-                parsable_metadata = buildParsableMetadataXML(vdi_info)
-                vdi_info_map = metadata._parseXML(parsable_metadata)[VDI_TAG]
+                vdi_info_map = parseVdiSlot(
+                    metadataxml[offset:offset + self.vdi_info_size])
                 vdi_info_map[OFFSET_TAG] = offset
 
                 if 'includeDeletedVdis' not in params and \
@@ -598,11 +668,11 @@ class MetadataHandler:
     def updateVdi(self, Dict):
         util.SMlog('entering updateVdi')
         try:
-            mdlength = getMetadataLength(self.fd)
-            md = self.getMetadataInternal({'vdi_uuid': Dict[UUID_TAG]})
-            value = self.getMetadataToWrite(md['sr_info'], md['vdi_info'], \
-                        md['lower'], md['upper'], Dict, md['offset'])
-            file_write_wrapper(self.fd, md['lower'], value)
+            offset = self.getIndex().offsets[Dict[UUID_TAG]]
+            vdi_info = parseVdiSlot(
+                file_read_wrapper(self.fd, offset, self.vdi_info_size))
+            vdi_info.update(Dict)
+            file_write_wrapper(self.fd, offset, self.getVdiInfo(vdi_info))
             return True
         except Exception as e:
             util.SMlog("Exception updating vdi with info: %s. Error: %s" % \
@@ -622,7 +692,8 @@ class MetadataHandler:
 
             # Now write the metadata on disk.
             file_write_wrapper(self.fd, 0, md)
-            updateLengthInHeader(self.fd, len(md))
+            updateLengthInHeader(self.fd, len(md), minor=MD_MINOR_INDEXED)
+            self.index = None
 
         except Exception as e:
             util.SMlog("Exception writing metadata with info: %s, %s. " \
@@ -754,8 +825,12 @@ class LVMMetadataHandler(MetadataHandler):
                 if VDI_DELETED_TAG not in Dict:
                     Dict.update({VDI_DELETED_TAG: '0'})
 
+                # The key of the slot, see SLOT_KEY_RE
+                sector2 += buildXMLElement(UUID_TAG, Dict)
+                sector2 += buildXMLElement(VDI_DELETED_TAG, Dict)
                 for tag in Dict.keys():
-                    if tag == NAME_LABEL_TAG or tag == NAME_DESCRIPTION_TAG:
+                    if tag in (NAME_LABEL_TAG, NAME_DESCRIPTION_TAG, UUID_TAG,
+                               VDI_DELETED_TAG, OFFSET_TAG):
                         continue
                     sector2 += buildXMLElement(tag, Dict)
 
@@ -16,6 +16,8 @@
 # Miscellaneous utility functions
 #
 
+from sm_typing import Dict, Optional
+
 import os
 import re
 import sys
@@ -27,8 +29,10 @@ import time
 import datetime
 import errno
 import socket
+import select
 import xml.dom.minidom
 import scsiutil
+import execstats
 import stat
 import xs_errors
 import XenAPI # pylint: disable=import-error
@@ -40,10 +44,15 @@ import traceback
 import glob
 import copy
 import tempfile
+import queue
+import threading
+import atexit
 
 from functools import reduce
 
 NO_LOGGING_STAMPFILE = '/etc/xensource/no_sm_log'
+# Contains the name of the least severe priority to log ("info", ...)
+LOG_LEVEL_FILE = '/etc/xensource/sm_log_level'
 
 IORETRY_MAX = 20  # retries
 IORETRY_PERIOD = 1.0  # seconds
@@ -59,12 +68,26 @@ LOG_NOTICE = syslog.LOG_NOTICE
 LOG_INFO = syslog.LOG_INFO
 LOG_DEBUG = syslog.LOG_DEBUG
 
+
+def _readLogLevel():
+    try:
+        with open(LOG_LEVEL_FILE) as f:
+            name = f.read().strip().upper()
+    except IOError:
+        return LOG_DEBUG
+    return getattr(syslog, "LOG_" + name, LOG_DEBUG)
+
+
+LOG_LEVEL = _readLogLevel()
+
 ISCSI_REFDIR = '/var/run/sr-ref'
 
 CMD_DD = "/bin/dd"
 
 FIST_PAUSE_PERIOD = 30  # seconds
 
+PLUGIN_CALL_TIMEOUT = 180  # seconds, see call_plugin_on_hosts
+
 
 class SMException(Exception):
     """Base class for all SM exceptions for easier catching & wrapping in
@@ -135,16 +158,98 @@ def make_WWN(name):
     return name
 
 
+# (ident, facility) of the syslog connection of this process, and the lock
+# that keeps the logging thread and the callers from reopening it at once.
+# _logPid is the process they belong to.
+_syslogOpened = None
+_syslogLock = threading.Lock()
+_logPid = os.getpid()
+
+# Set when the messages are logged by a background thread.
+_logQueue = None
+_logThread = None
+_logDropped = 0
+
+
 def _logToSyslog(ident, facility, priority, message):
-    syslog.openlog(ident, 0, facility)
-    syslog.syslog(priority, "[%d] %s" % (os.getpid(), message))
-    syslog.closelog()
+    global _syslogOpened
+    with _syslogLock:
+        # The connection is kept open for the next messages.
+        if _syslogOpened != (ident, facility):
+            syslog.openlog(ident, 0, facility)
+            _syslogOpened = (ident, facility)
+        syslog.syslog(priority, "[%d] %s" % (os.getpid(), message))
+
+
+def _logLines(ident, priority, lines):
+    for message_line in lines:
+        _logToSyslog(ident, _SM_SYSLOG_FACILITY, priority, message_line)
+
+
+def _logWorker(logQueue):
+    global _logDropped
+    while True:
+        item = logQueue.get()
+        if item is None:
+            break
+        _logLines(*item)
+        if _logDropped:
+            dropped, _logDropped = _logDropped, 0
+            _logLines("SM", LOG_WARNING,
+                      ["%d log messages dropped, queue full" % dropped])
+
+
+def startAsyncLogging(maxsize=1024):
+    """Make SMlog queue the messages to a thread of this process that sends
+    them to syslog. If more than @maxsize messages are waiting, the new ones
+    are dropped. The queued messages are logged at exit"""
+    global _logQueue, _logThread
+    if _getLogQueue() is not None:
+        return
+    _logQueue = queue.Queue(maxsize)
+    _logThread = threading.Thread(target=_logWorker, args=(_logQueue,),
+                                  name="SMlog", daemon=True)
+    _logThread.start()
+    atexit.register(stopAsyncLogging)
+
+
+def stopAsyncLogging():
+    """Log the queued messages and go back to synchronous logging"""
+    global _logQueue, _logThread
+    logQueue, logThread = _logQueue, _logThread
+    if logQueue is None:
+        return
+    _logQueue = _logThread = None
+    logQueue.put(None)
+    logThread.join()
+
+
+def _getLogQueue():
+    """The queue of the logging thread, None when logging synchronously. A
+    forked child gets a new syslog lock, since another thread of the parent
+    may have held it while forking, and logs synchronously since the logging
+    thread does not exist in the child (os.register_at_fork is not available
+    on all the supported pythons)"""
+    global _logQueue, _logThread, _logPid, _syslogLock
+    if _logPid != os.getpid():
+        _logPid = os.getpid()
+        _syslogLock = threading.Lock()
+        _logQueue = _logThread = None
+    return _logQueue
 
 
 def SMlog(message, ident="SM", priority=LOG_INFO):
-    if LOGGING:
-        for message_line in str(message).split('\n'):
-            _logToSyslog(ident, _SM_SYSLOG_FACILITY, priority, message_line)
+    global _logDropped
+    if LOGGING and priority <= LOG_LEVEL:
+        lines = str(message).split('\n')
+        logQueue = _getLogQueue()
+        if logQueue is None:
+            _logLines(ident, priority, lines)
+            return
+        try:
+            logQueue.put_nowait((ident, priority, lines))
+        except queue.Full:
+            _logDropped += 1
 
 
 def _getDateString():
@@ -154,24 +259,56 @@ def _getDateString():
           (t[0], t[1], t[2], t[3], t[4], t[5])
 
 
-def doexec(args, inputtext=None, new_env=None, text=True):
-    """Execute a subprocess, then return its return code, stdout and stderr"""
+# The file descriptors opened by python are not inherited (PEP 446), so
+# they do not need to be closed in the children. Not closing them, and
+# giving the path of the executable, lets subprocess use posix_spawn instead
+# of fork + exec, which costs a lot more in a process with a large memory.
+EXEC_CLOSE_FDS = False
+
+# name -> path of the executables found in the PATH
+_executables: Dict[str, Optional[str]] = {}
+
+
+def _getExecutable(name):
+    if os.path.sep in name:
+        return name
+    if name not in _executables:
+        _executables[name] = shutil.which(name)
+    return _executables[name] or name
+
+
+def doexec(args, inputtext=None, new_env=None, text=True, timeout=None):
+    """Execute a subprocess, then return its return code, stdout and stderr.
+    If @timeout is set, the subprocess is killed after @timeout seconds and
+    a CommandException with ETIMEDOUT is raised"""
     env = None
     if new_env:
         env = dict(os.environ)
         env.update(new_env)
+    args = list(args)
+    args[0] = _getExecutable(args[0])
+    start = time.monotonic()
     proc = subprocess.Popen(args, stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE,
-                            close_fds=True, env=env,
+                            close_fds=EXEC_CLOSE_FDS, env=env,
                             universal_newlines=text)
 
     if not text and inputtext is not None:
         inputtext = inputtext.encode()
 
-    (stdout, stderr) = proc.communicate(inputtext)
+    try:
+        (stdout, stderr) = proc.communicate(inputtext, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        execstats.record(args[0], time.monotonic() - start,
+                         execstats.RC_TIMEOUT)
+        raise CommandException(errno.ETIMEDOUT, str(args),
+                               "timed out after %s seconds" % timeout)
 
     rc = proc.returncode
+    execstats.record(args[0], time.monotonic() - start, rc)
     return rc, stdout, stderr
 
 
@@ -187,7 +324,7 @@ def is_string(value):
 # each pair, the first component is passed to exec while the second is
 # written to the logs.
 def pread(cmdlist, close_stdin=False, scramble=None, expect_rc=0,
-          quiet=False, new_env=None, text=True):
+          quiet=False, new_env=None, text=True, timeout=None):
     cmdlist_for_exec = []
     cmdlist_for_log = []
     for item in cmdlist:
@@ -206,7 +343,8 @@ def pread(cmdlist, close_stdin=False, scramble=None, expect_rc=0,
 
     if not quiet:
         SMlog(cmdlist_for_log)
-    (rc, stdout, stderr) = doexec(cmdlist_for_exec, new_env=new_env, text=text)
+    (rc, stdout, stderr) = doexec(cmdlist_for_exec, new_env=new_env, text=text,
+                                  timeout=timeout)
     if rc != expect_rc:
         SMlog("FAILED in util.pread: (rc %d) stdout: '%s', stderr: '%s'" % \
                 (rc, stdout, stderr))
@@ -216,7 +354,7 @@ def pread(cmdlist, close_stdin=False, scramble=None, expect_rc=0,
             stderr = stdout
         raise CommandException(rc, str(cmdlist), stderr.strip())
     if not quiet:
-        SMlog("  pread SUCCESS")
+        SMlog("  pread SUCCESS", priority=LOG_DEBUG)
     return stdout
 
 
@@ -265,7 +403,7 @@ def pread3(cmdlist, text):
         if '' == stderr:
             stderr = stdout
         raise CommandException(rc, str(cmdlist), stderr.strip())
-    SMlog("  pread3 SUCCESS")
+    SMlog("  pread3 SUCCESS", priority=LOG_DEBUG)
     return stdout
 
 
@@ -511,31 +649,97 @@ def get_real_path(path):
     return absPath
 
 
+# Multicast group of the uevents re-broadcast by udev once it has
+# processed them, i.e. once the /dev nodes and links are in place
+UEVENT_UDEV_GROUP = 2
+NETLINK_KOBJECT_UEVENT = 15  # not exported by the socket module
+UEVENT_BUFSIZE = 64 * 1024
+UEVENT_RECHECK = 1  # seconds
+UDEVADM = '/usr/sbin/udevadm'
+
+
+def _open_uevent_socket():
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             NETLINK_KOBJECT_UEVENT)
+    except (AttributeError, OSError) as e:
+        SMlog("Cannot listen to udev events (%s), polling" % e)
+        return None
+    try:
+        sock.bind((0, UEVENT_UDEV_GROUP))
+        sock.setblocking(False)
+    except OSError as e:
+        SMlog("Cannot listen to udev events (%s), polling" % e)
+        sock.close()
+        return None
+    return sock
+
+
+def _drain_uevents(sock):
+    try:
+        while sock.recv(UEVENT_BUFSIZE):
+            pass
+    except (BlockingIOError, InterruptedError):
+        pass
+
+
+def wait_for_event(check, timeout):
+    """
+    Wait up to timeout seconds for check() to return a true value,
+    calling it again whenever udev reports a device event, and at least
+    every UEVENT_RECHECK seconds. Falls back to polling when the udev
+    events cannot be received. Returns the last result of check().
+    """
+    deadline = time.monotonic() + timeout
+    # Subscribe before the first check so that no event can be missed
+    sock = _open_uevent_socket()
+    try:
+        while True:
+            result = check()
+            if result:
+                return result
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return result
+            wait = min(UEVENT_RECHECK, remaining)
+            if sock is None:
+                time.sleep(wait)
+            elif select.select([sock], [], [], wait)[0]:
+                _drain_uevents(sock)
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def udev_settle(timeout):
+    """
+    Wait up to timeout seconds for udev to process the queued device
+    events, returning as soon as the queue is empty.
+    """
+    try:
+        pread2([UDEVADM, 'settle', '--timeout=%d' % timeout], quiet=True)
+    except CommandException as inst:
+        SMlog("udevadm settle failed with %d" % inst.code)
+
+
 def wait_for_path(path, timeout):
-    for i in range(0, timeout):
-        if len(glob.glob(path)):
-            return True
-        time.sleep(1)
-    return False
+    return bool(wait_for_event(lambda: glob.glob(path), timeout))
 
 
 def wait_for_nopath(path, timeout):
-    for i in range(0, timeout):
-        if not os.path.exists(path):
-            return True
-        time.sleep(1)
-    return False
+    return wait_for_event(lambda: not os.path.exists(path), timeout)
 
 
 def wait_for_path_multi(path, timeout):
-    for i in range(0, timeout):
+    def first_path():
         paths = glob.glob(path)
         SMlog("_wait_for_paths_multi: paths = %s" % paths)
-        if len(paths):
-            SMlog("_wait_for_paths_multi: return first path: %s" % paths[0])
-            return paths[0]
-        time.sleep(1)
-    return ""
+        return paths[0] if paths else ""
+
+    path = wait_for_event(first_path, timeout)
+    if path:
+        SMlog("_wait_for_paths_multi: return first path: %s" % path)
+    return path
 
 
 def isdir(path):
@@ -801,6 +1005,63 @@ def get_all_slaves(session):
     return [x for x in host_refs if x != master_ref]
 
 
+def call_plugin_on_hosts(hostRefs, plugin, fn, args, timeout=None,
+                         desc=None):
+    """
+    Call the plugin function on all the hosts at once and return the
+    results in the order of hostRefs. Each call is made on its own local
+    XAPI session as a session can't be shared between threads. If desc is
+    given, it is logged with each host as its call is started. Once all the
+    calls have returned, every failure is logged and the one of the first
+    failing host raised.
+    With a timeout (in seconds, for all the calls), the calls that did not
+    return in time are reported as failed but are not interrupted: they may
+    still run, and succeed, on their host afterwards. The callers for which
+    that matters (e.g. to undo what the calls did) must not set a timeout.
+    """
+    results = [None] * len(hostRefs)
+    errors = [None] * len(hostRefs)
+
+    def call(i, hostRef):
+        try:
+            session = get_localAPI_session()
+            try:
+                results[i] = session.xenapi.host.call_plugin(
+                    hostRef, plugin, fn, args)
+            finally:
+                session.xenapi.session.logout()
+        except Exception as e:
+            errors[i] = e
+
+    threads = []
+    for i, hostRef in enumerate(hostRefs):
+        if desc:
+            SMlog("%s on %s" % (desc, hostRef))
+        thread = threading.Thread(target=call, args=(i, hostRef), daemon=True)
+        thread.start()
+        threads.append(thread)
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    failed = []
+    for i, thread in enumerate(threads):
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(0, deadline - time.monotonic()))
+        if thread.is_alive():
+            errors[i] = SMException("%s %s timed out after %d seconds, it "
+                                    "may still complete" %
+                                    (plugin, fn, timeout))
+        if errors[i] is not None:
+            SMlog("call-plugin %s %s failed on %s: %s" %
+                  (plugin, fn, hostRefs[i], errors[i]))
+            failed.append(errors[i])
+    if failed:
+        raise failed[0]
+    return results
+
+
 def is_attached_rw(sm_config):
     for key, val in sm_config.items():
         if key.startswith("host_") and val == "RW":
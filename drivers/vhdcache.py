@@ -0,0 +1,169 @@
+# Copyright (C) Vates SAS
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Persistent cache of the VHD info of VHD files, shared by all the SM
+# processes. There is one cache file per directory (i.e. per file-based SR).
+# An entry is only valid for the exact signature (device, inode, size, mtime)
+# of the file it was read from, so that any write to the file invalidates it,
+# whoever the writer is. On NFS, this relies on the attributes being
+# revalidated when the file is opened (close-to-open consistency), as a plain
+# stat can return attributes cached for up to acregmax. The cache is
+# best-effort: concurrent updates may lose entries, which only results in
+# cache misses
+#
+
+import json
+import os
+import time
+
+import util
+
+CACHE_DIR = "/var/run/sm/vhdcache"
+
+# the files modified less than that many seconds ago are not cached: another
+# write in the same mtime tick would not change the signature
+RACY_WINDOW = 2
+
+# VHDInfo attributes stored in the cache
+FIELDS = ["uuid", "path", "sizeVirt", "sizePhys", "sizeAllocated", "hidden",
+          "parentUuid", "parentPath"]
+
+
+def getSignature(path):
+    """Return the signature of the file, or None if it cannot be cached"""
+    try:
+        # open the file rather than stat it, to get the attributes from the
+        # server on NFS
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+    if time.time() - st.st_mtime < RACY_WINDOW:
+        return None
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def isCached(path):
+    """Tell whether the directory of the VHD file has a cache"""
+    return VHDInfoCache(os.path.dirname(path)).exists()
+
+
+def invalidate(path):
+    """Remove the entry of a VHD file that is about to be modified"""
+    cache = VHDInfoCache(os.path.dirname(path))
+    if cache.exists() and cache.remove(path):
+        cache.save()
+
+
+def clear(dirPath):
+    """Drop the cache of a directory"""
+    try:
+        os.unlink(VHDInfoCache(dirPath).cacheFile)
+    except FileNotFoundError:
+        pass
+
+
+class VHDInfoCache:
+    def __init__(self, dirPath):
+        self.dirPath = dirPath
+        name = dirPath.strip("/").replace("/", "_") + ".json"
+        self.cacheFile = os.path.join(CACHE_DIR, name)
+        self._entries = None
+        self._updated = {}
+        self._removed = set()
+
+    def exists(self):
+        return os.path.exists(self.cacheFile)
+
+    def _load(self):
+        try:
+            with open(self.cacheFile) as f:
+                entries = json.load(f)
+            if not isinstance(entries, dict):
+                raise ValueError("not a dict")
+            return entries
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            util.SMlog("Ignoring the VHD info cache %s: %s" %
+                       (self.cacheFile, e))
+        return {}
+
+    def _getEntries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def get(self, path, signature, vhdInfoClass):
+        """Return the cached VHD info of the file if its signature is still
+        the same, None otherwise"""
+        if signature is None:
+            return None
+        entry = self._getEntries().get(os.path.basename(path))
+        if not entry or entry.get("signature") != signature:
+            return None
+        vhdInfo = vhdInfoClass(entry["uuid"])
+        for field in FIELDS:
+            setattr(vhdInfo, field, entry[field])
+        return vhdInfo
+
+    def put(self, path, signature, vhdInfo):
+        """Cache the VHD info read from the file, 'signature' being the one of
+        the file before it was read"""
+        if signature is None or vhdInfo.error:
+            return
+        entry = dict((field, getattr(vhdInfo, field)) for field in FIELDS)
+        entry["signature"] = signature
+        name = os.path.basename(path)
+        self._getEntries()[name] = entry
+        self._updated[name] = entry
+        self._removed.discard(name)
+
+    def remove(self, path):
+        name = os.path.basename(path)
+        self._removed.add(name)
+        self._updated.pop(name, None)
+        return self._getEntries().pop(name, None) is not None
+
+    def prune(self, paths):
+        """Forget the files that are not in 'paths' anymore"""
+        names = set(os.path.basename(path) for path in paths)
+        for name in list(self._getEntries()):
+            if name not in names:
+                self.remove(name)
+
+    def save(self):
+        """Write the changes, merged with the ones written by other processes
+        since the cache was loaded"""
+        if not self._updated and not self._removed:
+            return
+        entries = self._load()
+        entries.update(self._updated)
+        for name in self._removed:
+            entries.pop(name, None)
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR, exist_ok=True)
+            util.atomicFileWrite(self.cacheFile, CACHE_DIR,
+                                 json.dumps(entries))
+        except OSError as e:
+            util.SMlog("Failed to write the VHD info cache %s: %s" %
+                       (self.cacheFile, e))
+        self._entries = entries
+        self._updated = {}
+        self._removed = set()
@@ -0,0 +1,291 @@
+# Copyright (C) Vates SAS
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Read-only parser of the VHD metadata (footer, dynamic header, parent
+# locators, BAT and batmap header), following the libvhd conventions so that
+# the results match the ones of vhd-util
+#
+
+import array
+import errno
+import mmap
+import os
+import struct
+import sys
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+
+FOOTER_COOKIE = b"conectix"
+HEADER_COOKIE = b"cxsparse"
+BATMAP_COOKIE = b"tdbatmap"
+
+TYPE_DYNAMIC = 3
+TYPE_DIFF = 4
+
+BLK_UNUSED = 0xFFFFFFFF
+
+PLAT_CODE_NONE = 0
+PLAT_CODE_MACX = 0x4D616358  # "MacX"
+
+NUM_PARENT_LOCATORS = 8
+LOCATOR_SIZE = 24
+
+NIL_UUID = b"\x00" * 16
+
+# a parent chain longer than that is a loop
+MAX_CHAIN_DEPTH = 64
+
+
+def _checksum(data, offset):
+    """One's complement of the sum of the bytes, the 4 bytes of the checksum
+    field itself (at 'offset') being excluded"""
+    total = sum(data) - sum(data[offset:offset + 4])
+    return ~total & 0xFFFFFFFF
+
+
+def _secsRoundUp(size):
+    secs = (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+    return max(secs, 1)
+
+
+class VHDReader:
+    """Metadata of a dynamic or differencing VHD. The metadata is read with
+    O_DIRECT (as libvhd does) so that changes made from other hosts to a
+    shared LV are seen. ValueError is raised for anything that vhd-util would
+    not handle the same way (bad cookie or checksum, fixed VHD, unsupported
+    parent locator...), in which case the caller should use vhd-util"""
+
+    def __init__(self, path, readBat=False):
+        self.path = path
+        self.bat = None
+        self.batmapHeader = None
+        self._fd = self._open(path)
+        try:
+            self._readFooter()
+            self._readHeader()
+            self._readBatmapHeader()
+            self.parentLocation = None
+            if self.diskType == TYPE_DIFF and not self.parentRaw:
+                self._readParentLocation()
+            if readBat:
+                self._readBat()
+        finally:
+            os.close(self._fd)
+            self._fd = -1
+
+    @staticmethod
+    def _open(path):
+        try:
+            return os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            # some file systems (e.g. tmpfs) do not support O_DIRECT
+            if e.errno != errno.EINVAL:
+                raise
+        return os.open(path, os.O_RDONLY)
+
+    def _pread(self, size, offset):
+        """Read 'size' bytes at 'offset' through a sector-aligned buffer, as
+        required by O_DIRECT. A short read raises ValueError"""
+        start = offset - offset % SECTOR_SIZE
+        end = offset + size
+        end += -end % SECTOR_SIZE
+        buf = mmap.mmap(-1, end - start)
+        try:
+            # os.preadv needs python 3.7, and os.pread can't read into an
+            # aligned buffer: the reader owns the fd, so seek then read
+            os.lseek(self._fd, start, os.SEEK_SET)
+            count = os.readv(self._fd, [buf])
+            if count < offset - start + size:
+                raise ValueError("short read of %d bytes at %d" %
+                                 (size, offset))
+            return bytes(buf[offset - start:offset - start + size])
+        finally:
+            buf.close()
+
+    def _readFooter(self):
+        """Use the footer at the end of the file like libvhd does, or its copy
+        at the beginning when the former is not valid (e.g. for a VHD in an
+        inflated LV)"""
+        end = os.lseek(self._fd, 0, os.SEEK_END)
+        footer = None
+        if end >= FOOTER_SIZE and end % SECTOR_SIZE == 0:
+            footer = self._pread(FOOTER_SIZE, end - FOOTER_SIZE)
+            if not self._isValidFooter(footer):
+                footer = None
+        if footer is None:
+            footer = self._pread(FOOTER_SIZE, 0)
+            if not self._isValidFooter(footer):
+                raise ValueError("no valid footer")
+
+        (self.dataOffset,) = struct.unpack_from(">Q", footer, 16)
+        (self.sizeVirt, self.diskType) = struct.unpack_from(">Q4xI",
+                                                            footer, 48)
+        if self.diskType not in (TYPE_DYNAMIC, TYPE_DIFF):
+            raise ValueError("disk type %d" % self.diskType)
+        self.uuid = footer[68:84]
+        self.hidden = footer[85]
+
+    @staticmethod
+    def _isValidFooter(footer):
+        if footer[0:8] != FOOTER_COOKIE:
+            return False
+        (checksum,) = struct.unpack_from(">I", footer, 64)
+        return checksum == _checksum(footer, 64)
+
+    def _readHeader(self):
+        header = self._pread(HEADER_SIZE, self.dataOffset)
+        if header[0:8] != HEADER_COOKIE:
+            raise ValueError("no dynamic disk header")
+        (checksum,) = struct.unpack_from(">I", header, 36)
+        if checksum != _checksum(header, 36):
+            raise ValueError("bad dynamic disk header checksum")
+        (self.tableOffset, self.maxBatSize, self.blockSize) = \
+                struct.unpack_from(">Q4xII", header, 16)
+        if not self.blockSize or self.blockSize % SECTOR_SIZE:
+            raise ValueError("block size %d" % self.blockSize)
+        self.parentUuid = header[40:56]
+        self.locators = []
+        for i in range(NUM_PARENT_LOCATORS):
+            offset = 576 + i * LOCATOR_SIZE
+            (code, dataSpace, dataLen, dataOffset) = \
+                    struct.unpack_from(">III4xQ", header, offset)
+            if code != PLAT_CODE_NONE:
+                self.locators.append((code, dataSpace, dataLen, dataOffset))
+
+    def _readBatmapHeader(self):
+        """The batmap is a tapdisk extension that follows the BAT"""
+        offset = self.tableOffset + self._batSize()
+        header = self._pread(SECTOR_SIZE, offset)
+        if header[0:8] == BATMAP_COOKIE:
+            self.batmapHeaderOffset = offset
+            self.batmapHeader = header
+
+    def _batSize(self):
+        return _secsRoundUp(self.maxBatSize * 4) * SECTOR_SIZE
+
+    @property
+    def parentRaw(self):
+        """libvhd marks the raw parents with a nil parent UUID"""
+        return self.diskType == TYPE_DIFF and self.parentUuid == NIL_UUID
+
+    def _readParentLocation(self):
+        """Decode the MACX parent locator, the only one written and used by
+        libvhd"""
+        for (code, _dataSpace, dataLen, dataOffset) in self.locators:
+            if code != PLAT_CODE_MACX:
+                continue
+            data = self._pread(dataLen, dataOffset)
+            location = data.decode("utf-8").rstrip("\0")
+            if location.startswith("file://"):
+                location = location[len("file://"):]
+            if not location:
+                raise ValueError("empty parent locator")
+            self.parentLocation = location
+            return
+        raise ValueError("no MACX parent locator")
+
+    def _readBat(self):
+        data = self._pread(self.maxBatSize * 4, self.tableOffset)
+        self.bat = array.array("I", data)
+        if sys.byteorder == "little":
+            self.bat.byteswap()
+
+    def getParentPath(self, resolve=True):
+        """Return the path of the parent, or None if there is none. The
+        locator path is relative to the directory of the child, unless it is
+        absolute. With 'resolve', the parent must be readable (vhd-util
+        checks it too)"""
+        if self.diskType != TYPE_DIFF:
+            return None
+        if self.parentRaw:
+            raise ValueError("raw parent")
+        location = self.parentLocation
+        if os.path.isabs(location):
+            candidates = [location]
+        else:
+            candidates = [
+                os.path.normpath(os.path.join(os.path.dirname(path),
+                                              location))
+                for path in (self.path, os.path.realpath(self.path))]
+        if not resolve:
+            return candidates[0]
+        for candidate in candidates:
+            if os.access(candidate, os.R_OK):
+                return candidate
+        raise ValueError("parent %s not found" % location)
+
+    def getDepth(self):
+        """Length of the parent chain, including this VHD (and the raw
+        parent at the bottom of the chain, if any)"""
+        depth = 1
+        vhd = self
+        while vhd.diskType == TYPE_DIFF:
+            depth += 1
+            if vhd.parentRaw:
+                break
+            if depth > MAX_CHAIN_DEPTH:
+                raise ValueError("parent chain loop")
+            vhd = VHDReader(vhd.getParentPath())
+        return depth
+
+    def getNumAllocatedBlocks(self):
+        return len(self.bat) - self.bat.count(BLK_UNUSED)
+
+    def getSizePhys(self):
+        """The physical utilisation, as reported by vhd-util: the end of the
+        last allocated block (or of the metadata if further) plus the size of
+        the footer"""
+        end = self._getEndOfHeaders()
+        allocated = [blk for blk in self.bat if blk != BLK_UNUSED]
+        if allocated:
+            spb = self.blockSize // SECTOR_SIZE
+            bitmapSecs = _secsRoundUp(spb // 8)
+            lastBlock = (max(allocated) + bitmapSecs + spb) * SECTOR_SIZE
+            end = max(end, lastBlock)
+        return end + FOOTER_SIZE
+
+    def _getEndOfHeaders(self):
+        end = max(self.dataOffset + HEADER_SIZE,
+                  self.tableOffset + self._batSize())
+        if self.batmapHeader:
+            (batmapOffset, batmapSize) = \
+                    struct.unpack_from(">QI", self.batmapHeader, 8)
+            end = max(end, self.batmapHeaderOffset + SECTOR_SIZE,
+                      batmapOffset + batmapSize * SECTOR_SIZE)
+        for (_code, dataSpace, _dataLen, dataOffset) in self.locators:
+            end = max(end, dataOffset + self._getLocatorSize(dataSpace))
+        return end
+
+    @staticmethod
+    def _getLocatorSize(dataSpace):
+        """The data space is in sectors or in bytes depending on the tool
+        that wrote the locator"""
+        if dataSpace < SECTOR_SIZE:
+            return dataSpace * SECTOR_SIZE
+        if dataSpace % SECTOR_SIZE == 0:
+            return dataSpace
+        return 0
+
+    def getKeyHash(self):
+        """Hash of the encryption key, stored in the batmap header"""
+        if not self.batmapHeader:
+            raise ValueError("no batmap")
+        # struct vhd_keyhash: cookie (1 byte), nonce (32 bytes), hash
+        # (32 bytes)
+        if not self.batmapHeader[29]:
+            return None
+        return self.batmapHeader[62:94].hex()
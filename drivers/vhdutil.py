@@ -19,10 +19,14 @@
 import os
 import util
 import errno
+import glob
 import zlib
 import re
 import xs_errors
 import time
+import vhdcache
+import vhdreader
+from concurrent.futures import ThreadPoolExecutor
 
 MIN_VHD_SIZE = 2 * 1024 * 1024
 MAX_VHD_SIZE = 2040 * 1024 * 1024 * 1024
@@ -33,6 +37,22 @@ OPT_LOG_ERR = "--debug"
 VHD_BLOCK_SIZE = 2 * 1024 * 1024
 VHD_FOOTER_SIZE = 512
 
+# Backend of the read-only queries: QUERY_BACKEND_NATIVE parses the VHD
+# metadata in-process (see vhdreader) and uses vhd-util only for the VHDs it
+# cannot handle, QUERY_BACKEND_VHD_UTIL always uses vhd-util. The
+# modifications always go through vhd-util
+QUERY_BACKEND_NATIVE = "native"
+QUERY_BACKEND_VHD_UTIL = "vhd-util"
+QUERY_BACKEND = QUERY_BACKEND_NATIVE
+
+# above this many VHD files missing from the VHD info cache, a batch scan is
+# cheaper than querying them one by one
+MAX_CACHE_MISS_QUERIES = 16
+
+# max number of VHD headers read in parallel (mostly useful on NFS, where the
+# reads are latency-bound)
+MAX_HEADER_READERS = 16
+
 # lock to lock the entire SR for short ops
 LOCK_TYPE_SR = "sr"
 
@@ -89,9 +109,12 @@ def calcOverheadBitmap(virtual_size):
     return num_blocks * 4096
 
 
-def ioretry(cmd, text=True):
-    return util.ioretry(lambda: util.pread2(cmd, text=text),
-                        errlist=[errno.EIO, errno.EAGAIN])
+def ioretry(cmd, text=True, run=None):
+    """Run the command with util.pread2, or with run(cmd) when given,
+    retrying on I/O errors"""
+    if run is None:
+        run = lambda cmd: util.pread2(cmd, text=text)
+    return util.ioretry(lambda: run(cmd), errlist=[errno.EIO, errno.EAGAIN])
 
 
 def convertAllocatedSizeToBytes(size):
@@ -99,10 +122,56 @@ def convertAllocatedSizeToBytes(size):
     return size * 2 * 1024 * 1024
 
 
+# returned by _queryNative when vhd-util has to be used
+_USE_VHD_UTIL = object()
+
+
+def _queryNative(path, query, readBat=False):
+    """Run query() on the VHDReader of path. Return _USE_VHD_UTIL if the
+    native backend is disabled or cannot handle this VHD"""
+    if QUERY_BACKEND != QUERY_BACKEND_NATIVE:
+        return _USE_VHD_UTIL
+    try:
+        return query(vhdreader.VHDReader(path, readBat))
+    except (OSError, ValueError) as e:
+        util.SMlog("Native query of VHD %s failed (%s), using vhd-util" %
+                   (path, e))
+        return _USE_VHD_UTIL
+
+
+def _getVHDInfoNative(vhd, extractUuidFunction, includeParent, resolveParent):
+    vhdInfo = VHDInfo(extractUuidFunction(vhd.path))
+    vhdInfo.sizeVirt = _roundSizeVirt(vhd.sizeVirt)
+    vhdInfo.sizePhys = vhd.getSizePhys()
+    if includeParent:
+        parentPath = vhd.getParentPath(resolveParent)
+        if parentPath:
+            vhdInfo.parentPath = parentPath
+            vhdInfo.parentUuid = extractUuidFunction(parentPath)
+    vhdInfo.hidden = vhd.hidden
+    vhdInfo.sizeAllocated = convertAllocatedSizeToBytes(
+        vhd.getNumAllocatedBlocks())
+    vhdInfo.path = vhd.path
+    return vhdInfo
+
+
+def _roundSizeVirt(size):
+    """vhd-util reports the virtual size in MiB, rounded down"""
+    return (size // (1024 * 1024)) * 1024 * 1024
+
+
 def getVHDInfo(path, extractUuidFunction, includeParent=True, resolveParent=True):
     """Get the VHD info. The parent info may optionally be omitted: vhd-util
     tries to verify the parent by opening it, which results in error if the VHD
     resides on an inactive LV"""
+    vhdInfo = _queryNative(
+        path,
+        lambda vhd: _getVHDInfoNative(vhd, extractUuidFunction,
+                                      includeParent, resolveParent),
+        readBat=True)
+    if vhdInfo is not _USE_VHD_UTIL:
+        return vhdInfo
+
     opts = "-vsaf"
     if includeParent:
         opts += "p"
@@ -168,6 +237,59 @@ def getAllVHDs(pattern, extractUuidFunction, vgName=None, \
     return vhds
 
 
+def getAllVHDsCached(pattern, extractUuidFunction):
+    """Like getAllVHDs for VHD files, but using the persistent VHD info cache
+    of their directory (see vhdcache): only the files that changed since they
+    were cached are read, and the cache is updated with them"""
+    paths = util.ioretry(lambda: glob.glob(pattern))
+    cache = vhdcache.VHDInfoCache(os.path.dirname(pattern))
+    cache.prune(paths)
+    vhds = dict()
+    missing = []
+    for path in paths:
+        signature = vhdcache.getSignature(path)
+        vhdInfo = cache.get(path, signature, VHDInfo)
+        if vhdInfo:
+            vhds[vhdInfo.uuid] = vhdInfo
+        else:
+            missing.append((path, signature))
+
+    if len(missing) > MAX_CACHE_MISS_QUERIES:
+        scanned = getAllVHDs(pattern, extractUuidFunction)
+        scannedByName = dict((os.path.basename(vhdInfo.path), vhdInfo)
+                             for vhdInfo in scanned.values())
+        for path, signature in missing:
+            vhdInfo = scannedByName.get(os.path.basename(path))
+            if vhdInfo:
+                cache.put(path, signature, vhdInfo)
+        vhds = scanned
+    else:
+        for path, signature in missing:
+            try:
+                vhdInfo = getVHDInfo(path, extractUuidFunction,
+                                     resolveParent=False)
+            except util.CommandException as e:
+                vhdInfo = VHDInfo(extractUuidFunction(path))
+                vhdInfo.path = path
+                vhdInfo.error = str(e)
+                util.SMlog("***** VHD query error: %s" % e)
+            cache.put(path, signature, vhdInfo)
+            vhds[vhdInfo.uuid] = vhdInfo
+
+    if missing:
+        util.SMlog("VHD info cache: %d/%d VHDs read" %
+                   (len(missing), len(paths)))
+    cache.save()
+    return vhds
+
+
+def getCachedVHDInfo(path):
+    """Return the VHD info of the VHD file from the persistent VHD info cache
+    of its directory if it is up-to-date, None otherwise"""
+    cache = vhdcache.VHDInfoCache(os.path.dirname(path))
+    return cache.get(path, vhdcache.getSignature(path), VHDInfo)
+
+
 def getParentChain(lvName, extractUuidFunction, vgName):
     """Get the chain of all VHD parents of 'path'. Safe to call for raw VDI's
     as well"""
@@ -190,19 +312,36 @@ def getParentChain(lvName, extractUuidFunction, vgName):
 
 
 def getParent(path, extractUuidFunction):
+    parentPath = getParentPath(path)
+    if parentPath is None:
+        return None
+    return extractUuidFunction(parentPath)
+
+
+def getParentPath(path):
+    """Return the path of the parent of the VHD, or None if it has none"""
+    parentPath = _queryNative(path, lambda vhd: vhd.getParentPath())
+    if parentPath is not _USE_VHD_UTIL:
+        return parentPath
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     if ret.find("query failed") != -1 or ret.find("Failed opening") != -1:
         raise util.SMException("VHD query returned %s" % ret)
     if ret.find("no parent") != -1:
         return None
-    return extractUuidFunction(ret)
+    return ret.strip()
 
 
 def hasParent(path):
     """Check if the VHD has a parent. A VHD has a parent iff its type is
     'Differencing'. This function does not need the parent to actually
     be present (e.g. the parent LV to be activated)."""
+    isDiff = _queryNative(
+        path, lambda vhd: vhd.diskType == vhdreader.TYPE_DIFF)
+    if isDiff is not _USE_VHD_UTIL:
+        return isDiff
+
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     # pylint: disable=no-member
@@ -212,15 +351,30 @@ def hasParent(path):
     return vhd_type == "Differencing"
 
 
+def _modify(path, cmd, run=None):
+    """Run a vhd-util command that modifies the VHD file at path"""
+    try:
+        return ioretry(cmd, run=run)
+    finally:
+        vhdcache.invalidate(path)
+
+
 def setParent(path, parentPath, parentRaw):
     normpath = os.path.normpath(parentPath)
     cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-p", normpath, "-n", path]
     if parentRaw:
         cmd.append("-m")
-    ioretry(cmd)
+    try:
+        _modify(path, cmd)
+    finally:
+        vhdcache.invalidate(normpath)
 
 
 def getHidden(path):
+    hidden = _queryNative(path, lambda vhd: vhd.hidden)
+    if hidden is not _USE_VHD_UTIL:
+        return hidden
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-f", "-n", path]
     ret = ioretry(cmd)
     hidden = int(ret.split(':')[-1].strip())
@@ -232,10 +386,14 @@ def setHidden(path, hidden=True):
     if not hidden:
         opt = "0"
     cmd = [VHD_UTIL, "set", OPT_LOG_ERR, "-n", path, "-f", "hidden", "-v", opt]
-    ret = ioretry(cmd)
+    _modify(path, cmd)
 
 
 def getSizeVirt(path):
+    size = _queryNative(path, lambda vhd: _roundSizeVirt(vhd.sizeVirt))
+    if size is not _USE_VHD_UTIL:
+        return size
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-v", "-n", path]
     ret = ioretry(cmd)
     size = int(ret) * 1024 * 1024
@@ -247,14 +405,14 @@ def setSizeVirt(path, size, jFile):
     size_mb = size // (1024 * 1024)
     cmd = [VHD_UTIL, "resize", OPT_LOG_ERR, "-s", str(size_mb), "-n", path,
             "-j", jFile]
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def setSizeVirtFast(path, size):
     "resize VHD online"
     size_mb = size // (1024 * 1024)
     cmd = [VHD_UTIL, "resize", OPT_LOG_ERR, "-s", str(size_mb), "-n", path, "-f"]
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def getMaxResizeSize(path):
@@ -265,6 +423,10 @@ def getMaxResizeSize(path):
 
 
 def getSizePhys(path):
+    size = _queryNative(path, lambda vhd: vhd.getSizePhys(), readBat=True)
+    if size is not _USE_VHD_UTIL:
+        return size
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-s", "-n", path]
     ret = ioretry(cmd)
     return int(ret)
@@ -276,10 +438,17 @@ def setSizePhys(path, size, debug=True):
         cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-s", str(size), "-n", path]
     else:
         cmd = [VHD_UTIL, "modify", "-s", str(size), "-n", path]
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def getAllocatedSize(path):
+    size = _queryNative(
+        path,
+        lambda vhd: convertAllocatedSizeToBytes(vhd.getNumAllocatedBlocks()),
+        readBat=True)
+    if size is not _USE_VHD_UTIL:
+        return size
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, '-a', '-n', path]
     ret = ioretry(cmd)
     return convertAllocatedSizeToBytes(int(ret))
@@ -287,11 +456,15 @@ def getAllocatedSize(path):
 def killData(path):
     "zero out the disk (kill all data inside the VHD file)"
     cmd = [VHD_UTIL, "modify", OPT_LOG_ERR, "-z", "-n", path]
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def getDepth(path):
     "get the VHD parent chain depth"
+    depth = _queryNative(path, lambda vhd: vhd.getDepth())
+    if depth is not _USE_VHD_UTIL:
+        return depth
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-d", "-n", path]
     text = ioretry(cmd)
     depth = -1
@@ -306,12 +479,31 @@ def getBlockBitmap(path):
     return zlib.compress(text)
 
 
-def coalesce(path):
+def coalesce(path, ancestorPath=None, run=None):
     """
-    Coalesce the VHD, on success it returns the number of sectors coalesced
+    Coalesce the VHD, on success it returns the number of sectors coalesced.
+    With ancestorPath, the VHD and all its parents below that ancestor are
+    coalesced onto it in one pass, each block being copied in its newest
+    version. The vhd-util command is run by run(cmd) when given, which
+    returns its output
     """
     cmd = [VHD_UTIL, "coalesce", OPT_LOG_ERR, "-n", path]
-    text = ioretry(cmd)
+    writtenPath = ancestorPath
+    if ancestorPath:
+        cmd.extend(["-a", ancestorPath])
+    elif vhdcache.isCached(path):
+        # the parent is written to
+        try:
+            writtenPath = getParentPath(path)
+        except util.SMException as e:
+            util.SMlog("Cannot find the parent of %s (%s), dropping the "
+                       "VHD info cache" % (path, e))
+            vhdcache.clear(os.path.dirname(path))
+    try:
+        text = _modify(path, cmd, run)
+    finally:
+        if writtenPath:
+            vhdcache.invalidate(writtenPath)
     match = re.match(r'^Coalesced (\d+) sectors', text)
     if match:
         return int(match.group(1))
@@ -327,7 +519,7 @@ def create(path, size, static, msize=0):
     if msize:
         cmd.append("-S")
         cmd.append(str(msize))
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def snapshot(path, parent, parentRaw, msize=0, checkEmpty=True):
@@ -339,7 +531,7 @@ def snapshot(path, parent, parentRaw, msize=0, checkEmpty=True):
         cmd.append(str(msize))
     if not checkEmpty:
         cmd.append("-e")
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def check(path, ignoreMissingFooter=False, fast=False):
@@ -357,7 +549,7 @@ def check(path, ignoreMissingFooter=False, fast=False):
 
 def revert(path, jFile):
     cmd = [VHD_UTIL, "revert", OPT_LOG_ERR, "-n", path, "-j", jFile]
-    ioretry(cmd)
+    _modify(path, cmd)
 
 
 def _parseVHDInfo(line, extractUuidFunction):
@@ -406,7 +598,7 @@ def _getVHDParentNoCheck(path):
 
 def repair(path):
     """Repairs the VHD."""
-    ioretry([VHD_UTIL, 'repair', '-n', path])
+    _modify(path, [VHD_UTIL, 'repair', '-n', path])
 
 
 def validate_and_round_vhd_size(size):
@@ -443,6 +635,34 @@ def getKeyHash(path):
     return key_hash
 
 
+def getKeyHashes(paths):
+    """Get the hash of the encryption key of several VHDs at once, as a dict
+    path -> hash (or None). The hashes are read directly from the VHD headers
+    by a pool of threads; vhd-util is only used for the VHDs whose layout is
+    not the expected one or that could not be read"""
+    if not paths:
+        return {}
+    workers = min(MAX_HEADER_READERS, len(paths))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(_getKeyHashDirect, paths)))
+
+
+def _getKeyHashDirect(path):
+    try:
+        return _readKeyHash(path)
+    except (OSError, ValueError) as e:
+        # vhd-util is also retried on I/O errors
+        util.SMlog("Cannot read the key hash of %s directly (%s), using "
+                   "vhd-util" % (path, e))
+        return getKeyHash(path)
+
+
+def _readKeyHash(path):
+    """Read the key hash from the batmap header of the VHD. Raise ValueError
+    if the VHD does not have the expected layout"""
+    return vhdreader.VHDReader(path).getKeyHash()
+
+
 def setKey(path, key_hash):
     """Set the encryption key for a VHD"""
     cmd = ["vhd-util", "key", "-s", "-n", path, "-H", key_hash]
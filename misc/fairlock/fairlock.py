@@ -1,10 +1,18 @@
 from sm_typing import Any, Callable, Dict, Optional, override
 
+from types import ModuleType
 import os
 import socket
 import inspect
 import time
 
+lockstats: Optional[ModuleType]
+try:
+    # Lock contention statistics, shipped with the SM drivers.
+    import lockstats
+except ImportError:
+    lockstats = None
+
 SOCKDIR = "/run/fairlock"
 START_SERVICE_TIMEOUT_SECS = 2
 
@@ -67,6 +75,7 @@ class Fairlock(metaclass=SingletonWithArgs):
         if self.connected:
             raise FairlockDeadlock(f"Deadlock on Fairlock resource '{self.name}'")
 
+        start = time.monotonic()
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.setblocking(True)
         try:
@@ -77,11 +86,16 @@ class Fairlock(metaclass=SingletonWithArgs):
 
         self.sock.send(f'{os.getpid()} - {time.monotonic()}'.encode())
         self.connected = True
+        if lockstats:
+            lockstats.recordAcquired(f"fairlock:{self.name}",
+                                     time.monotonic() - start)
         return self
 
     def __exit__(self, type, value, traceback):
         self.sock.close()
         self.sock = None
         self.connected = False
+        if lockstats:
+            lockstats.recordReleased(f"fairlock:{self.name}")
         return False
 
@@ -0,0 +1,446 @@
+"""
+Benchmarks of the SR hot paths, run on synthetic SRs of N VDIs in VHD chains
+of depth D. Only the subprocesses are faked (see BenchmarkContext), so the
+parsing and the bookkeeping of the drivers are timed, and the external
+commands run by each operation are counted.
+
+The results are written as JSON, and can be compared with the ones of a
+previous run: more commands run, or a time above the tolerance, are
+reported as regressions (and make the exit status 1).
+
+    PYTHONPATH=.:./mocks:./drivers:./misc/fairlock:./tests \\
+        python3 tests/benchmarks/hotpaths.py -n 500 -d 5 -o results.json \\
+        [--baseline baseline.json]
+
+The logs are disabled during the benchmarks.
+"""
+
+from sm_typing import override
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest.mock as mock
+import uuid
+
+import cleanup
+import FileSR
+import lock
+import LVHDSR
+import lvhdutil
+import lvmcache
+import lvmcached
+import lvutil
+import srmetadata
+import vhdcache
+import vhdutil
+from refcounter import RefCounter
+
+import testlib
+from lvmlib import LVSubsystem
+from test_srmetadata import LVMMetadataTestContext
+from test_vhdutil import write_vhd
+
+SR_UUID = "0f1ec7f3-5a33-4f7c-8f3e-2d0e8b4f9a61"
+VG_NAME = lvhdutil.VG_PREFIX + SR_UUID
+
+VDI_SIZE = 10 * 1024 * 1024 * 1024
+VG_SIZE = 4 * 1024 * 1024 * 1024 * 1024
+
+# the leaf of one chain out of GARBAGE_EVERY is hidden: the chain is garbage
+GARBAGE_EVERY = 4
+
+DEFAULT_TOLERANCE = 0.5
+# smaller slowdowns are noise, whatever the tolerance
+MIN_SLOWDOWN = 0.001
+
+
+class SyntheticVDI:
+    def __init__(self, index, parent, hidden):
+        self.uuid = str(uuid.UUID(int=index + 1))
+        self.parent = parent
+        self.hidden = hidden
+
+
+class SyntheticSR:
+    """numVDIs VDIs in chains of 'depth' VHDs. The inner VHDs of a chain are
+    hidden and coalesceable, its leaf is visible unless the chain is garbage
+    (see GARBAGE_EVERY)"""
+
+    def __init__(self, numVDIs, depth):
+        self.vdis = []
+        for i in range(numVDIs):
+            chain, pos = divmod(i, depth)
+            parent = self.vdis[-1] if pos else None
+            leaf = pos == depth - 1 or i == numVDIs - 1
+            hidden = not leaf or chain % GARBAGE_EVERY == GARBAGE_EVERY - 1
+            self.vdis.append(SyntheticVDI(i, parent, hidden))
+
+    def lvName(self, vdi):
+        return lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + vdi.uuid
+
+    def vhdScan(self, pathOf, parentsOnly):
+        """Return the output of "vhd-util scan" for the VHDs, 'pathOf' giving
+        the path of a VDI"""
+        parents = set(vdi.parent for vdi in self.vdis if vdi.parent)
+        lines = []
+        for vdi in self.vdis:
+            if parentsOnly and vdi not in parents:
+                continue
+            parent = pathOf(vdi.parent) if vdi.parent else "none"
+            lines.append("vhd=%s capacity=%d size=%d hidden=%d parent=%s" %
+                         (pathOf(vdi), VDI_SIZE, VDI_SIZE // 2,
+                          int(vdi.hidden), parent))
+        return "\n".join(lines) + "\n"
+
+
+class BenchmarkContext(testlib.TestContext):
+    """Only fakes the subprocesses (the files are real ones): each command
+    run is counted by the base name of its executable"""
+
+    def __init__(self):
+        super().__init__()
+        self.commands = collections.Counter()
+
+    @override
+    def add_executable(self, fpath, funct) -> None:
+        name = os.path.basename(fpath)
+
+        def counted(args, stdin):
+            self.commands[name] += 1
+            return funct(args, stdin)
+
+        super().add_executable(fpath, counted)
+
+    @override
+    def start(self) -> None:
+        self.patch('subprocess.Popen', new=self.fake_popen)
+
+    @override
+    def log(self, *args) -> None:
+        pass
+
+
+class FakeStorage:
+    """The commands giving the state of the synthetic SR: the LVs of its VG
+    (on top of the LVSubsystem fake) and the VHD headers, as LVs in the VG
+    or as files in 'fileDir'"""
+
+    def __init__(self, context, sr, fileDir):
+        self.sr = sr
+        self.fileDir = fileDir
+        self.lvSystem = LVSubsystem(context.log, context.add_executable)
+        self.lvSystem.add_volume_group(VG_NAME)
+        vg = self.lvSystem.get_volume_group(VG_NAME)
+        sizeMB = lvhdutil.calcSizeVHDLV(VDI_SIZE) // (1024 * 1024)
+        for vdi in sr.vdis:
+            vg.add_volume(sr.lvName(vdi), sizeMB, active=False)
+
+        for cmd, fake in ((lvutil.CMD_LVS, self.fakeLvs),
+                          (lvutil.CMD_VGS, self.fakeVgs)):
+            context.add_executable(os.path.join(lvutil.LVM_BIN, cmd), fake)
+        for path in (vhdutil.VHD_UTIL, "vhd-util"):
+            context.add_executable(path, self.fakeVhdUtil)
+        for path in ("ls", shutil.which("ls")):
+            context.add_executable(path, self.fakeLs)
+
+    def fakeLvs(self, args, stdin):
+        assert "json" in args
+        vg = self.lvSystem.get_volume_group(args[-1][len("/dev/"):])
+        lvs = [{"lv_name": lv.name,
+                "lv_size": str(lv.size_mb * 1024 * 1024),
+                "lv_attr": "-wi-a-----" if lv.active else "-wi-------",
+                "lv_uuid": "uuid-" + lv.name,
+                "lv_tags": lv.tag or ""} for lv in vg.volumes]
+        return 0, json.dumps({"report": [{"lv": lvs}]}), ""
+
+    def fakeVgs(self, args, stdin):
+        used = sum(lv.size_mb for lv in
+                   self.lvSystem.get_volume_group(args[-1]).volumes)
+        return 0, "  %s 1 %d 0 wz--n- %d %d\n" % (
+            args[-1], len(self.sr.vdis), VG_SIZE,
+            VG_SIZE - used * 1024 * 1024), ""
+
+    def fakeLs(self, args, stdin):
+        return 0, "".join(name + "\n" for name in os.listdir(args[1])), ""
+
+    def fakeVhdUtil(self, args, stdin):
+        if args[1] == "read" and "-B" in args:
+            # half of the blocks allocated
+            return 0, b"\x55" * (VDI_SIZE // vhdutil.VHD_BLOCK_SIZE // 8), b""
+        if args[1] != "scan":
+            return 1, "", "%s is not faked" % args[1]
+        if "-l" in args:
+            def pathOf(vdi):
+                return self.sr.lvName(vdi)
+        else:
+            def pathOf(vdi):
+                return os.path.join(self.fileDir, vdi.uuid + ".vhd")
+        return 0, self.sr.vhdScan(pathOf, "-a" in args), ""
+
+
+class Benchmark:
+    def __init__(self, context, repeat):
+        self.context = context
+        self.repeat = repeat
+        self.results = dict()
+
+    def run(self, name, setup, operation):
+        """Time operation(setup()), keeping the best time out of 'repeat'
+        runs. Only the commands run by the operation are counted"""
+        times = []
+        commands = None
+        for _ in range(self.repeat):
+            state = setup()
+            self.context.commands.clear()
+            start = time.perf_counter()
+            operation(state)
+            times.append(time.perf_counter() - start)
+            if commands is None:
+                commands = dict(self.context.commands)
+        self.results[name] = {"seconds": min(times), "commands": commands}
+
+
+def makeXapiSession():
+    session = mock.MagicMock()
+    session.xenapi.SR.get_other_config.return_value = {}
+    session.xenapi.SR.get_sm_config.return_value = {"allocation": "thick"}
+    # the VDIs are all introduced by the scan
+    session.xenapi.VDI.get_all_records_where.return_value = {}
+    return session
+
+
+def makeSRCommand(dconf):
+    srcmd = mock.Mock()
+    srcmd.dconf = dconf
+    srcmd.params = {"command": "sr_scan", "session_ref": "session-ref",
+                    "sr_ref": "sr-ref"}
+    return srcmd
+
+
+def benchmarkLVHD(benchmark):
+    def newCache():
+        return lvmcache.LVMCache(VG_NAME)
+
+    benchmark.run("LVMCache.refresh", newCache,
+                  lambda cache: cache.refresh(direct=True))
+
+    def newSR():
+        srcmd = makeSRCommand({"device": "/dev/bench", "SRmaster": "true"})
+        return LVHDSR.LVHDSR(srcmd, SR_UUID)
+
+    benchmark.run("LVHDSR.scan", newSR, lambda sr: sr.scan(SR_UUID))
+
+    xapi = mock.MagicMock()
+    xapi.srRecord = {"name_label": "bench", "other_config": {}}
+    xapi.getConfigVDI.return_value = {}
+
+    def newGCSR():
+        return cleanup.LVHDSR(SR_UUID, xapi, False, True)
+
+    def newScannedGCSR():
+        sr = newGCSR()
+        sr.scan()
+        return sr
+
+    benchmark.run("cleanup.SR.scan", newGCSR, lambda sr: sr.scan())
+    benchmark.run("cleanup.SR.scan(incremental)", newScannedGCSR,
+                  lambda sr: sr.scan(incremental=True))
+    benchmark.run("cleanup.SR.findCoalesceable", newScannedGCSR,
+                  lambda sr: sr.findCoalesceable())
+    benchmark.run("cleanup.SR.findGarbage", newScannedGCSR,
+                  lambda sr: sr.findGarbage())
+
+    def newSearchedGCSR():
+        sr = newScannedGCSR()
+        sr.findCoalesceable()
+        return sr
+
+    def searchAgain(sr):
+        sr.scanLocked(incremental=True)
+        return sr.findCoalesceable()
+
+    # what the next iterations of the GC loop do when the VHD trees did not
+    # change
+    benchmark.run("cleanup.SR.findCoalesceable(again)", newSearchedGCSR,
+                  searchAgain)
+
+
+def benchmarkFileSR(benchmark, sr, fileDir, cacheDir):
+    # older than the racy window of the VHD info cache
+    mtime = time.time() - 3600
+    for vdi in sr.vdis:
+        path = os.path.join(fileDir, vdi.uuid + ".vhd")
+        parent = None
+        if vdi.parent:
+            parent = os.path.join(fileDir, vdi.parent.uuid + ".vhd")
+        write_vhd(path, hidden=int(vdi.hidden), parent=parent)
+        os.utime(path, (mtime, mtime))
+
+    def newSR():
+        srcmd = makeSRCommand({"location": fileDir})
+        fileSR = FileSR.FileSR(srcmd, SR_UUID)
+        fileSR.path = fileDir
+        return fileSR
+
+    def newUncachedSR():
+        for name in os.listdir(cacheDir):
+            os.unlink(os.path.join(cacheDir, name))
+        return newSR()
+
+    benchmark.run("FileSR._loadvdis", newUncachedSR,
+                  lambda fileSR: fileSR._loadvdis())
+    benchmark.run("FileSR._loadvdis(cached)", newSR,
+                  lambda fileSR: fileSR._loadvdis())
+
+
+def benchmarkMetadata(benchmark, sr):
+    srInfo = {"allocation": "thick", "uuid": SR_UUID,
+               "name_label": "bench", "name_description": ""}
+    vdiInfo = dict((vdi.uuid, makeVdiMetadata(vdi.uuid)) for vdi in sr.vdis)
+    context = LVMMetadataTestContext()
+    context.start()
+    try:
+        def newMetadata():
+            srmetadata.LVMMetadataHandler(
+                context.METADATA_PATH).writeMetadata(srInfo, vdiInfo)
+            return srmetadata.LVMMetadataHandler(context.METADATA_PATH)
+
+        newUuid = str(uuid.UUID(int=len(sr.vdis) + 1))
+        benchmark.run("srmetadata.addVdi", newMetadata,
+                      lambda handler: handler.addVdi(
+                          makeVdiMetadata(newUuid)))
+        benchmark.run("srmetadata.deleteVdiFromMetadata", newMetadata,
+                      lambda handler: handler.deleteVdiFromMetadata(
+                          sr.vdis[len(sr.vdis) // 2].uuid))
+    finally:
+        context.stop()
+
+
+def makeVdiMetadata(vdiUuid):
+    return {"uuid": vdiUuid, "name_label": "VDI " + vdiUuid,
+            "name_description": "", "is_snapshot": "0", "snapshot_of": "",
+            "snapshot_time": "", "type": "user", "vdi_type": "vhd",
+            "read_only": "0", "metadata_of_pool": "", "managed": "1"}
+
+
+def runBenchmarks(numVDIs, depth, repeat):
+    sr = SyntheticSR(numVDIs, depth)
+    context = BenchmarkContext()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        fileDir = os.path.join(tmpDir, SR_UUID)
+        cacheDir = os.path.join(tmpDir, "vhdcache")
+        os.mkdir(fileDir)
+        os.mkdir(cacheDir)
+        FakeStorage(context, sr, fileDir)
+        benchmark = Benchmark(context, repeat)
+        patchers = [
+            mock.patch('util.SMlog'),
+            mock.patch('lvutil.Fairlock'),
+            # the devices of the LVs do not exist
+            mock.patch('lvutil._checkActive', return_value=True),
+            mock.patch('LVHDSR.Lock'),
+            # not run through util
+            mock.patch('LVHDSR.LVHDSR._kickGC'),
+            mock.patch('FileSR.Lock'),
+            mock.patch('SR.XenAPI.xapi_local', new=makeXapiSession),
+            mock.patch('LVHDSR.scsiutil.getsize', return_value=VG_SIZE),
+            mock.patch.object(lvmcached, 'API_SOCKET',
+                              os.path.join(tmpDir, "lvmcached.sock")),
+            mock.patch.object(lvmcached, 'KICK_FIFO',
+                              os.path.join(tmpDir, "lvmcached.kick")),
+            mock.patch.object(vhdcache, 'CACHE_DIR', cacheDir),
+            mock.patch.object(lock.Lock, 'BASE_DIR',
+                              os.path.join(tmpDir, "lock")),
+            mock.patch.object(RefCounter, 'BASE_DIR',
+                              os.path.join(tmpDir, "refcount"))
+        ]
+        for patcher in patchers:
+            patcher.start()
+        context.start()
+        try:
+            benchmarkLVHD(benchmark)
+            benchmarkFileSR(benchmark, sr, fileDir, cacheDir)
+        finally:
+            context.stop()
+            for patcher in reversed(patchers):
+                patcher.stop()
+        with mock.patch('util.SMlog'):
+            benchmarkMetadata(benchmark, sr)
+    return {"parameters": {"vdis": numVDIs, "depth": depth,
+                           "repeat": repeat},
+            "operations": benchmark.results}
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of 'results' against 'baseline'"""
+    regressions = []
+    for name, base in sorted(baseline["operations"].items()):
+        result = results["operations"].get(name)
+        if result is None:
+            continue
+        for binary in sorted(set(base["commands"]) | set(result["commands"])):
+            before = base["commands"].get(binary, 0)
+            after = result["commands"].get(binary, 0)
+            if after > before:
+                regressions.append("%s: %d %s commands instead of %d" %
+                                   (name, after, binary, before))
+        slowdown = result["seconds"] - base["seconds"]
+        if slowdown > MIN_SLOWDOWN and \
+                slowdown > base["seconds"] * tolerance:
+            regressions.append("%s: %.6fs instead of %.6fs" %
+                               (name, result["seconds"], base["seconds"]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the SR hot paths")
+    parser.add_argument("-n", "--vdis", type=int, default=100,
+                        help="number of VDIs in the SR")
+    parser.add_argument("-d", "--depth", type=int, default=3,
+                        help="depth of the VHD chains")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="number of runs of each operation")
+    parser.add_argument("-o", "--output", help="file to write the results to")
+    parser.add_argument("-b", "--baseline",
+                        help="results of a previous run to compare with")
+    parser.add_argument("-t", "--tolerance", type=float,
+                        default=DEFAULT_TOLERANCE,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline["parameters"]["vdis"], baseline["parameters"]["depth"]) \
+                != (args.vdis, args.depth):
+            parser.error("the baseline was run with %s" %
+                         baseline["parameters"])
+
+    results = runBenchmarks(args.vdis, args.depth, args.repeat)
+    for name, result in results["operations"].items():
+        commands = ", ".join("%s: %d" % item for item in
+                             sorted(result["commands"].items()))
+        print("%-36s %10.6fs  %s" % (name, result["seconds"],
+                                     commands or "no commands"))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,6 +4,7 @@ Unit tests for the Base ISCSI SR
 
 from sm_typing import override
 
+import threading
 from unittest import mock
 from uuid import uuid4
 
@@ -107,6 +108,101 @@ class TestBaseISCSI(ISCSITestCase):
         # Assert
         self.assertEqual(107, srose.exception.errno)
 
+    def setup_portals(self, unreachable):
+        def testHost(hostname, port, errstring):
+            if hostname in unreachable:
+                raise xs_errors.XenError(errstring)
+
+        self.mock_util._testHost.side_effect = testHost
+        self.setup_path_mocks()
+        self.path_contents.update(
+            {'/dev/disk/by-scsid/3600a098038313577792450384a4a6275': ['sdb']})
+        self.discovery_data = {
+            'tgt2': [
+                ('tgt1:3260', 1, 'iqn.2009-11.com.infinidat:storage:infinibox-sn-3393'),
+                ('tgt2:3260', 1, 'iqn.2009-11.com.infinidat:storage:infinibox-sn-3393'),
+                ('tgt3:3260', 1, 'iqn.2009-11.com.infinidat:storage:infinibox-sn-3393')],
+        }
+        self.create_test_sr(self.create_sr_command(
+            additional_dconf={'multihomed': 'true'},
+            cmd='sr_attach',
+            multihomelist='tgt1:3260,tgt2:3260,tgt3:3260',
+            target_iqn='iqn.2009-11.com.infinidat:storage:infinibox-sn-3393'))
+
+    @mock.patch('BaseISCSI.BaseISCSISR._initPaths', autospec=True)
+    def test_attach_portals_probed(self, mock_init_paths):
+        """
+        The unreachable portals are skipped
+        """
+        self.setup_portals(unreachable=['tgt1'])
+
+        self.subject.attach(self.sr_uuid)
+
+        self.assertEqual('tgt2', self.subject.target)
+        self.assertEqual(['tgt2:3260', 'tgt3:3260'], sorted(
+            c[0][0] for c in self.mock_iscsilib.login.call_args_list))
+
+        # udev is let settle once the devices of the sessions showed up
+        self.assertEqual(['wait_for_event', 'udev_settle'], [
+            c[0] for c in self.mock_util.mock_calls
+            if c[0] in ('wait_for_event', 'udev_settle')])
+        devs_created = self.mock_util.wait_for_event.call_args[0][0]
+        iqn = 'iqn.2009-11.com.infinidat:storage:infinibox-sn-3393'
+        self.path_contents['/dev/iscsi/%s/tgt2:3260' % iqn] = ['LUN0']
+        self.assertFalse(devs_created())
+        self.path_contents['/dev/iscsi/%s/tgt3:3260' % iqn] = ['LUN0']
+        self.assertTrue(devs_created())
+
+    @mock.patch('BaseISCSI.BaseISCSISR._initPaths', autospec=True)
+    def test_attach_probe_not_waited(self, mock_init_paths):
+        """
+        The probes of the portals after the first reachable one are not
+        waited for
+        """
+        self.setup_portals(unreachable=['tgt1'])
+        testHostUnreachable = self.mock_util._testHost.side_effect
+        release = threading.Event()
+        self.addCleanup(release.set)
+        probed = []
+        finished = []
+
+        def testHost(hostname, port, errstring):
+            if hostname == 'tgt3' and hostname not in probed:
+                probed.append(hostname)
+                release.wait(10)
+                finished.append(hostname)
+            testHostUnreachable(hostname, port, errstring)
+
+        self.mock_util._testHost.side_effect = testHost
+
+        self.subject.attach(self.sr_uuid)
+
+        self.assertEqual([], finished)
+        self.assertEqual('tgt2', self.subject.target)
+
+    @mock.patch('BaseISCSI.BaseISCSISR._initPaths', autospec=True)
+    def test_attach_login_failure(self, mock_init_paths):
+        """
+        A login failure is fatal, the sessions opened through the other
+        portals are closed
+        """
+        self.setup_portals(unreachable=['tgt1'])
+
+        def login(target, *args):
+            if target == 'tgt3:3260':
+                raise Exception('ISCSI login failed')
+            self.iscsi_login(target, *args)
+
+        self.mock_iscsilib.login.side_effect = login
+        self.mock_iscsilib.logout.side_effect = Exception('logout failed')
+
+        with self.assertRaisesRegex(Exception, 'ISCSI login failed'):
+            self.subject.attach(self.sr_uuid)
+
+        self.assertEqual(2, self.mock_iscsilib.login.call_count)
+        self.mock_iscsilib.logout.assert_called_once_with(
+            'tgt2:3260', 'iqn.2009-11.com.infinidat:storage:infinibox-sn-3393')
+
     def test_sr_attach_multi_session(self):
         # Arrange
         self.mock_util.find_my_pbd.return_value = 'my_pbd'
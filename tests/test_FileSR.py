@@ -361,9 +361,11 @@ class TestFileVDI(unittest.TestCase):
         expected_path = f"sr_path/{vdi_uuid}.vhd"
         mock_open.assert_called_with(expected_path, 'w')
 
+    @mock.patch("FileSR.vhdutil.getCachedVHDInfo", autospec=True,
+                return_value=None)
     @mock.patch("FileSR.util.pathexists", autospec=True)
     @mock.patch("FileSR.os.chdir", autospec=True)
-    def test_vdi_load_vhd(self, mock_chdir, mock_pathexists):
+    def test_vdi_load_vhd(self, mock_chdir, mock_pathexists, mock_cached):
         # Arrange
         self.mock_pread.return_value = """10240
 /dev/VG_XenStorage-602fa2e9-2f9e-84af-ac1d-de4616cdcccb/VHD-155a6d00-2f70-411f-9bc7-3fa51fa543ca has no parent
@@ -561,7 +563,7 @@ class TestShareFileSR(unittest.TestCase):
         }
         self.mock_glob.glob.return_value = []
 
-        self.mock_vhdutil.getAllVHDs.return_value = test_vhds
+        self.mock_vhdutil.getAllVHDsCached.return_value = test_vhds
 
         # Act
         test_sr.scan(self.sr_uuid)
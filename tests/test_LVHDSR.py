@@ -104,6 +104,38 @@ class TestLVHDSR(unittest.TestCase, Stubs):
         sr._undoAllInflateJournals()
         self.assertEqual(0, mock_lvhdutil_lvRefreshOnAllSlaves.call_count)
 
+    @mock.patch('LVHDSR.util.call_plugin_on_hosts', autospec=True)
+    @mock.patch('LVHDSR.util.get_this_host_ref', autospec=True)
+    @mock.patch('lvutil.Fairlock', autospec=True)
+    @mock.patch('LVHDSR.Lock', autospec=True)
+    @mock.patch('SR.XenAPI')
+    def test_update_slaves(self, mock_xenapi, mock_lock, mock_lvlock,
+                           mock_host_ref, mock_call_plugin):
+        """The slaves are updated at once, the master is skipped"""
+        mock_host_ref.return_value = 'master-ref'
+        mock_call_plugin.return_value = ['True', 'True']
+        sr = self.create_LVHDSR(sr_uuid='sr-uuid')
+        hostRefs = ['host1-ref', 'master-ref', 'host2-ref']
+
+        sr._updateSlavesOnClone(hostRefs, 'VHD-orig', 'VHD-orig', 'base-uuid',
+                                'VHD-base')
+
+        mock_call_plugin.assert_called_once_with(
+            ['host1-ref', 'host2-ref'], 'on-slave', 'multi',
+            {'vgName': 'VG_XenStorage-sr-uuid',
+             'action1': 'refresh',
+             'lvName1': 'VHD-orig',
+             'action2': 'activate',
+             'ns2': lvhdutil.NS_PREFIX_LVM + 'sr-uuid',
+             'lvName2': 'VHD-base',
+             'uuid2': 'base-uuid'},
+            desc='Updating VHD-orig, VHD-orig, VHD-base on slave')
+
+        # A plugin failure on any slave is raised
+        mock_call_plugin.return_value = ['True', '']
+        with self.assertRaisesRegex(Exception, 'plugin on-slave failed'):
+            sr._updateSlavesOnRemove(hostRefs, 'base-uuid', 'VHD-base')
+
     @mock.patch('LVHDSR.cleanup', autospec=True)
     @mock.patch('LVHDSR.IPCFlag', autospec=True)
     @mock.patch('LVHDSR.Lock', autospec=True)
@@ -206,7 +238,7 @@ class TestLVHDSR(unittest.TestCase, Stubs):
         self.stubout('LVHDSR.Fairlock')
         mock_remove_device = self.stubout(
             'LVHDSR.lvutil.removeDevMapperEntry')
-        mock_glob = self.stubout('glob.glob')
+        mock_glob = self.stubout('LVHDSR.glob').glob
         mock_vdi_uuid = "72101dbd-bd62-4a14-a03c-afca8cceec86"
         mock_filepath = os.path.join(
             '/dev/mapper/', 'VG_XenStorage'
@@ -365,6 +397,32 @@ class TestLVHDVDI(unittest.TestCase, Stubs):
         test_vhdInfo.hidden = hidden
         self.mock_vhdutil.getVHDInfo.return_value = test_vhdInfo
 
+    @mock.patch('LVHDSR.Lock', autospec=True)
+    @mock.patch('SR.XenAPI')
+    def test_chain_set_active(self, mock_xenapi, mock_lock):
+        vdi_uuid = 'some VDI UUID'
+        self.get_dummy_vdi(vdi_uuid)
+        self.get_dummy_vhd(vdi_uuid, False)
+        sr = self.create_LVHDSR()
+        vdi = sr.vdi(vdi_uuid)
+        vdi.vdi_type = vhdutil.VDI_TYPE_VHD
+        self.mock_vhdutil.getParentChain.return_value = {
+            vdi_uuid: 'VHD-leaf', 'parent UUID': 'VHD-parent'}
+        sr.lvActivator = mock.MagicMock()
+
+        vdi._chainSetActive(True, False, True)
+
+        sr.lvActivator.activateMany.assert_called_once_with(
+            [(vdi_uuid, 'VHD-leaf', False),
+             ('parent UUID', 'VHD-parent', False)], True)
+
+        vdi._chainSetActive(False, False)
+
+        sr.lvActivator.add.assert_has_calls([
+            mock.call(vdi_uuid, 'VHD-leaf', False),
+            mock.call('parent UUID', 'VHD-parent', False)])
+        sr.lvActivator.activateMany.assert_called_once()
+
     @mock.patch('LVHDSR.Lock', autospec=True)
     @mock.patch('SR.XenAPI')
     def test_clone_success(self, mock_xenapi, mock_lock):
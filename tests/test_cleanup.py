@@ -1,7 +1,12 @@
 from sm_typing import Dict, List, override
 
 import errno
+import os
 import signal
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock as mock
 import uuid
@@ -10,6 +15,7 @@ from uuid import uuid4
 
 import cleanup
 import lock
+import lvhdutil
 
 import util
 import vhdutil
@@ -74,7 +80,7 @@ class TestSR(unittest.TestCase):
         self.mock_blktap2 = blktap2_patcher.start()
 
         self.xapi_mock = mock.MagicMock(name='MockXapi')
-        self.xapi_mock.srRecord = {'name_label': 'dummy'}
+        self.xapi_mock.srRecord = {'name_label': 'dummy', 'other_config': {}}
         self.xapi_mock.isPluggedHere.return_value = True
         self.xapi_mock.isMaster.return_value = True
         self.mock_xapi_session = mock.MagicMock(name="MockSession")
@@ -275,6 +281,35 @@ class TestSR(unittest.TestCase):
 
         self.assertEqual(0, sr._locked)
 
+    def test_lock_held_by_one_thread(self):
+        """
+        Another thread waits for the SR lock to be released
+        """
+
+        self.setup_abort_flag(self.mock_IPCFlag)
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr._srLock = mock.MagicMock()
+        sr._srLock.acquireNoblock.return_value = True
+        locked = threading.Event()
+
+        def lockInThread():
+            sr.lock()
+            locked.set()
+            sr.unlock()
+
+        sr.lock()
+        sr.lock()
+        thread = threading.Thread(target=lockInThread)
+        thread.start()
+        sr.unlock()
+        self.assertFalse(locked.wait(0.1))
+        sr.unlock()
+        thread.join()
+
+        self.assertTrue(locked.is_set())
+        self.assertEqual(0, sr._locked)
+        self.assertEqual(2, sr._srLock.release.call_count)
+
     def test_gcPause_fist_point_legal(self):
         """
         Make sure the fist point has been added to the array of legal
@@ -1025,7 +1060,9 @@ class TestSR(unittest.TestCase):
         sr.writeSpeedToFile = mock.MagicMock(autospec=True)
         sr.recordStorageSpeed(1, 6, 9)
         self.assertEqual(sr.writeSpeedToFile.call_count, 1)
-        sr.writeSpeedToFile.assert_called_with(1.8)
+        sr.writeSpeedToFile.assert_called_with(1.8, False)
+        sr.recordStorageSpeed(1, 6, 9, live=True)
+        sr.writeSpeedToFile.assert_called_with(1.8, True)
 
     def makeFakeFile(self):
         FakeFile.writelines = mock.MagicMock()
@@ -1077,7 +1114,15 @@ class TestSR(unittest.TestCase):
 
         # File exists 3 values
         self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             True, 3.0, 1, lines=["1.0", "2.0", "6.0"])
+                             True, 2.0, 1, lines=["2.0", "2.0", "2.0"])
+
+        # File exists 3 values, too variable to be predicted
+        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
+                             True, None, 1, lines=["1.0", "2.0", "6.0"])
+
+        # File exists, bad mode
+        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
+                             True, None, 1, lines=["1.0 1000 paused"])
 
         # File exists contains, a string
         self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
@@ -1124,21 +1169,25 @@ class TestSR(unittest.TestCase):
     @mock.patch("util.atomicFileWrite", autospec=True)
     @mock.patch("cleanup.SR.lock", autospec=True)
     @mock.patch("cleanup.SR.unlock", autospec=True)
-    def test_writeSpeedToFile(self, mock_lock, mock_unlock, mock_atomicWrite,
-                              mock_isFile, mock_open):
+    @mock.patch("cleanup.N_SPEED_SAMPLES", 10)
+    @mock.patch("cleanup.time.time", autospec=True, return_value=1000)
+    def test_writeSpeedToFile(self, mock_time, mock_lock, mock_unlock,
+                              mock_atomicWrite, mock_isFile, mock_open):
         sr_uuid = uuid4()
         sr = create_cleanup_sr(self.xapi_mock, uuid=str(sr_uuid))
         FakeFile = self.makeFakeFile()
         mock_open.return_value = FakeFile
+        sr._speedLogSample = [(1.0, 900, False)]
 
         # File does not exist
         self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile,
                             False, mock_open, mock_atomicWrite,
-                            write="1.8\n", openOp="w")
+                            write="1.8 1000 offline\n", openOp="w")
+        self.assertIsNone(sr._speedLogSample)
 
         # File does exist but empty (Should not happen)
         readLines = []
-        write = "1.8\n"
+        write = "1.8 1000 offline\n"
         self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
                             mock_open, mock_atomicWrite, readLines=readLines,
                             write=write)
@@ -1158,7 +1207,7 @@ class TestSR(unittest.TestCase):
 
         # File does exist
         readLines = ["1.9\n", "2.1\n", "3\n"]
-        write = "1.9\n2.1\n3\n1.8\n"
+        write = "1.9\n2.1\n3\n1.8 1000 offline\n"
         self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
                             mock_open, mock_atomicWrite, readLines=readLines,
                             write=write)
@@ -1174,7 +1223,8 @@ class TestSR(unittest.TestCase):
                      "2.7\n",
                      "2.8\n"]
 
-        write = "2.0\n2.1\n2.2\n2.3\n2.4\n2.5\n2.6\n2.7\n2.8\n1.8\n"
+        write = "2.0\n2.1\n2.2\n2.3\n2.4\n2.5\n2.6\n2.7\n2.8\n" \
+                "1.8 1000 offline\n"
 
         self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
                             mock_open, mock_atomicWrite, readLines=readLines,
@@ -1193,12 +1243,138 @@ class TestSR(unittest.TestCase):
                      "1.9\n",
                      "1.9\n"]
 
-        write = "1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.8\n"
+        write = "1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n" \
+                "1.8 1000 offline\n"
 
         self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
                             mock_open, mock_atomicWrite, readLines=readLines,
                             write=write)
 
+    @staticmethod
+    def speedSample(speed, hour, live):
+        return (speed, int(time.mktime((2024, 1, 1, hour, 30, 0, 0, 0, -1))),
+                live)
+
+    def test_parseSpeedSample(self):
+        self.assertEqual((1.5, None, False),
+                         cleanup.SR.parseSpeedSample("1.5\n"))
+        self.assertEqual((1.5, 1000, True),
+                         cleanup.SR.parseSpeedSample("1.5 1000 live\n"))
+        self.assertEqual((1.5, 1000, False),
+                         cleanup.SR.parseSpeedSample("1.5 1000 offline\n"))
+        for line in ["", "1.5 1000", "1.5 1000 paused", "fast 1000 live"]:
+            with self.assertRaises(ValueError):
+                cleanup.SR.parseSpeedSample(line)
+
+    def test_predictStorageSpeed(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        busy = [self.speedSample(10.0, 9, False) for _ in range(5)]
+        quiet = [self.speedSample(100.0, 2, True) for _ in range(3)]
+
+        self.assertIsNone(sr.predictStorageSpeed(None, 2))
+        # Live samples of the time of day first
+        self.assertEqual(100.0, sr.predictStorageSpeed(busy + quiet, 3))
+        # Then any sample of the time of day
+        self.assertEqual(10.0, sr.predictStorageSpeed(busy + quiet, 10))
+        # Then the live samples, then all the samples
+        self.assertEqual(100.0, sr.predictStorageSpeed(busy + quiet, 20))
+        self.assertEqual(10.0, sr.predictStorageSpeed(busy, 20))
+        self.assertEqual(10.0, sr.predictStorageSpeed(busy[:1], 9))
+        # Legacy samples, without time
+        self.assertEqual(3.0, sr.predictStorageSpeed([(3.0, None, False)], 9))
+
+        # Lower bound of the recent samples
+        samples = [self.speedSample(speed, 9, True)
+                   for speed in [60.0, 100.0, 90.0, 110.0]]
+        speed = sr.predictStorageSpeed(samples, 9)
+        self.assertLess(speed, 60.0)
+        self.assertGreater(speed, 50.0)
+        self.assertLess(sr.predictStorageSpeed(samples[-1:] + samples[:-1], 9),
+                        speed)
+
+        # Too variable
+        samples = [self.speedSample(speed, 9, True)
+                   for speed in [100.0, 1.0, 1.0]]
+        self.assertIsNone(sr.predictStorageSpeed(samples, 9))
+
+    def test_deferLeafCoalesce(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdi = cleanup.VDI(sr, str(uuid4()), False)
+        vdi.getConfig = mock.MagicMock(return_value=None)
+        vdi.setConfig = mock.MagicMock()
+        # 1 GiB to coalesce in less than 5 seconds
+        vdi.getAllocatedSize = mock.MagicMock(return_value=1 << 30)
+        samples = [self.speedSample(speed, hour, True)
+                   for hour, speed in [(9, 1 << 20), (2, 1 << 30)]
+                   for _ in range(3)]
+        real_localtime = time.localtime
+        now = None
+        patcher = mock.patch("cleanup.time.localtime", autospec=True,
+            side_effect=lambda t=None: now if t is None else real_localtime(t))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Quiet window within SPEED_MAX_DEFER_HOURS
+        now = real_localtime(self.speedSample(0, 21, True)[1])
+        self.assertTrue(sr._deferLeafCoalesce(vdi, samples))
+        vdi.setConfig.assert_called_once_with(
+            cleanup.VDI.DB_LEAFCLSC_DEFERRED, mock.ANY)
+
+        # Deferred again: the time of the first deferral is kept
+        vdi.getConfig.return_value = str(int(time.time()))
+        self.assertTrue(sr._deferLeafCoalesce(vdi, samples))
+        vdi.setConfig.assert_called_once()
+
+        # Deferred for too long already
+        vdi.getConfig.return_value = str(
+            int(time.time()) - cleanup.SPEED_MAX_DEFER_HOURS * 60 * 60)
+        self.assertFalse(sr._deferLeafCoalesce(vdi, samples))
+        vdi.getConfig.return_value = "garbage"
+        self.assertFalse(sr._deferLeafCoalesce(vdi, samples))
+        vdi.getConfig.return_value = None
+
+        # Quiet window too far away
+        now = real_localtime(self.speedSample(0, 9, True)[1])
+        self.assertFalse(sr._deferLeafCoalesce(vdi, samples))
+
+        # Quiet now
+        now = real_localtime(self.speedSample(0, 2, True)[1])
+        self.assertFalse(sr._deferLeafCoalesce(vdi, samples))
+
+        # Nothing known
+        now = real_localtime(self.speedSample(0, 21, True)[1])
+        self.assertFalse(sr._deferLeafCoalesce(vdi, []))
+
+    @mock.patch('cleanup.SR.leafCoalesceForbidden', autospec=True,
+                return_value=False)
+    @mock.patch('cleanup.SR.getFreeSpace', autospec=True, return_value=1024)
+    @mock.patch('cleanup.SR.gatherLeafCoalesceable', autospec=True)
+    def test_findLeafCoalesceable_deferred(self, mock_gatherLeafCoalesceable,
+                                           mock_getFreeSpace,
+                                           mock_leafCoalesceForbidden):
+        """
+        The speed log is read once, and a leaf-coalesce is only deferred if
+        there is enough space to snapshot-coalesce it
+        """
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.readSpeedLog = mock.MagicMock(return_value=None)
+        sr._deferLeafCoalesce = mock.MagicMock(return_value=True)
+        deferred = self.makeVDIReturningSize(sr, 4, False, 4)
+        noSpace = self.makeVDIReturningSize(sr, 4096, True, 4)
+
+        def fakeCandidates(_, candidates):
+            candidates.extend([deferred, noSpace])
+
+        mock_gatherLeafCoalesceable.side_effect = fakeCandidates
+
+        self.assertEqual(noSpace, sr.findLeafCoalesceable())
+        self.assertEqual(noSpace, sr.findLeafCoalesceable())
+
+        sr._deferLeafCoalesce.assert_has_calls([
+            mock.call(deferred, []), mock.call(deferred, [])])
+        self.assertEqual(2, sr._deferLeafCoalesce.call_count)
+        sr.readSpeedLog.assert_called_once_with()
+
     def canLiveCoalesce(self, vdi, size, config, speed, expectedRes):
         vdi.getAllocatedSize = mock.MagicMock(return_value=size)
         vdi.getConfig = mock.MagicMock(return_value=config)
@@ -1481,6 +1657,147 @@ class TestSR(unittest.TestCase):
 
         return vdis
 
+    def make_file_sr_for_scan(self, tmp_dir, uuids):
+        sr = cleanup.FileSR(str(uuid4()), self.xapi_mock, False, False)
+        sr.path = tmp_dir
+        sr.journaler = mock.MagicMock()
+        sr.journaler.getAll.return_value = {}
+        vhds = {}
+        for vdi_uuid in uuids:
+            with open(os.path.join(tmp_dir, vdi_uuid + '.vhd'), 'w') as f:
+                f.write(vdi_uuid)
+            vhds[vdi_uuid] = vhdutil.VHDInfo(vdi_uuid)
+        # uuids[0] is the parent of all the others
+        for vdi_uuid in uuids[1:]:
+            vhds[vdi_uuid].parentUuid = uuids[0]
+        return sr, vhds
+
+    @mock.patch('cleanup.vhdutil.getVHDInfo', autospec=True)
+    @mock.patch('cleanup.vhdutil.getAllVHDsCached', autospec=True)
+    def test_incremental_scan_unchanged(self, mock_getAllVHDs,
+                                        mock_getVHDInfo):
+        uuids = [str(uuid4()), str(uuid4())]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sr, vhds = self.make_file_sr_for_scan(tmp_dir, uuids)
+            mock_getAllVHDs.return_value = vhds
+
+            sr.scan()
+            child = sr.getVDI(uuids[1])
+            sr.scan(incremental=True)
+
+        mock_getAllVHDs.assert_called_once()
+        mock_getVHDInfo.assert_not_called()
+        # the tree was kept as is
+        self.assertIs(child, sr.getVDI(uuids[1]))
+        self.assertIs(sr.getVDI(uuids[0]), child.parent)
+        self.assertEqual([child], child.parent.children)
+
+    @mock.patch('cleanup.vhdutil.getVHDInfo', autospec=True)
+    @mock.patch('cleanup.vhdutil.getAllVHDsCached', autospec=True)
+    def test_incremental_scan_changed_file(self, mock_getAllVHDs,
+                                           mock_getVHDInfo):
+        uuids = [str(uuid4()), str(uuid4()), str(uuid4())]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sr, vhds = self.make_file_sr_for_scan(tmp_dir, uuids)
+            mock_getAllVHDs.return_value = vhds
+            sr.scan()
+
+            # uuids[2] got hidden by someone else, uuids[1] by us
+            path = os.path.join(tmp_dir, uuids[2] + '.vhd')
+            with open(path, 'a') as f:
+                f.write('hidden')
+            changed = {}
+            for vdi_uuid in uuids[1:]:
+                changed[vdi_uuid] = vhdutil.VHDInfo(vdi_uuid)
+                changed[vdi_uuid].parentUuid = uuids[0]
+                changed[vdi_uuid].hidden = 1
+            sr._invalidateScanCache(uuids[1])
+            mock_getVHDInfo.side_effect = \
+                lambda path, extract: changed[extract(path)]
+
+            sr.scan(incremental=True)
+
+        mock_getAllVHDs.assert_called_once()
+        self.assertEqual(2, mock_getVHDInfo.call_count)
+        self.assertFalse(sr.getVDI(uuids[0]).isHidden())
+        self.assertTrue(sr.getVDI(uuids[1]).isHidden())
+        self.assertTrue(sr.getVDI(uuids[2]).isHidden())
+        self.assertEqual(2, len(sr.getVDI(uuids[0]).children))
+
+    @mock.patch('cleanup.vhdutil.getVHDInfo', autospec=True)
+    @mock.patch('cleanup.vhdutil.getAllVHDsCached', autospec=True)
+    def test_incremental_scan_too_many_changes(self, mock_getAllVHDs,
+                                               mock_getVHDInfo):
+        uuids = [str(uuid4()), str(uuid4())]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sr, vhds = self.make_file_sr_for_scan(tmp_dir, uuids)
+            sr.INCREMENTAL_SCAN_MAX_QUERIES = 1
+            mock_getAllVHDs.return_value = vhds
+            sr.scan()
+
+            sr._invalidateScanCache(uuids[0])
+            sr._invalidateScanCache(uuids[1])
+            sr.scan(incremental=True)
+
+        self.assertEqual(2, mock_getAllVHDs.call_count)
+        mock_getVHDInfo.assert_not_called()
+
+    @mock.patch('cleanup.VDI._doCoalesceVHD', autospec=True)
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_vhd_records_speed(self, mock_abortable, mock_coalesce):
+        """
+        The coalesce timing comes back from the child process and the speed
+        is recorded by the parent
+        """
+        mock_abortable.side_effect = self.runAbortable
+        mock_coalesce.return_value = (10.0, 12.5, 4096)
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr.recordStorageSpeed = mock.MagicMock()
+        vdis = self.add_vdis_for_coalesce(sr)
+
+        vdis['vdi']._coalesceVHD(0)
+
+        mock_coalesce.assert_called_once_with(vdis['vdi'], None)
+        sr.recordStorageSpeed.assert_called_once_with(10.0, 12.5, 4096, False)
+
+    @mock.patch('cleanup.lvhdutil.getLVInfo', autospec=True)
+    @mock.patch('cleanup.lvhdutil.getVDIInfo', autospec=True)
+    @mock.patch('cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('cleanup.lvmcache.LVMCache', autospec=True)
+    def test_incremental_scan_unchanged_lvhd(self, mock_lvmcache,
+                                             mock_journaler, mock_getVDIInfo,
+                                             mock_getLVInfo):
+        """
+        The LV state of the VDIs kept from the previous scan is refreshed
+        """
+        uuids = [str(uuid4()), str(uuid4())]
+        mock_getLVInfo.return_value = dict((x, mock.MagicMock()) for x in uuids)
+        mock_journaler.return_value.getAll.return_value = {}
+
+        def get_vdi_info(lvmCache, reuse=None):
+            infos = {}
+            for vdi_uuid in uuids:
+                info = lvhdutil.VDIInfo(vdi_uuid)
+                info.vdiType = vhdutil.VDI_TYPE_VHD
+                info.lvName = 'VHD-' + vdi_uuid
+                info.lvActive = bool(reuse)
+                info.lvReadonly = bool(reuse)
+                infos[vdi_uuid] = info
+            infos[uuids[1]].parentUuid = uuids[0]
+            return infos
+
+        mock_getVDIInfo.side_effect = get_vdi_info
+        sr = cleanup.LVHDSR(str(uuid4()), self.xapi_mock, False, False)
+        sr.scan()
+        parent = sr.getVDI(uuids[0])
+        self.assertFalse(parent.lvReadonly)
+
+        sr.scan(incremental=True)
+
+        self.assertIs(parent, sr.getVDI(uuids[0]))
+        self.assertTrue(parent.lvActive)
+        self.assertTrue(parent.lvReadonly)
+
     @mock.patch('cleanup.os.unlink', autospec=True)
     @mock.patch('cleanup.util', autospec=True)
     @mock.patch('cleanup.vhdutil', autospec=True)
@@ -1530,6 +1847,347 @@ class TestSR(unittest.TestCase):
              mock.call(vdis['child'], 'vhd-parent'),
              mock.call(vdis['child'], 'relinking')])
 
+    def add_hidden_vdi_above_child(self, sr, vdis):
+        """Insert a new coalesceable VDI between vdis['vdi'] and its child"""
+        mid = cleanup.FileVDI(sr, str(uuid4()), False)
+        mid.path = '%s.vhd' % mid.uuid
+        mid._sizeAllocated = 20971520
+        mid.parent = vdis['vdi']
+        mid.children = [vdis['child']]
+        vdis['vdi'].children = [mid]
+        vdis['child'].parent = mid
+        sr.vdis[mid.uuid] = mid
+        for vdi in sr.vdis.values():
+            vdi.scanError = False
+            vdi._hidden = True
+        return mid
+
+    @mock.patch('cleanup.VDI._calcExtraSpaceForCoalescingOnto', autospec=True)
+    @mock.patch('cleanup.os.unlink', autospec=True)
+    @mock.patch('cleanup.util', autospec=True)
+    @mock.patch('cleanup.vhdutil', autospec=True)
+    @mock.patch('cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_run(
+            self, mock_abortable, mock_journaler, mock_vhdutil, mock_util,
+            mock_unlink, mock_space):
+        """
+        Multi-level coalesce of two hidden VDIs onto their ancestor
+        """
+        self.xapi_mock.getConfigVDI.return_value = {}
+        self.xapi_mock.srRecord['other_config'] = {'max_coalesce_depth': '8'}
+
+        mock_abortable.side_effect = self.runAbortable
+        mock_vhdutil.coalesce.return_value = 0
+        mock_space.return_value = 0
+
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+
+        mock_ipc_flag = mock.MagicMock(spec=ipc.IPCFlag)
+        self.mock_IPCFlag.return_value = mock_ipc_flag
+        mock_ipc_flag.test.return_value = None
+
+        vdis = self.add_vdis_for_coalesce(sr)
+        mid = self.add_hidden_vdi_above_child(sr, vdis)
+        mock_journaler.get.return_value = None
+
+        self.assertEqual((mid, vdis['parent']),
+                         sr.getCoalesceRun(vdis['vdi'], 0))
+
+        mid_uuid = mid.uuid
+        mid_path = mid.path
+        sr.coalesce(vdis['vdi'], False)
+
+        mock_vhdutil.coalesce.assert_called_once_with(
+            mid_path, vdis['parent'].path, run=None)
+        mock_journaler.create.assert_has_calls(
+            [mock.call('coalesce', mid_uuid, '1'),
+             mock.call('relink', mid_uuid, vdis['parent'].uuid)])
+        mock_journaler.remove.assert_has_calls(
+            [mock.call('coalesce', mid_uuid),
+             mock.call('relink', mid_uuid)])
+        self.assertEqual(vdis['parent'], vdis['child'].parent)
+        self.assertEqual([vdis['child']], vdis['parent'].children)
+        self.assertEqual({vdis['parent'].uuid, vdis['child'].uuid},
+                         set(sr.vdis.keys()))
+
+    @mock.patch('cleanup.VDI._calcExtraSpaceForCoalescingOnto', autospec=True)
+    def test_coalesce_run_limits(self, mock_space):
+        """
+        The coalesce runs are bounded by the depth switch and the free space
+        """
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdis = self.add_vdis_for_coalesce(sr)
+        mid = self.add_hidden_vdi_above_child(sr, vdis)
+        mock_space.return_value = 10
+
+        # Single-level by default
+        self.assertEqual((mid, vdis['vdi']), sr.getCoalesceRun(mid, 20))
+
+        self.xapi_mock.srRecord['other_config'] = {'max_coalesce_depth': '2'}
+        self.assertEqual((mid, vdis['parent']), sr.getCoalesceRun(mid, 20))
+        mock_space.assert_called_once_with(mid, vdis['parent'])
+
+        # Failed targets are not part of runs
+        sr._failedCoalesceTargets.append(vdis['vdi'])
+        self.assertEqual((mid, vdis['vdi']), sr.getCoalesceRun(mid, 20))
+        sr._failedCoalesceTargets = []
+
+        mock_space.return_value = 30
+        self.assertEqual((vdis['vdi'], vdis['parent']),
+                         sr.getCoalesceRun(vdis['vdi'], 20))
+
+    def test_get_max_coalesce_depth(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        for val, expected in [(None, 1), ("3", 3), ("100", 32), ("0", 1),
+                              ("deep", 1)]:
+            other_config = {}
+            if val is not None:
+                other_config['max_coalesce_depth'] = val
+            self.xapi_mock.srRecord['other_config'] = other_config
+            self.assertEqual(expected, sr.getMaxCoalesceDepth())
+
+    def test_or_bitmaps(self):
+        self.assertEqual(b'\x0f\xf0\x01',
+                         cleanup.Util.orBitmaps(b'\x05\x10', b'\x0a\xe0\x01'))
+
+    def add_coalesce_trees(self, sr, count):
+        """Add count VHD trees in which the middle VDI is coalesceable"""
+        trees = []
+        for _ in range(count):
+            vdis = self.add_vdis_for_coalesce(sr)
+            vdis['child'].parent = vdis['vdi']
+            trees.append(vdis)
+        return trees
+
+    @mock.patch('cleanup.VDI._calcExtraSpaceForCoalescing', autospec=True)
+    @mock.patch('cleanup.VDI.isCoalesceable', autospec=True)
+    def test_find_coalesceables(self, mock_coalesceable, mock_space):
+        """
+        The coalesce candidates are in different trees and fit in the free
+        space together
+        """
+        self.xapi_mock.srRecord['other_config'] = {}
+        self.xapi_mock.getConfigVDI.return_value = {}
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.MagicMock()
+        sr.journaler.getAll.return_value = {}
+        trees = self.add_coalesce_trees(sr, 3)
+        candidates = [trees[0]['vdi'], trees[0]['child'], trees[1]['vdi'],
+                      trees[2]['vdi']]
+        mock_coalesceable.side_effect = lambda vdi: vdi in candidates
+        mock_space.return_value = 10
+        sr.getFreeSpace = mock.MagicMock(return_value=25)
+
+        # Only two fit in the free space, one per tree
+        chosen = sr.findCoalesceables(4)
+        self.assertEqual(2, len(chosen))
+        self.assertEqual(2, len(set(vdi.getTreeRoot() for vdi in chosen)))
+        self.assertEqual({}, sr.no_space_candidates)
+
+        # A single one
+        self.assertIn(sr.findCoalesceable(), candidates)
+
+    @mock.patch('cleanup.VDI._calcExtraSpaceForCoalescing', autospec=True)
+    @mock.patch('cleanup.VDI.isCoalesceable', autospec=True)
+    def test_find_coalesceables_index(self, mock_coalesceable, mock_space):
+        """
+        The candidates and the space they need are indexed once per tree, and
+        the free space is sampled once per scan
+        """
+        self.xapi_mock.srRecord['other_config'] = {}
+        self.xapi_mock.getConfigVDI.return_value = {}
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.MagicMock()
+        sr.journaler.getAll.return_value = {}
+        trees = self.add_coalesce_trees(sr, 3)
+        # The last tree is the tallest one
+        grandchild = cleanup.FileVDI(sr, str(uuid4()), False)
+        grandchild.parent = trees[2]['child']
+        trees[2]['child'].children.append(grandchild)
+        sr.vdis[grandchild.uuid] = grandchild
+        candidates = [trees[0]['vdi'], trees[1]['vdi'], trees[2]['vdi']]
+        mock_coalesceable.side_effect = lambda vdi: vdi in candidates
+        space = {trees[0]['vdi']: 30, trees[1]['vdi']: 10,
+                 trees[2]['vdi']: 50}
+        mock_space.side_effect = lambda vdi: space[vdi]
+        sr.getFreeSpace = mock.MagicMock(return_value=100)
+
+        self.assertEqual(trees[2]['vdi'], sr.findCoalesceable())
+        self.assertEqual([trees[2]['vdi'], trees[0]['vdi'], trees[1]['vdi']],
+                         sr.findCoalesceables(3))
+        self.assertEqual(3, mock_space.call_count)
+        sr.getFreeSpace.assert_called_once_with()
+        # The 10 left are shared between the coalesce runs
+        self.assertEqual({trees[2]['vdi'].uuid: 53, trees[0]['vdi'].uuid: 33,
+                          trees[1]['vdi'].uuid: 13}, sr._coalesceBudgets)
+
+        # The failed targets are skipped, and the candidates of the same
+        # height now come by the space they need
+        sr._failedCoalesceTargets.append(trees[2]['vdi'])
+        self.assertEqual([trees[1]['vdi'], trees[0]['vdi']],
+                         sr.findCoalesceables(3))
+        self.assertEqual(3, mock_space.call_count)
+
+        # Less space after a scan
+        sr.getFreeSpace.return_value = 20
+        sr.scanLocked()
+        self.assertEqual([trees[1]['vdi']], sr.findCoalesceables(3))
+        self.assertEqual(2, sr.getFreeSpace.call_count)
+        self.assertEqual({trees[0]['vdi'].uuid: trees[0]['vdi']},
+                         sr.no_space_candidates)
+
+        # Everything is computed again once the trees change
+        sr.invalidateIndex()
+        sr.findCoalesceables(3)
+        self.assertEqual(5, mock_space.call_count)
+
+    def test_get_max_parallel_coalesce(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        for val, expected in [(None, 1), ("3", 3), ("100", 8), ("0", 1),
+                              ("many", 1)]:
+            other_config = {}
+            if val is not None:
+                other_config['max_parallel_coalesce'] = val
+            self.xapi_mock.srRecord['other_config'] = other_config
+            self.assertEqual(expected, sr.getMaxParallelCoalesce())
+
+    @mock.patch('cleanup.os.unlink', autospec=True)
+    @mock.patch('cleanup.util', autospec=True)
+    @mock.patch('cleanup.vhdutil', autospec=True)
+    @mock.patch('cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('cleanup.Util.runAbortableCmd', autospec=True)
+    @mock.patch('cleanup.Util.runAbortable')
+    def test_coalesce_parallel(
+            self, mock_abortable, mock_abortable_cmd, mock_journaler,
+            mock_vhdutil, mock_util, mock_unlink):
+        """
+        Non-leaf coalesce of two trees at once, the workers run vhd-util
+        without forking
+        """
+        self.xapi_mock.getConfigVDI.return_value = {}
+        mock_vhdutil.coalesce.side_effect = \
+            lambda path, run=None: run(["vhd-util", "coalesce", path])
+        mock_abortable_cmd.return_value = "0"
+
+        sr_uuid = str(uuid4())
+        sr = create_cleanup_sr(self.xapi_mock, uuid=sr_uuid)
+        sr.journaler = mock_journaler
+        sr.cleanup = mock.MagicMock()
+
+        mock_ipc_flag = mock.MagicMock(spec=ipc.IPCFlag)
+        self.mock_IPCFlag.return_value = mock_ipc_flag
+        mock_ipc_flag.test.return_value = None
+
+        trees = self.add_coalesce_trees(sr, 2)
+        vdi_uuids = [vdis['vdi'].uuid for vdis in trees]
+        vdi_paths = [vdis['vdi'].path for vdis in trees]
+        mock_journaler.get.return_value = None
+
+        sr.coalesceParallel([vdis['vdi'] for vdis in trees], False)
+
+        for vdis, vdi_uuid in zip(trees, vdi_uuids):
+            mock_journaler.create.assert_any_call('coalesce', vdi_uuid, '1')
+            mock_journaler.remove.assert_any_call('relink', vdi_uuid)
+            self.assertNotIn(vdi_uuid, sr.vdis)
+            self.assertEqual(vdis['parent'], vdis['child'].parent)
+        mock_abortable.assert_not_called()
+        self.assertEqual(sorted(vdi_paths), sorted(
+            c[0][0][2] for c in mock_abortable_cmd.call_args_list))
+        sr.cleanup.assert_called_once_with()
+        self.assertFalse(sr.inParallelCoalesce())
+
+    @mock.patch('cleanup.os.unlink', autospec=True)
+    @mock.patch('cleanup.util', autospec=True)
+    @mock.patch('cleanup.vhdutil', autospec=True)
+    @mock.patch('cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('cleanup.Util.runAbortableCmd', autospec=True)
+    def test_coalesce_parallel_abort(
+            self, mock_abortable_cmd, mock_journaler, mock_vhdutil, mock_util,
+            mock_unlink):
+        """
+        An aborted worker aborts the parallel coalesce, the failed ones are
+        skipped
+        """
+        mock_util.SMException = util.SMException
+        mock_util.CommandException = util.CommandException
+        self.xapi_mock.getConfigVDI.return_value = {}
+
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        sr.cleanup = mock.MagicMock()
+        trees = self.add_coalesce_trees(sr, 2)
+        mock_journaler.get.return_value = None
+        mock_vhdutil.getParent.return_value = trees[0]['parent'].path
+        mock_vhdutil.coalesce.side_effect = \
+            lambda path, run=None: run(["vhd-util", "coalesce", path])
+        timed_out_path = trees[0]['vdi'].path
+
+        def run_abortable_cmd(cmd, abortTest, pollInterval, timeOut):
+            if cmd[2] == timed_out_path:
+                raise util.SMException("Timed out")
+            raise cleanup.AbortException("Aborting due to signal")
+
+        mock_abortable_cmd.side_effect = run_abortable_cmd
+
+        with self.assertRaises(cleanup.AbortException):
+            sr.coalesceParallel([vdis['vdi'] for vdis in trees], False)
+
+        self.assertEqual([trees[0]['vdi']], sr._failedCoalesceTargets)
+        sr.cleanup.assert_called_once_with()
+
+    def test_run_abortable_cmd(self):
+        self.assertEqual("out\n", cleanup.Util.runAbortableCmd(
+            ["sh", "-c", "echo out"], lambda: False, 0.01, 0))
+
+        with self.assertRaises(util.CommandException) as ce:
+            cleanup.Util.runAbortableCmd(
+                ["sh", "-c", "echo failed >&2; exit 5"], lambda: False, 0.01,
+                0)
+        self.assertEqual(5, ce.exception.code)
+        self.assertEqual("failed", ce.exception.reason)
+
+    def test_run_abortable_cmd_killed(self):
+        """
+        The command is killed once aborted or timed out
+        """
+        procs = []
+        popen = subprocess.Popen
+
+        def start_process(*args, **kwargs):
+            procs.append(popen(*args, **kwargs))
+            return procs[-1]
+
+        with mock.patch('cleanup.subprocess.Popen', side_effect=start_process):
+            with self.assertRaises(cleanup.AbortException):
+                cleanup.Util.runAbortableCmd(["sleep", "10"], lambda: True,
+                                             0.01, 0)
+            with self.assertRaisesRegex(util.SMException, "Timed out"):
+                cleanup.Util.runAbortableCmd(["sleep", "10"], lambda: False,
+                                             0.01, 0.1)
+
+        self.assertEqual([-signal.SIGKILL, -signal.SIGKILL],
+                         [proc.returncode for proc in procs])
+
+    @mock.patch('cleanup.SR.getInstance', autospec=True)
+    def test_should_preempt_parallel_coalesce(self, mock_get_instance):
+        mock_sr = mock.MagicMock(spec=cleanup.SR)
+        mock_sr.journaler = mock.MagicMock()
+        mock_sr.journaler.getAll.return_value = {'uuid1': '1', 'uuid2': '1'}
+        garbage = mock.MagicMock()
+        garbage.uuid = 'uuid2'
+        mock_sr.findGarbage.return_value = [garbage]
+        mock_get_instance.return_value = mock_sr
+
+        self.assertTrue(cleanup.should_preempt(None, 'sr_uuid'))
+
+        garbage.uuid = 'uuid3'
+        self.assertFalse(cleanup.should_preempt(None, 'sr_uuid'))
+
+        mock_sr.journaler.getAll.return_value = {}
+        self.assertFalse(cleanup.should_preempt(None, 'sr_uuid'))
+
     @mock.patch('cleanup.os.unlink', autospec=True)
     @mock.patch('cleanup.util', autospec=True)
     @mock.patch('cleanup.vhdutil', autospec=True)
@@ -1611,6 +2269,24 @@ class TestSR(unittest.TestCase):
         self.assertIn(vdis['vdi'], sr._failedCoalesceTargets)
         self.assertEqual(0, mock_vhdutil.repair.call_count)
 
+    @mock.patch('cleanup.journaler.Journaler', autospec=True)
+    def test_coalesce_relink_target_missing(self, mock_journaler):
+        """
+        An interrupted coalesce is not resumed onto the wrong VDI when the
+        ancestor in the relink journal is gone
+        """
+        self.xapi_mock.getConfigVDI.return_value = {}
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        vdis = self.add_vdis_for_coalesce(sr)
+        mock_journaler.get.return_value = str(uuid4())
+
+        sr.coalesce(vdis['vdi'], False)
+
+        self.assertIn(vdis['vdi'], sr._failedCoalesceTargets)
+        self.assertEqual([vdis['child']], vdis['vdi'].children)
+        mock_journaler.remove.assert_not_called()
+
     def test_tag_children_for_relink_activation(self):
         """
         Cleanup: tag for relink, activation races
@@ -1759,6 +2435,9 @@ class TestSR(unittest.TestCase):
 
         mock_sr.garbageCollect = mock.MagicMock(spec=cleanup.SR.garbageCollect)
         mock_sr.coalesce = mock.MagicMock(spec=cleanup.SR.coalesce)
+        mock_sr.coalesceParallel = mock.MagicMock(
+            spec=cleanup.SR.coalesceParallel)
+        mock_sr.getMaxParallelCoalesce.return_value = 1
         mock_sr.coalesceLeaf = mock.MagicMock(spec=cleanup.SR.coalesceLeaf)
 
         return (sr_uuid, mock_sr)
@@ -1806,8 +2485,8 @@ class TestSR(unittest.TestCase):
             True, True, True, False]
         mock_sr.findGarbage.side_effect = [
             [vdis['child']], []]
-        mock_sr.findCoalesceable.side_effect = [
-            vdis['vdi'], None]
+        mock_sr.findCoalesceables.side_effect = [
+            [vdis['vdi']], []]
         mock_sr.findLeafCoalesceable.side_effect = [
             vdis['vdi']]
 
@@ -1819,9 +2498,39 @@ class TestSR(unittest.TestCase):
 
         ## Assert
         mock_sr.garbageCollect.assert_called_with(False)
+        mock_sr.findCoalesceables.assert_called_with(1)
         mock_sr.coalesce.assert_called_with(vdis['vdi'], False)
+        mock_sr.coalesceParallel.assert_not_called()
         mock_sr.coalesceLeaf.assert_called_with(vdis['vdi'], False)
 
+    @mock.patch('cleanup._create_init_file', autospec=True)
+    def test_gcloop_parallel_coalesce(self, mock_init_file):
+        """
+        GC, two non-leaf coalesces in different trees at once
+        """
+        ## Arrange
+        sr_uuid, mock_sr = self.init_gc_loop_sr()
+        vdis1 = self.add_vdis_for_coalesce(mock_sr)
+        vdis2 = self.add_vdis_for_coalesce(mock_sr)
+
+        mock_sr.getMaxParallelCoalesce.return_value = 4
+        mock_sr.hasWork.side_effect = [True, True, False]
+        mock_sr.findGarbage.return_value = []
+        mock_sr.findCoalesceables.side_effect = [
+            [vdis1['vdi'], vdis2['vdi']]]
+
+        cleanup.lockGCActive.acquireNoblock = mock.Mock(return_value=True)
+        cleanup.lockGCRunning.acquireNoblock = mock.Mock(return_value=True)
+
+        ## Act
+        cleanup._gcLoop(mock_sr, dryRun=False)
+
+        ## Assert
+        mock_sr.findCoalesceables.assert_called_with(4)
+        mock_sr.coalesceParallel.assert_called_with(
+            [vdis1['vdi'], vdis2['vdi']], False)
+        mock_sr.coalesce.assert_not_called()
+
     @mock.patch('cleanup.Util')
     @mock.patch('cleanup._gc', autospec=True)
     def test_gc_foreground_is_immediate(self, mock_gc, mock_util):
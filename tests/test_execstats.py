@@ -0,0 +1,58 @@
+from sm_typing import override
+
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import execstats
+
+
+class TestExecStats(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        for name, value in (("STATS_DIR", self.tmp_dir.name),
+                            ("_enabled", None)):
+            patcher = mock.patch("execstats." + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_disabled(self):
+        execstats.STATS_DIR = os.path.join(self.tmp_dir.name, "missing")
+
+        execstats.record("/usr/bin/vhd-util", 0.5, 0)
+
+        self.assertFalse(execstats.isEnabled())
+        self.assertEqual([], execstats.readCalls())
+
+    def test_record(self):
+        execstats.record("/usr/bin/vhd-util", 0.5, 0)
+        execstats.record("/usr/bin/vhd-util", 0.25, 22)
+        execstats.record("/sbin/lvs", 30, execstats.RC_TIMEOUT)
+
+        self.assertEqual(["vhd-util 0.500000 0\n", "vhd-util 0.250000 22\n",
+                          "lvs 30.000000 %d\n" % execstats.RC_TIMEOUT],
+                         execstats.readCalls())
+
+        out = io.StringIO()
+        execstats.show(out)
+        self.assertEqual(
+            "lvs: 1 calls, 0 failed, 1 timed out, total 30.000s\n"
+            "  p50 30.000s, p90 30.000s, p99 30.000s, max 30.000s\n"
+            "vhd-util: 2 calls, 1 failed, 0 timed out, total 0.750s\n"
+            "  p50 0.500s, p90 0.500s, p99 0.500s, max 0.500s\n",
+            out.getvalue())
+
+    def test_percentiles(self):
+        stats = execstats.aggregate(
+            ["tap-ctl %d 0\n" % duration for duration in range(100, 0, -1)]
+            + ["tap-ctl 1"])
+
+        self.assertEqual(["tap-ctl"], list(stats))
+        self.assertEqual(100, len(stats["tap-ctl"].durations))
+        self.assertEqual([51, 91, 100],
+                         [stats["tap-ctl"].percentile(p)
+                          for p in execstats.PERCENTILES])
@@ -0,0 +1,230 @@
+from sm_typing import override
+
+import json
+import threading
+import unittest
+import unittest.mock as mock
+
+import linstorvhdutil
+import util
+
+HOSTS = {
+    'master-ref': {'hostname': 'master'},
+    'host1-ref': {'hostname': 'host1'},
+    'host2-ref': {'hostname': 'host2'}
+}
+
+# volume UUID: (up to date diskful nodes, node where it is in use)
+VOLUMES = {
+    'vdi-in-use': ({'master', 'host1'}, 'host2'),
+    'vdi-master': ({'host1', 'master'}, None),
+    'vdi-host1': ({'host2', 'host1'}, None),
+    'vdi-unknown-node': ({'other'}, None),
+    'vdi-no-node': (set(), None)
+}
+
+
+def vhd_info(path, parent=None):
+    obj = {
+        'sizeVirt': 1024, 'sizePhys': 512, 'hidden': 0, 'path': path
+    }
+    if parent:
+        obj.update(parentPath=parent, parentUuid=parent[len('/dev/'):])
+    return obj
+
+
+class TestLinstorVhdUtil(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.session = mock.MagicMock()
+        self.session.xenapi.host.get_all_records.return_value = HOSTS
+        self.thread_session = mock.MagicMock()
+
+        for name, value in (
+            ('get_master_ref', 'master-ref'),
+            ('get_localAPI_session', self.thread_session)
+        ):
+            patcher = mock.patch('linstorvhdutil.util.' + name,
+                                 return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        log_patcher = mock.patch('linstorvhdutil.util.SMlog')
+        log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+        self.linstor = mock.MagicMock()
+        self.linstor.group_name = 'group'
+        self.linstor.get_volume_name.side_effect = lambda uuid: uuid
+        self.linstor.build_device_path.side_effect = \
+            lambda name: '/dev/' + name
+        self.linstor.find_up_to_date_diskful_nodes.side_effect = \
+            lambda uuid: VOLUMES[uuid]
+
+        self.vhdutil = linstorvhdutil.LinstorVhdUtil(self.session,
+                                                     self.linstor)
+
+    def reply(self, host_ref, plugin, method, args):
+        self.assertEqual(plugin, linstorvhdutil.MANAGER_PLUGIN)
+        self.assertEqual(method, 'getVHDInfoMany')
+        self.assertEqual(args['groupName'], 'group')
+        paths = json.loads(args['devicePaths'])
+        self.calls[host_ref] = sorted(paths)
+        # The volume of host1 is not a VHD
+        return json.dumps(dict(
+            (path, vhd_info(path, '/dev/vdi-parent')) for path in paths
+            if path != '/dev/vdi-host1'
+        ))
+
+    def test_get_vhd_info_many(self):
+        self.calls = {}
+        self.session.xenapi.host.call_plugin.side_effect = self.reply
+        self.thread_session.xenapi.host.call_plugin.side_effect = self.reply
+
+        all_vhd_info = self.vhdutil.get_vhd_info_many(list(VOLUMES))
+
+        self.assertEqual(self.calls, {
+            'master-ref': ['/dev/vdi-master'],
+            'host1-ref': ['/dev/vdi-host1'],
+            'host2-ref': ['/dev/vdi-in-use']
+        })
+        # Only the master is called with the session of the caller
+        self.assertEqual(
+            self.session.xenapi.host.call_plugin.call_args[0][0],
+            'master-ref'
+        )
+        self.assertEqual(
+            self.thread_session.xenapi.session.logout.call_count, 2
+        )
+
+        self.assertEqual(sorted(all_vhd_info), ['vdi-in-use', 'vdi-master'])
+        info = all_vhd_info['vdi-master']
+        self.assertEqual(info.uuid, 'vdi-master')
+        self.assertEqual(info.path, '/dev/vdi-master')
+        self.assertEqual(info.sizeVirt, 1024)
+        self.assertEqual(info.sizePhys, 512)
+        self.assertEqual(info.parentUuid, 'vdi-parent')
+
+    def test_get_vhd_info_many_host_failure(self):
+        self.calls = {}
+        self.session.xenapi.host.call_plugin.side_effect = self.reply
+        self.thread_session.xenapi.host.call_plugin.side_effect = \
+            Exception('host down')
+
+        all_vhd_info = self.vhdutil.get_vhd_info_many(
+            ['vdi-master', 'vdi-in-use']
+        )
+
+        self.assertEqual(list(all_vhd_info), ['vdi-master'])
+
+    def test_get_vhd_info_many_names_resolved_by_caller(self):
+        self.calls = {}
+        self.session.xenapi.host.call_plugin.side_effect = self.reply
+        self.thread_session.xenapi.host.call_plugin.side_effect = self.reply
+        caller = threading.get_ident()
+
+        def get_volume_name(uuid):
+            self.assertEqual(threading.get_ident(), caller)
+            if uuid == 'vdi-host1':
+                raise Exception('no volume name')
+            return uuid
+
+        self.linstor.get_volume_name.side_effect = get_volume_name
+
+        all_vhd_info = self.vhdutil.get_vhd_info_many(list(VOLUMES))
+
+        # The group of host1 is skipped
+        self.assertEqual(sorted(self.calls), ['host2-ref', 'master-ref'])
+        self.assertEqual(sorted(all_vhd_info), ['vdi-in-use', 'vdi-master'])
+
+    def test_get_vhd_info_many_no_hosts(self):
+        self.session.xenapi.host.get_all_records.side_effect = \
+            Exception('XAPI down')
+
+        self.assertEqual(self.vhdutil.get_vhd_info_many(['vdi-master']), {})
+        self.session.xenapi.host.call_plugin.assert_not_called()
+
+    @mock.patch('linstorvhdutil.util.get_hosts_attached_on', autospec=True)
+    def test_routes_cached(self, mock_attached):
+        mock_attached.return_value = ['host1-ref']
+        call_plugin = self.session.xenapi.host.call_plugin
+        call_plugin.return_value = '1024'
+
+        self.assertEqual(self.vhdutil.get_size_virt('vdi-host1'), 1024)
+        self.assertEqual(self.vhdutil.get_size_virt('vdi-host1'), 1024)
+
+        self.assertEqual(
+            [call[0][0] for call in call_plugin.call_args_list],
+            ['host1-ref', 'host1-ref']
+        )
+        self.assertEqual(call_plugin.call_args[0][2], 'getSizeVirt')
+        mock_attached.assert_called_once_with(self.session, ['vdi-host1'])
+
+        # The volume was attached elsewhere meanwhile
+        mock_attached.return_value = ['host2-ref']
+        call_plugin.side_effect = \
+            lambda host_ref, plugin, method, args: \
+            '2048' if host_ref == 'host2-ref' else 1 / 0
+
+        self.assertEqual(self.vhdutil.get_size_virt('vdi-host1'), 2048)
+        self.assertEqual(self.vhdutil.get_size_virt('vdi-host1'), 2048)
+
+        self.assertEqual(
+            [call[0][0] for call in call_plugin.call_args_list[2:]],
+            ['host1-ref', 'host2-ref', 'host2-ref']
+        )
+        self.assertEqual(mock_attached.call_count, 2)
+
+    @mock.patch('linstorvhdutil.time.monotonic', autospec=True)
+    @mock.patch('linstorvhdutil.util.get_hosts_attached_on', autospec=True)
+    def test_routes_expire(self, mock_attached, mock_monotonic):
+        mock_attached.return_value = ['host1-ref']
+        mock_monotonic.return_value = 1000
+        self.session.xenapi.host.call_plugin.return_value = '1024'
+
+        self.vhdutil.get_size_virt('vdi-host1')
+        mock_monotonic.return_value += \
+            linstorvhdutil.LinstorVhdUtil.VOLUME_CACHE_TTL - 1
+        self.vhdutil.get_size_virt('vdi-host1')
+        self.assertEqual(mock_attached.call_count, 1)
+
+        # The route is refreshed by each successful call
+        mock_monotonic.return_value += \
+            linstorvhdutil.LinstorVhdUtil.VOLUME_CACHE_TTL
+        self.vhdutil.get_size_virt('vdi-host1')
+        self.assertEqual(mock_attached.call_count, 2)
+
+    @mock.patch('linstorvhdutil.vhdutil.setHidden', autospec=True)
+    @mock.patch('linstorvhdutil.util.get_hosts_attached_on', autospec=True)
+    def test_routes_invalidated_by_modifier(self, mock_attached,
+                                            mock_set_hidden):
+        mock_attached.return_value = ['host1-ref']
+        self.session.xenapi.host.call_plugin.return_value = '1024'
+
+        self.vhdutil.get_size_virt('vdi-host1')
+        self.vhdutil.get_size_virt('vdi-master')
+        self.vhdutil.set_hidden('/dev/vdi-host1')
+        self.vhdutil.get_size_virt('vdi-host1')
+        self.vhdutil.get_size_virt('vdi-master')
+
+        mock_set_hidden.assert_called_once_with('/dev/vdi-host1', True)
+        self.assertEqual(
+            [call[0][1] for call in mock_attached.call_args_list],
+            [['vdi-host1'], ['vdi-master'], ['vdi-host1']]
+        )
+
+    @mock.patch('linstorvhdutil.util.time.sleep', autospec=True)
+    @mock.patch('linstorvhdutil.vhdutil.repair', autospec=True)
+    def test_openers_invalidated_by_local_failure(self, mock_repair,
+                                                  mock_sleep):
+        mock_repair.side_effect = util.CommandException(5, 'vhd-util repair')
+        # The volume is opened on host1 after the first local failure
+        self.linstor.get_volume_openers.side_effect = [
+            {}, {}, {'host1': {'openers': 1}}]
+        call_plugin = self.session.xenapi.host.call_plugin
+        call_plugin.return_value = 'repaired'
+
+        self.assertEqual(self.vhdutil.force_repair('/dev/vdi-host1'),
+                         'repaired')
+
+        self.assertEqual(call_plugin.call_args[0][:3],
+                         ('host1-ref', linstorvhdutil.MANAGER_PLUGIN, 'repair'))
@@ -0,0 +1,101 @@
+from sm_typing import override
+
+import unittest
+import unittest.mock as mock
+
+import linstorvolumemanager
+
+LinstorVolumeManager = linstorvolumemanager.LinstorVolumeManager
+
+GROUP_NAME = 'xcp-sr-linstor_group_thin_device'
+
+
+def make_resource(name, node_name, diskless=False):
+    resource = mock.MagicMock()
+    resource.name = name
+    resource.node_name = node_name
+    resource.flags = ['DISKLESS'] if diskless else []
+    volume = mock.MagicMock()
+    volume.storage_pool_name = \
+        'DfltDisklessStorPool' if diskless else GROUP_NAME
+    volume.allocated_size = 1024
+    volume.usable_size = 2048
+    resource.volumes = [volume]
+    return resource
+
+
+def make_resource_state(name, node_name, disk_state, in_use=False):
+    resource_state = mock.MagicMock()
+    resource_state.name = name
+    resource_state.node_name = node_name
+    resource_state.in_use = in_use
+    resource_state.volume_states[0].disk_state = disk_state
+    return resource_state
+
+
+class TestLinstorVolumeManager(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        linstor_mock = mock.MagicMock()
+        resource_list = linstor_mock.resource_list_raise.return_value
+        resource_list.resources = [
+            make_resource('xcp-volume-a', 'host1'),
+            make_resource('xcp-volume-a', 'host2'),
+            make_resource('xcp-volume-a', 'host3', diskless=True),
+            make_resource('xcp-volume-b', 'host1')
+        ]
+        resource_list.resource_states = [
+            make_resource_state('xcp-volume-a', 'host1', 'UpToDate'),
+            make_resource_state('xcp-volume-a', 'host2', 'Outdated'),
+            make_resource_state('xcp-volume-a', 'host3', 'Diskless', True),
+            make_resource_state('xcp-volume-b', 'host1', 'UpToDate')
+        ]
+        self.linstor = linstor_mock
+
+        self.manager = LinstorVolumeManager.__new__(LinstorVolumeManager)
+        self.manager._linstor = linstor_mock
+        self.manager._group_name = GROUP_NAME
+        self.manager._resource_snapshot = None
+        self.manager._resource_generation = 0
+
+        patcher = mock.patch('linstorvolumemanager.linstor')
+        patcher.start().consts.FLAG_DISKLESS = 'DISKLESS'
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            LinstorVolumeManager, 'get_volume_name', autospec=True,
+            side_effect=lambda manager, uuid: 'xcp-volume-' + uuid
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_find_up_to_date_diskful_nodes(self):
+        self.assertEqual(
+            self.manager.find_up_to_date_diskful_nodes('a'),
+            ({'host1'}, 'host3')
+        )
+        self.assertEqual(
+            self.manager.find_up_to_date_diskful_nodes('b'),
+            ({'host1'}, None)
+        )
+        self.assertEqual(
+            self.manager.find_up_to_date_diskful_nodes('c'), (set(), None)
+        )
+        self.linstor.resource_list_raise.assert_called_once_with()
+
+    def test_resource_snapshot(self):
+        snapshot = self.manager.get_resource_snapshot()
+        volume_info = self.manager.get_volume_info('a')
+        self.assertEqual(volume_info.diskful, ['host1', 'host2'])
+        self.assertEqual(volume_info.allocated_size, 1024 * 1024)
+        self.assertEqual(volume_info.virtual_size, 2048 * 1024)
+
+        self.assertIs(self.manager.get_resource_snapshot(), snapshot)
+        self.assertIs(self.manager.get_volume_info('a'), volume_info)
+        self.linstor.resource_list_raise.assert_called_once_with()
+
+        self.manager.invalidate_resource_cache()
+        new_snapshot = self.manager.get_resource_snapshot()
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertEqual(new_snapshot.generation, snapshot.generation + 1)
+        self.assertIsNot(self.manager.get_volume_info('a'), volume_info)
+        self.assertEqual(self.linstor.resource_list_raise.call_count, 2)
@@ -6,6 +6,7 @@ import unittest.mock as mock
 import os
 import errno
 import struct
+import tempfile
 
 import testlib
 
@@ -18,6 +19,7 @@ class TestLock(unittest.TestCase):
     def tearDown(self) -> None:
         lock.Lock.INSTANCES = {}
         lock.Lock.BASE_INSTANCES = {}
+        lock.Lock.OPEN_INSTANCES.clear()
 
     @testlib.with_context
     def test_lock_without_namespace_creates_nil_namespace(self, context):
@@ -193,6 +195,56 @@ class TestLock(unittest.TestCase):
 
         self.assertFalse(lck1.held())
 
+    @mock.patch('lock.lockstats', autospec=True)
+    @testlib.with_context
+    def test_lock_stats_recorded_once(self, context, mock_lockstats):
+        self.setup_fcntl_return(context)
+
+        lck = lock.Lock("somename", ns="namespace")
+        lck.acquire()
+        lck.acquireNoblock()
+        lck.release()
+        lck.release()
+
+        lockpath = os.path.join(lock.Lock.BASE_DIR, 'namespace', 'somename')
+        mock_lockstats.recordAcquired.assert_called_once_with(
+            lockpath, mock.ANY)
+        mock_lockstats.recordReleased.assert_called_once_with(lockpath)
+
+    @mock.patch('lock.Lock.MAX_OPEN_LOCKS', 2)
+    def test_least_recently_used_lock_closed(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        base_dir_patcher = mock.patch('lock.Lock.BASE_DIR', tmp_dir.name)
+        base_dir_patcher.start()
+        self.addCleanup(base_dir_patcher.stop)
+
+        held = lock.Lock("held", ns="namespace")
+        held.acquire()
+        lck1 = lock.Lock("lock1", ns="namespace")
+        lck2 = lock.Lock("lock2", ns="namespace")
+
+        # The held lock is the least recently used one
+        self.assertIsNotNone(held.lockfile)
+        self.assertIsNone(lck1.lockfile)
+        self.assertIsNotNone(lck2.lockfile)
+        self.assertEqual([held, lck2],
+                         list(lock.Lock.OPEN_INSTANCES.values()))
+
+        write_lock = lck1.lock
+        lck1.acquire()
+
+        self.assertIs(lock.Lock("lock1", ns="namespace"), lck1)
+        self.assertIs(write_lock, lck1.lock)
+        self.assertEqual(lck1.lockfile.fileno(), lck1.lock.fd)
+        self.assertTrue(lck1.held())
+        self.assertIsNone(lck2.lockfile)
+
+        lck1.release()
+        held.release()
+        lock.Lock.cleanup("lock1", ns="namespace")
+        self.assertEqual([held], list(lock.Lock.OPEN_INSTANCES.values()))
+
 
 def create_lock_class_that_fails_to_create_file(number_of_failures):
 
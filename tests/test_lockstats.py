@@ -0,0 +1,118 @@
+from sm_typing import override
+
+import io
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import lockstats
+
+
+class TestLockStats(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = mock.patch.multiple("lockstats",
+                                      STATS_DIR=self.tmp_dir.name,
+                                      _enabled=None, _acquired={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_disabled(self):
+        lockstats.STATS_DIR = os.path.join(self.tmp_dir.name, "missing")
+
+        lockstats.recordAcquired("/var/lock/sm/ns/sr", 0.5)
+        lockstats.recordReleased("/var/lock/sm/ns/sr")
+
+        self.assertFalse(lockstats.isEnabled())
+        self.assertEqual([], lockstats.readEvents())
+
+    @mock.patch("lockstats.time.monotonic", autospec=True)
+    def test_record(self, mock_monotonic):
+        mock_monotonic.side_effect = [10, 12.5, 20, 20.25]
+
+        lockstats.recordAcquired("/var/lock/sm/ns/sr", 0.002)
+        lockstats.recordReleased("/var/lock/sm/ns/sr")
+        lockstats.recordAcquired("fairlock:devicemapper", 0)
+        # Released without being recorded as acquired
+        lockstats.recordReleased("/var/lock/sm/ns/sr")
+
+        lines = lockstats.readEvents()
+        self.assertEqual(3, len(lines))
+        fields = lines[0].split()
+        self.assertEqual(["A", "/var/lock/sm/ns/sr", str(os.getpid()),
+                          "0.002000"], [fields[0]] + fields[2:5])
+        self.assertTrue(fields[5].startswith("test_lockstats.py:test_record:"))
+        stats = lockstats.aggregate(lines)
+
+        self.assertEqual(1, stats["/var/lock/sm/ns/sr"].count)
+        self.assertEqual(2.5, stats["/var/lock/sm/ns/sr"].hold.max)
+        self.assertEqual({}, stats["/var/lock/sm/ns/sr"].holders)
+        ((tag, _),) = stats["fairlock:devicemapper"].holders.values()
+        self.assertTrue(tag.startswith("test_lockstats.py:test_record:"))
+
+        out = io.StringIO()
+        lockstats.show(out)
+        self.assertIn("held by PID %d (%s)" % (os.getpid(), tag),
+                      out.getvalue())
+
+    def test_aggregate(self):
+        stats = lockstats.aggregate([
+            "A 100.0 lock1 1 0.0005 a.py:f:1\n",
+            "A 101.0 lock1 2 2.0 b.py:g:2\n",
+            "R 102.0 lock1 1 0.2\n",
+            "R 103.0 lock1 2 45.0\n",
+            "A 103.0 lock1 3 200.0 c.py:h:3\n",
+            "A 104.0 lock2 4 700.0 d.py:i:4\n",
+            "R 10"
+        ])
+
+        self.assertEqual(["lock1", "lock2"], sorted(stats))
+        lock1 = stats["lock1"]
+        self.assertEqual(3, lock1.count)
+        self.assertEqual([1, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0],
+                         lock1.wait.counts)
+        self.assertEqual([0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0],
+                         lock1.hold.counts)
+        self.assertEqual(202.0005, lock1.wait.total)
+        self.assertEqual({3: ("c.py:h:3", 103.0)}, lock1.holders)
+        self.assertEqual(1, stats["lock2"].wait.counts[-1])
+        self.assertEqual("total 700.000s, max 700.000s [>=300s: 1]",
+                         str(stats["lock2"].wait))
+
+    def test_rotate(self):
+        with mock.patch("lockstats.MAX_EVENTS_SIZE", 100):
+            for i in range(5):
+                lockstats.recordAcquired("lock%d" % i, 0)
+
+        self.assertEqual(["events", "events.1"],
+                         sorted(os.listdir(self.tmp_dir.name)))
+        # The oldest events are lost
+        self.assertEqual(["lock2", "lock3", "lock4"],
+                         sorted(lockstats.aggregate(lockstats.readEvents())))
+
+        lockstats.reset()
+        self.assertEqual([], os.listdir(self.tmp_dir.name))
+
+    def test_rotate_concurrent(self):
+        path = os.path.join(self.tmp_dir.name, "events")
+        write = os.write
+
+        def rotatedMeanwhile(fd, data):
+            # Another process rotates the log and logs a new event
+            os.rename(path, path + ".1")
+            with open(path, "w") as f:
+                f.write("A 2.0 lock2 1 0.0 ?\n")
+            return write(fd, data)
+
+        with open(path, "w") as f:
+            f.write("A 1.0 lock1 1 0.0 ?\n" * 10)
+        with mock.patch("lockstats.MAX_EVENTS_SIZE", 100), \
+                mock.patch("lockstats.os.write", side_effect=rotatedMeanwhile):
+            lockstats.recordAcquired("lock0", 0)
+
+        # The log rotated by the other process is kept
+        self.assertEqual(["lock0", "lock1", "lock2"],
+                         sorted(lockstats.aggregate(lockstats.readEvents())))
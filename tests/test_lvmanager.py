@@ -0,0 +1,46 @@
+from sm_typing import override
+
+import unittest
+import unittest.mock as mock
+
+import lvmanager
+import util
+
+SR_UUID = "b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+
+
+class TestLVActivator(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.lvm_cache = mock.MagicMock()
+        self.activator = lvmanager.LVActivator(SR_UUID, self.lvm_cache)
+
+    def test_activate_many(self):
+        self.activator.activateMany([("a", "VHD-a", False)])
+        self.activator.activateMany([("a", "VHD-a", False),
+                                     ("b", "VHD-b", False)])
+
+        self.lvm_cache.activateMany.assert_has_calls([
+            mock.call(self.activator.ns, [("a", "VHD-a", False)]),
+            mock.call(self.activator.ns, [("b", "VHD-b", False)])])
+        self.assertEqual("VHD-b", self.activator.get("b", False))
+
+    def test_activate_many_double_persistent(self):
+        self.activator.activateMany([("a", "VHD-a", False)], True)
+
+        with self.assertRaises(lvmanager.LVManagerException):
+            self.activator.activateMany([("b", "VHD-b", False),
+                                         ("a", "VHD-a", False)], True)
+
+        self.lvm_cache.activateMany.assert_called_once()
+        self.assertNotIn("b", self.activator.lvActivations[True][False])
+
+    def test_activate_many_failed(self):
+        self.lvm_cache.activateMany.side_effect = util.CommandException(5)
+
+        with self.assertRaises(util.CommandException):
+            self.activator.activateMany([("a", "VHD-a", False)])
+
+        self.assertIsNone(self.activator.get("a", False))
+        self.assertTrue(self.activator.deactivateAll())
+        self.lvm_cache.deactivateMany.assert_not_called()
@@ -0,0 +1,204 @@
+from sm_typing import override
+
+import json
+import unittest
+import unittest.mock as mock
+
+import lvmcache
+import lvutil
+import util
+
+TEST_VG = "VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+
+
+def lvs_report(lvs):
+    return json.dumps({"report": [{"lv": [
+        {"lv_name": name, "lv_size": str(size), "lv_attr": attr,
+         "lv_uuid": "uuid-" + name, "lv_tags": tags}
+        for (name, size, attr, tags) in lvs]}]})
+
+
+class TestLVMCache(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        cmd_lvm_patcher = mock.patch('lvmcache.lvutil.cmd_lvm', autospec=True)
+        self.mock_cmd_lvm = cmd_lvm_patcher.start()
+        self.addCleanup(cmd_lvm_patcher.stop)
+
+    def test_refresh(self):
+        self.mock_cmd_lvm.return_value = lvs_report([
+            ("VHD-a", 8388608, "-wi-ao----", "hidden"),
+            ("VHD-b", 4194304, "-ri-------", ""),
+            ("LV-c", 2097152, "-wi-a-----", "hidden,other")])
+        cache = lvmcache.LVMCache(TEST_VG)
+
+        self.assertEqual(8388608, cache.getSize("VHD-a"))
+
+        self.mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_LVS, "--reportformat", "json", "--units", "b",
+             "--nosuffix", "-o", lvmcache.LVS_FIELDS, "/dev/" + TEST_VG])
+        infos = cache.getLVInfo()
+        self.assertEqual(["LV-c", "VHD-a", "VHD-b"], sorted(infos))
+        self.assertTrue(infos["VHD-a"].active)
+        self.assertTrue(infos["VHD-a"].open)
+        self.assertFalse(infos["VHD-a"].readonly)
+        self.assertTrue(infos["VHD-a"].hidden)
+        self.assertFalse(infos["VHD-b"].active)
+        self.assertFalse(infos["VHD-b"].open)
+        self.assertTrue(infos["VHD-b"].readonly)
+        self.assertFalse(infos["VHD-b"].hidden)
+        self.assertEqual(["LV-c", "VHD-a"], sorted(cache.getTagged("hidden")))
+        self.assertEqual(["LV-c"], cache.getTagged("other"))
+
+    def test_refresh_in_place(self):
+        self.mock_cmd_lvm.return_value = lvs_report([
+            ("VHD-a", 8388608, "-wi-ao----", ""),
+            ("VHD-b", 4194304, "-wi-------", ""),
+            ("VHD-c", 4194304, "-wi-------", "hidden"),
+            ("VHD-d", 4194304, "-wi-------", "")])
+        cache = lvmcache.LVMCache(TEST_VG)
+        cache.refresh()
+        self.mock_cmd_lvm.return_value = lvs_report([
+            ("VHD-a", 8388608, "-wi-ao----", ""),
+            ("VHD-b", 6291456, "-wi-------", ""),
+            ("VHD-c", 4194304, "-wi-------", ""),
+            ("VHD-e", 4194304, "-wi-------", "")])
+        lvs = cache.lvs
+
+        cache.refresh()
+
+        self.assertIs(lvs, cache.lvs)
+        self.assertEqual(["VHD-a", "VHD-b", "VHD-c", "VHD-e"], sorted(lvs))
+        self.assertEqual(6291456, cache.getSize("VHD-b"))
+        self.assertEqual([], cache.getTagged("hidden"))
+        self.assertIsNone(cache.checkLV("VHD-d"))
+
+    def test_refresh_empty_vg(self):
+        self.mock_cmd_lvm.return_value = lvs_report([])
+        cache = lvmcache.LVMCache(TEST_VG)
+
+        self.assertEqual({}, cache.getLVInfo())
+
+    @mock.patch('lvmcache.lvmcached.getLVs', autospec=True)
+    def test_refresh_from_daemon(self, mock_get_lvs):
+        mock_get_lvs.return_value = json.loads(lvs_report([
+            ("VHD-a", 8388608, "-wi-ao----", "")]))["report"][0]["lv"]
+        cache = lvmcache.LVMCache(TEST_VG)
+
+        self.assertEqual(["VHD-a"], list(cache.getLVInfo()))
+        mock_get_lvs.assert_called_once_with(TEST_VG)
+        self.mock_cmd_lvm.assert_not_called()
+
+        self.mock_cmd_lvm.return_value = lvs_report([])
+        cache.refresh(direct=True)
+        self.mock_cmd_lvm.assert_called_once()
+
+
+@mock.patch('lvmcache.RefCounter', autospec=True)
+@mock.patch('lvmcache.Lock', autospec=True)
+class TestLVMCacheActivation(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        cmd_lvm_patcher = mock.patch('lvmcache.lvutil.cmd_lvm', autospec=True)
+        self.mock_cmd_lvm = cmd_lvm_patcher.start()
+        self.addCleanup(cmd_lvm_patcher.stop)
+        self.mock_cmd_lvm.return_value = lvs_report([
+            ("VHD-a", 8388608, "-wi-------", ""),
+            ("VHD-b", 8388608, "-wi-a-----", ""),
+            ("VHD-c", 8388608, "-wi-------", ""),
+            ("VHD-d", 8388608, "-wi-ao----", "")])
+        lvutil_patcher = mock.patch('lvmcache.lvutil', autospec=True)
+        self.mock_lvutil = lvutil_patcher.start()
+        self.addCleanup(lvutil_patcher.stop)
+        self.mock_lvutil.cmd_lvm = self.mock_cmd_lvm
+        self.cache = lvmcache.LVMCache(TEST_VG)
+        self.cache.refresh()
+
+    def test_activate_many(self, mock_lock, mock_refcounter):
+        counts = {"a": 1, "b": 2, "c": 1}
+        mock_refcounter.get.side_effect = lambda ref, binary, ns: counts[ref]
+
+        self.cache.activateMany("ns", [("c", "VHD-c", False),
+                                       ("b", "VHD-b", False),
+                                       ("a", "VHD-a", True)])
+
+        self.mock_lvutil.activateNoRefcountMany.assert_called_once_with(
+            ["/dev/%s/VHD-c" % TEST_VG, "/dev/%s/VHD-a" % TEST_VG])
+        self.assertTrue(self.cache.is_active("VHD-a"))
+        self.assertTrue(self.cache.is_active("VHD-c"))
+        self.assertEqual([mock.call("a", "ns"), mock.call("b", "ns"),
+                          mock.call("c", "ns")], mock_lock.call_args_list)
+        self.assertEqual(3, mock_lock.return_value.acquire.call_count)
+        self.assertEqual(3, mock_lock.return_value.release.call_count)
+        mock_refcounter.put.assert_not_called()
+
+    def test_activate_many_failure(self, mock_lock, mock_refcounter):
+        mock_refcounter.get.return_value = 1
+        self.mock_lvutil.activateNoRefcountMany.side_effect = \
+            util.CommandException(5, "lvchange")
+
+        with self.assertRaises(util.CommandException):
+            self.cache.activateMany("ns", [("a", "VHD-a", False),
+                                           ("c", "VHD-c", True)])
+
+        mock_refcounter.put.assert_has_calls([
+            mock.call("a", False, "ns"), mock.call("c", True, "ns")])
+        self.assertEqual(2, mock_lock.return_value.release.call_count)
+
+    def test_deactivate_many(self, mock_lock, mock_refcounter):
+        counts = {"a": 0, "b": 1, "c": 0, "d": 0}
+        mock_refcounter.put.side_effect = lambda ref, binary, ns: counts[ref]
+
+        failed = self.cache.deactivateMany("ns", [
+            ("a", "VHD-a", False), ("b", "VHD-b", False),
+            ("c", "VHD-c", False), ("d", "VHD-d", False)])
+
+        # VHD-d is still open after a direct refresh
+        self.assertEqual([], failed)
+        self.mock_lvutil.deactivateNoRefcountMany.assert_called_once_with(
+            ["/dev/%s/VHD-a" % TEST_VG, "/dev/%s/VHD-c" % TEST_VG])
+        self.mock_lvutil.deactivateNoRefcount.assert_not_called()
+        self.assertFalse(self.cache.is_active("VHD-a"))
+        self.assertTrue(self.cache.is_active("VHD-b"))
+        self.assertEqual(4, mock_lock.return_value.release.call_count)
+
+    def test_deactivate_many_refreshes(self, mock_lock, mock_refcounter):
+        mock_refcounter.put.return_value = 0
+        # VHD-a was opened since the cache was loaded
+        self.mock_cmd_lvm.return_value = lvs_report([
+            ("VHD-a", 8388608, "-wi-ao----", ""),
+            ("VHD-c", 8388608, "-wi-a-----", "")])
+
+        failed = self.cache.deactivateMany("ns", [
+            ("a", "VHD-a", False), ("c", "VHD-c", False)])
+
+        self.assertEqual([], failed)
+        self.mock_lvutil.deactivateNoRefcountMany.assert_called_once_with(
+            ["/dev/%s/VHD-c" % TEST_VG])
+
+    def test_deactivate_many_failures(self, mock_lock, mock_refcounter):
+        mock_refcounter.put.side_effect = \
+            lambda ref, binary, ns: {"a": 0, "c": 0, "x": 0}[ref]
+        self.mock_lvutil.deactivateNoRefcountMany.side_effect = \
+            util.CommandException(5, "lvchange")
+
+        failed = self.cache.deactivateMany("ns", [
+            ("a", "VHD-a", False), ("b", "VHD-b", False),
+            ("c", "VHD-c", False), ("x", "VHD-x", False)])
+
+        # retried one by one, unknown ref and LV
+        self.assertEqual(["b", "x"], sorted(failed))
+        self.mock_lvutil.deactivateNoRefcount.assert_has_calls([
+            mock.call("/dev/%s/VHD-a" % TEST_VG),
+            mock.call("/dev/%s/VHD-c" % TEST_VG)])
+        self.assertEqual(4, mock_lock.return_value.release.call_count)
+
+    def test_lock_failure(self, mock_lock, mock_refcounter):
+        mock_lock.return_value.acquire.side_effect = [None, OSError()]
+
+        with self.assertRaises(OSError):
+            self.cache.activateMany("ns", [("a", "VHD-a", False),
+                                           ("b", "VHD-b", False)])
+
+        mock_lock.return_value.release.assert_called_once_with()
+        mock_refcounter.get.assert_not_called()
@@ -0,0 +1,284 @@
+from sm_typing import List, override
+
+import errno
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+
+import lvmcached
+import util
+
+TEST_VG = "VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+TEST_PV = "/dev/sdb"
+
+MDA_OFFSET = 4096
+
+
+def write_pv(path, raw_locn=(8192, 1000, 0xabcd), label_sector=1,
+             magic=lvmcached.MDA_MAGIC, mda=True):
+    data = bytearray(1024 * 1024)
+    label = label_sector * 512
+    struct.pack_into("<8sQII8s", data, label, b"LABELONE", label_sector, 0,
+                     32, b"LVM2 001")
+    # pv_header: uuid, device size, data areas, metadata areas
+    offset = label + 32 + 40
+    areas = [(1024 * 1024, 0), (0, 0)]
+    if mda:
+        areas += [(MDA_OFFSET, 1024 * 1024 - MDA_OFFSET)]
+    areas += [(0, 0)]
+    for area in areas:
+        struct.pack_into("<QQ", data, offset, *area)
+        offset += 16
+    struct.pack_into("<I16sIQQQQII", data, MDA_OFFSET, 0, magic, 1,
+                     MDA_OFFSET, 1024 * 1024 - MDA_OFFSET, *raw_locn, 0)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def vgs_report(size=8589934592, free=4294967296, pvs=(TEST_PV,)):
+    return json.dumps({"report": [{"vg": [
+        {"vg_name": TEST_VG, "vg_size": str(size), "vg_free": str(free),
+         "vg_seqno": "3", "pv_name": pv}
+        for pv in pvs]}]})
+
+
+class TestMetadataLocation(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.pv = os.path.join(self.tmp_dir.name, "pv")
+
+    def test_location(self):
+        write_pv(self.pv)
+        self.assertEqual([8192, 1000, 0xabcd],
+                         lvmcached.readMetadataLocation(self.pv))
+
+        write_pv(self.pv, raw_locn=(9216, 1010, 0x1234), label_sector=3)
+        self.assertEqual([9216, 1010, 0x1234],
+                         lvmcached.readMetadataLocation(self.pv))
+
+    def test_location_unknown(self):
+        self.assertIsNone(lvmcached.readMetadataLocation(self.pv))
+
+        write_pv(self.pv, mda=False)
+        self.assertIsNone(lvmcached.readMetadataLocation(self.pv))
+
+        write_pv(self.pv, magic=b"x" * 16)
+        self.assertIsNone(lvmcached.readMetadataLocation(self.pv))
+
+        write_pv(self.pv, label_sector=5)
+        self.assertIsNone(lvmcached.readMetadataLocation(self.pv))
+
+        with open(self.pv, "wb") as f:
+            f.write(b"LABELONE" + b"\xff" * 24)
+        self.assertIsNone(lvmcached.readMetadataLocation(self.pv))
+
+    @mock.patch('lvmcached.os.open', autospec=True)
+    def test_open_no_direct(self, mock_open):
+        mock_open.side_effect = [OSError(errno.EINVAL, "O_DIRECT"), 42]
+        self.assertEqual(42, lvmcached._open(self.pv))
+
+        mock_open.side_effect = [OSError(errno.EACCES, "denied")]
+        with self.assertRaises(OSError):
+            lvmcached._open(self.pv)
+
+
+class TestLVMCacheDaemon(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        cmd_lvm_patcher = mock.patch('lvmcached.lvutil.cmd_lvm',
+                                     autospec=True)
+        self.mock_cmd_lvm = cmd_lvm_patcher.start()
+        self.addCleanup(cmd_lvm_patcher.stop)
+        self.mock_cmd_lvm.return_value = vgs_report()
+        read_lvs_patcher = mock.patch('lvmcached.lvmcache.readLVs',
+                                      autospec=True)
+        self.mock_read_lvs = read_lvs_patcher.start()
+        self.addCleanup(read_lvs_patcher.stop)
+        self.mock_read_lvs.return_value = [{"lv_name": "VHD-a"}]
+        generation_patcher = mock.patch('lvmcached._getGeneration',
+                                        autospec=True)
+        self.mock_generation = generation_patcher.start()
+        self.addCleanup(generation_patcher.stop)
+        self.mock_generation.return_value = [[8192, 1000, 1]]
+        self.daemon = lvmcached.LVMCacheDaemon()
+
+    def test_cached(self):
+        # The first load lists the PVs to check beforehand
+        for _ in range(3):
+            self.assertEqual({"lvs": [{"lv_name": "VHD-a"}]},
+                             self.daemon.handle({"op": "lvs", "vg": TEST_VG}))
+        self.assertEqual(
+            {"size": 8589934592, "free": 4294967296},
+            self.daemon.handle({"op": "vgs", "vg": TEST_VG}))
+
+        self.assertEqual(2, self.mock_cmd_lvm.call_count)
+        self.assertEqual(1, self.mock_read_lvs.call_count)
+        self.mock_read_lvs.assert_called_with(TEST_VG)
+        self.mock_generation.assert_called_with([TEST_PV])
+
+    def test_metadata_changed(self):
+        self.daemon.getVG(TEST_VG)
+        self.daemon.getVG(TEST_VG)
+        self.mock_generation.return_value = [[9216, 1000, 2]]
+        self.mock_cmd_lvm.return_value = vgs_report(free=0)
+
+        self.assertEqual(0, self.daemon.getVG(TEST_VG).free)
+        self.daemon.getVG(TEST_VG)
+
+        self.assertEqual(3, self.mock_cmd_lvm.call_count)
+
+    def test_metadata_changed_while_loading(self):
+        self.mock_generation.side_effect = [[[1, 1, 1]], [[2, 2, 2]]] * 2
+        self.daemon.vgs[TEST_VG] = lvmcached.VGState(None, 0, 0, [TEST_PV],
+                                                     [])
+
+        self.daemon.getVG(TEST_VG)
+        self.daemon.getVG(TEST_VG)
+
+        self.assertEqual(2, self.mock_cmd_lvm.call_count)
+
+    def test_unreadable_metadata(self):
+        self.mock_generation.return_value = None
+
+        self.daemon.getVG(TEST_VG)
+        self.daemon.getVG(TEST_VG)
+
+        self.assertEqual(2, self.mock_read_lvs.call_count)
+
+    def test_invalidate(self):
+        self.daemon.getVG(TEST_VG)
+        self.daemon.getVG(TEST_VG)
+
+        self.daemon.invalidate()
+        self.daemon.getVG(TEST_VG)
+        self.daemon.getVG(TEST_VG)
+
+        self.assertEqual(3, self.mock_cmd_lvm.call_count)
+
+    def test_errors(self):
+        self.mock_cmd_lvm.side_effect = util.CommandException(
+            5, "vgs", "Volume group not found")
+
+        self.assertEqual({"error": 5, "reason": "Volume group not found"},
+                         self.daemon.handle({"op": "vgs", "vg": TEST_VG}))
+        self.assertEqual(errno.EINVAL,
+                         self.daemon.handle({"op": "pvs"})["error"])
+
+
+class TestClient(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        api_socket = os.path.join(self.tmp_dir.name, "api.sock")
+        kick_fifo = os.path.join(self.tmp_dir.name, "kick.sock")
+        for name, value in (("API_SOCKET", api_socket),
+                            ("KICK_FIFO", kick_fifo)):
+            patcher = mock.patch("lvmcached." + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        os.mkfifo(kick_fifo)
+        self.daemon = lvmcached.LVMCacheDaemon()
+        self.daemon.kickFd = os.open(kick_fifo, os.O_RDWR | os.O_NONBLOCK)
+        self.addCleanup(os.close, self.daemon.kickFd)
+        self.replies: List[dict] = []
+        handle_patcher = mock.patch.object(
+            self.daemon, "handle",
+            side_effect=lambda request: self.replies.pop(0))
+        self.mock_handle = handle_patcher.start()
+        self.addCleanup(handle_patcher.stop)
+
+    def serve(self, count=1):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(lvmcached.API_SOCKET)
+        server.listen(1)
+        server.settimeout(10)
+        self.addCleanup(server.close)
+
+        def accept():
+            for _ in range(count):
+                self.daemon._serveClient(server.accept()[0])
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_no_daemon(self):
+        os.unlink(lvmcached.KICK_FIFO)
+
+        self.assertIsNone(lvmcached.getLVs(TEST_VG))
+        self.assertIsNone(lvmcached.getVGStats(TEST_VG))
+        lvmcached.invalidate()
+
+    @mock.patch('lvmcached.util.SMlog', autospec=True)
+    def test_daemon_stopped(self, mock_log):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(lvmcached.API_SOCKET)
+        server.close()
+
+        self.assertIsNone(lvmcached.getLVs(TEST_VG))
+
+    def test_requests(self):
+        self.replies = [{"lvs": [{"lv_name": "VHD-a"}]},
+                        {"size": 10, "free": 4}]
+        self.serve(count=2)
+
+        self.assertEqual([{"lv_name": "VHD-a"}], lvmcached.getLVs(TEST_VG))
+        self.assertEqual((10, 4), lvmcached.getVGStats(TEST_VG))
+
+        self.mock_handle.assert_has_calls([
+            mock.call({"op": "lvs", "vg": TEST_VG}),
+            mock.call({"op": "vgs", "vg": TEST_VG})])
+
+    def test_request_error(self):
+        self.replies = [{"error": 5, "reason": "Volume group not found"}]
+        self.serve()
+
+        with self.assertRaises(util.CommandException) as cm:
+            lvmcached.getVGStats(TEST_VG)
+
+        self.assertEqual(5, cm.exception.code)
+        self.assertEqual("Volume group not found", cm.exception.reason)
+
+    @mock.patch('lvmcached.util.SMlog', autospec=True)
+    def test_bad_request(self, mock_log):
+        self.serve()
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(lvmcached.API_SOCKET)
+            sock.sendall(b"{\n")
+            self.assertEqual(b"", sock.recv(10))
+
+        self.mock_handle.assert_not_called()
+
+    def test_kick(self):
+        self.daemon.vgs[TEST_VG] = lvmcached.VGState([[1, 1, 1]], 0, 0,
+                                                     [TEST_PV], [])
+        self.replies = [{}, {}]
+        self.serve(count=2)
+
+        # Nothing to handle
+        lvmcached._request({"op": "lvs"})
+        self.assertIsNotNone(self.daemon.vgs[TEST_VG].generation)
+
+        lvmcached.invalidate()
+        lvmcached._request({"op": "lvs"})
+        self.assertIsNone(self.daemon.vgs[TEST_VG].generation)
+
+    @mock.patch('lvmcached.util.SMlog', autospec=True)
+    @mock.patch('lvmcached.os.write', autospec=True)
+    def test_kick_full(self, mock_write, mock_log):
+        mock_write.side_effect = OSError(errno.EAGAIN, "full")
+        lvmcached.invalidate()
+        mock_log.assert_not_called()
+
+        mock_write.side_effect = OSError(errno.EIO, "error")
+        lvmcached.invalidate()
+        mock_log.assert_called_once()
@@ -210,6 +210,19 @@ class TestDeactivate(unittest.TestCase):
         mock_symlink.assert_called_once_with(
             mock.ANY, 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume')
 
+    @mock.patch('lvutil.util.pread')
+    @mock.patch('lvutil.cmd_lvm')
+    def test_deactivate_noref_many(self, mock_cmd_lvm, mock_pread):
+        self.mock_exists.return_value = False
+        mock_pread.side_effect = util.CommandException(1)
+        paths = ["%s/volume1" % TEST_VG, "%s/volume2" % TEST_VG]
+
+        lvutil.deactivateNoRefcountMany(paths)
+
+        mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_LVCHANGE, "-an"] + paths)
+        self.assertEqual(2, mock_pread.call_count)
+
 
 class TestActivate(unittest.TestCase):
     @override
@@ -241,6 +254,29 @@ class TestActivate(unittest.TestCase):
         # Act
         lvutil.activateNoRefcount(TEST_VOL, False)
 
+    @mock.patch('lvutil.cmd_lvm')
+    def test_activate_noref_many(self, mock_cmd_lvm):
+        self.mock_exists.return_value = True
+        paths = ["%s/volume1" % TEST_VG, "%s/volume2" % TEST_VG]
+
+        lvutil.activateNoRefcountMany(paths)
+
+        mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_LVCHANGE, "-ay"] + paths)
+        self.mock_exists.assert_has_calls([mock.call(path) for path in paths])
+
+    @mock.patch('lvutil._checkActive', autospec=True)
+    @mock.patch('lvutil.cmd_lvm')
+    def test_activate_noref_many_not_active(self, mock_cmd_lvm,
+                                            mock_check_active):
+        mock_check_active.side_effect = [True, False]
+
+        with self.assertRaises(util.CommandException) as ce:
+            lvutil.activateNoRefcountMany(["%s/volume1" % TEST_VG,
+                                           "%s/volume2" % TEST_VG])
+
+        self.assertIn('volume2 not activated', ce.exception.reason)
+
     @mock.patch('lvutil.time.sleep', autospec=True)
     @mock.patch('lvutil.cmd_lvm')
     @with_lvm_subsystem
@@ -360,6 +396,42 @@ class Test_cmd_lvm(unittest.TestCase):
         self.assertIn("Long LVM call", m_smlog.call_args[0][0])
         self.assertIn(f"took {lvutil.MAX_OPERATION_DURATION*2}", m_smlog.call_args[0][0])
 
+    @mock.patch('lvutil.lvmcached.invalidate', autospec=True)
+    def test_lvmcached_invalidated(self, m_invalidate, _1, m_pread):
+        lvutil.cmd_lvm([lvutil.CMD_LVS])
+        m_invalidate.assert_not_called()
+
+        m_pread.side_effect = util.CommandException(5, "lvchange")
+        with self.assertRaises(util.CommandException):
+            lvutil.cmd_lvm([lvutil.CMD_LVCHANGE, "-ay"])
+        m_invalidate.assert_called_once_with()
+
+
+@mock.patch('lvutil.lvmcached.getVGStats', autospec=True)
+@mock.patch('lvutil.cmd_lvm', autospec=True)
+class TestVGStats(unittest.TestCase):
+    def test_from_lvmcached(self, mock_cmd_lvm, mock_get_stats):
+        mock_get_stats.return_value = (100, 40)
+
+        self.assertTrue(lvutil._checkVG(TEST_VG))
+        self.assertEqual({'physical_size': 100, 'physical_utilisation': 60,
+                          'freespace': 40}, lvutil._getVGstats(TEST_VG))
+        mock_cmd_lvm.assert_not_called()
+
+        mock_get_stats.side_effect = util.CommandException(5, "lvmcached")
+        self.assertFalse(lvutil._checkVG(TEST_VG))
+
+    def test_without_lvmcached(self, mock_cmd_lvm, mock_get_stats):
+        mock_get_stats.return_value = None
+        mock_cmd_lvm.return_value = \
+            "  %s   1   2   0 wz--n- 100 40" % TEST_VG
+
+        self.assertTrue(lvutil._checkVG(TEST_VG))
+        self.assertEqual({'physical_size': 100, 'physical_utilisation': 60,
+                          'freespace': 40}, lvutil._getVGstats(TEST_VG))
+        self.assertEqual(2, mock_cmd_lvm.call_count)
+
+
 @mock.patch('lvutil.cmd_lvm')
 @mock.patch('util.SMlog', autospec=True)
 class TestGetPVsInVG(unittest.TestCase):
@@ -0,0 +1,187 @@
+"""
+Unit tests for the multipathd socket client
+"""
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+
+from sm_typing import override
+
+import mpath_cli
+
+
+class FakeMultipathd(threading.Thread):
+    """Serve the multipathd control protocol on a unix socket, replying
+    from a dict of command -> reply"""
+
+    def __init__(self, path, replies):
+        super().__init__(daemon=True)
+        self.replies = replies
+        self.commands = []
+        self.connections = 0
+        self.dropNext = False
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+
+    @override
+    def run(self) -> None:
+        size = mpath_cli.MPathdClient.LENGTH.size
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with conn, conn.makefile('rb') as f:
+                while True:
+                    header = f.read(size)
+                    if len(header) < size:
+                        break
+                    (length,) = mpath_cli.MPathdClient.LENGTH.unpack(header)
+                    cmd = f.read(length).rstrip(b'\0').decode()
+                    self.commands.append(cmd)
+                    if self.dropNext:
+                        # as if multipathd restarted
+                        self.dropNext = False
+                        break
+                    reply = self.replies.get(cmd, "fail\n").encode() + b'\0'
+                    conn.sendall(
+                        mpath_cli.MPathdClient.LENGTH.pack(len(reply)) + reply)
+
+    def stop(self):
+        self.server.shutdown(socket.SHUT_RDWR)
+        self.server.close()
+        self.join()
+
+
+TOPOLOGY = """3600a098038303973743f486833396d44 dm-1 NETAPP  ,LUN C-Mode
+size=200G features='0' hwhandler='1 alua' wp=rw
+`-+- policy='service-time 0' prio=50 status=active
+  |- 0:0:0:4  sdr  65:16  active ready  running
+  `- 7:0:0:4  sdab 65:176 failed faulty running
+"""
+
+MAP_JSON = {
+    "major_version": 0, "minor_version": 1,
+    "map": {"name": "3600a098038303973743f486833396d44",
+            "uuid": "3600a098038303973743f486833396d44",
+            "path_groups": [{"paths": [{"dev": "sdr"}, {"dev": "sdab"}]}]}
+}
+
+
+class TestMPathdClient(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "multipathd.sock")
+        self.multipathd = FakeMultipathd(self.path, {
+            "help": "multipath-tools v0.4.9\nswitchgroup map $map group $group\n",
+            "list maps": "name sysfs uuid\n"
+                         "3600a098038303973743f486833396d44 dm-1 3600a098038303973743f486833396d44\n"
+                         "3600a098038303973743f486833396d45 dm-2 3600a098038303973743f486833396d45\n",
+            "show maps json": json.dumps({"maps": [MAP_JSON["map"]]}),
+            "show map 3600a098038303973743f486833396d44 json": json.dumps(MAP_JSON),
+            "show map 3600a098038303973743f486833396d44 topology": TOPOLOGY,
+            "resize map 3600a098038303973743f486833396d44": "ok\n"
+        })
+        self.multipathd.start()
+        self.addCleanup(self.multipathd.stop)
+        self.client = mpath_cli.MPathdClient(self.path, 5)
+        self.addCleanup(self.client.close)
+
+        client_patcher = mock.patch('mpath_cli.client', self.client)
+        client_patcher.start()
+        self.addCleanup(client_patcher.stop)
+        for name in ['Fairlock', 'util']:
+            patcher = mock.patch('mpath_cli.%s' % name, autospec=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_pipelined_commands(self):
+        replies = self.client.query(["resize map 3600a098038303973743f486833396d44",
+                                     "remove map 3600a098038303973743f486833396d44"])
+
+        self.assertEqual(["ok\n", "fail\n"], replies)
+        self.assertEqual(1, self.multipathd.connections)
+
+    def test_connection_kept(self):
+        self.assertTrue(mpath_cli.is_working())
+        mpath_cli.resize_map("3600a098038303973743f486833396d44")
+        with self.assertRaises(mpath_cli.MPathCLIFail):
+            mpath_cli.remove_map("3600a098038303973743f486833396d44")
+
+        self.assertEqual(["help",
+                          "resize map 3600a098038303973743f486833396d44",
+                          "remove map 3600a098038303973743f486833396d44"],
+                         self.multipathd.commands)
+        self.assertEqual(1, self.multipathd.connections)
+
+    def test_reconnect(self):
+        self.assertTrue(mpath_cli.is_working())
+        self.multipathd.dropNext = True
+
+        # The command is sent again on a new connection
+        self.assertTrue(mpath_cli.is_working())
+        self.assertEqual(["help", "help", "help"], self.multipathd.commands)
+        self.assertEqual(2, self.multipathd.connections)
+
+    def test_dropped_new_connection(self):
+        self.multipathd.dropNext = True
+
+        with self.assertRaises(mpath_cli.MPathCLIFail):
+            mpath_cli.query("help")
+        self.assertEqual(1, self.multipathd.connections)
+
+    def test_not_running(self):
+        with mock.patch('mpath_cli.client',
+                        mpath_cli.MPathdClient(self.path + ".missing")):
+            self.assertFalse(mpath_cli.is_working())
+            self.assertEqual([], mpath_cli.list_maps())
+            self.assertEqual([], mpath_cli.get_all_topologies())
+            self.assertIsNone(mpath_cli.get_all_maps())
+            self.assertEqual([], mpath_cli.list_paths(
+                "3600a098038303973743f486833396d44"))
+
+    def test_list_maps(self):
+        self.assertEqual(["3600a098038303973743f486833396d44",
+                          "3600a098038303973743f486833396d45"],
+                         mpath_cli.list_maps())
+
+    def test_topology(self):
+        self.assertEqual(TOPOLOGY.rstrip("\n").split("\n"),
+                         mpath_cli.get_topology("3600a098038303973743f486833396d44"))
+
+    def test_json(self):
+        self.assertEqual([MAP_JSON["map"]], mpath_cli.get_all_maps())
+        self.assertEqual(["sdr", "sdab"], mpath_cli.list_paths(
+            "3600a098038303973743f486833396d44"))
+
+        self.multipathd.replies["show maps json"] = "{not json"
+        self.assertIsNone(mpath_cli.get_all_maps())
+
+    def test_list_paths_text(self):
+        """
+        Older multipathd without JSON output
+        """
+        del self.multipathd.replies["show map 3600a098038303973743f486833396d44 json"]
+
+        self.assertEqual(["sdr", "sdab"], mpath_cli.list_paths(
+            "3600a098038303973743f486833396d44"))
+
+    @mock.patch('mpath_cli.time.sleep', autospec=True)
+    def test_ensure_map_gone(self, mock_sleep):
+        def map_gone(seconds):
+            del self.multipathd.replies["show map 3600a098038303973743f486833396d44 json"]
+            del self.multipathd.replies["show map 3600a098038303973743f486833396d44 topology"]
+
+        mock_sleep.side_effect = map_gone
+
+        mpath_cli.ensure_map_gone("3600a098038303973743f486833396d44")
+
+        mock_sleep.assert_called_once_with(1)
@@ -4,6 +4,7 @@ Unit tests for mpathcount
 import unittest
 import unittest.mock as mock
 import mpathcount
+import mpath_cli as real_mpath_cli
 
 import XenAPI
 
@@ -36,6 +37,88 @@ class TestMpathCount(unittest.TestCase):
         self.assertEqual(4, total, msg='total count incorrect')
         self.assertEqual(2, count, msg='count count incorrect')
 
+    @mock.patch('mpathcount.mpath_cli', autospec=True)
+    def test_get_all_path_counts(self, mpath_cli):
+        mpath_cli.get_all_maps.return_value = None
+        mpath_cli.get_all_topologies.return_value = [
+            "3600a098038303973743f486833396d44 dm-1 NETAPP  ,LUN C-Mode",
+            "size=200G features='4 queue_if_no_path pg_init_retries 50 retain_attached_hw_handle' hwhandler='1 alua' wp=rw",
+            "`-+- policy='service-time 0' prio=50 status=active",
+            "  |- 0:0:0:4  sdr  65:16  active ready  running",
+            "  |- 0:0:1:4  sdg  8:96   active ready  running",
+            "  |- 7:0:0:4  sdab 65:176 failed faulty running",
+            "  `- 7:0:1:4  sdam 66:96  failed faulty running",
+            "mpathb (3600a098038303973743f486833396d45) dm-2 NETAPP  ,LUN C-Mode",
+            "size=100G features='0' hwhandler='1 alua' wp=rw",
+            "|-+- policy='service-time 0' prio=50 status=active",
+            "| `- 0:0:0:5  sds  65:32  active ready  running",
+            "`-+- policy='service-time 0' prio=10 status=enabled",
+            "  `- 7:0:0:5  sdac 65:192 active ready  running"
+        ]
+        counts = mpathcount.get_all_path_counts()
+        self.assertEqual({'3600a098038303973743f486833396d44': (2, 4),
+                          '3600a098038303973743f486833396d45': (2, 2)},
+                         counts)
+
+        # The snapshot is used when there is one, and the maps missing from
+        # it are queried
+        with mock.patch('mpathcount.path_counts', counts):
+            self.assertEqual(
+                (2, 2),
+                mpathcount.get_path_count('3600a098038303973743f486833396d45'))
+            mpath_cli.get_topology.assert_not_called()
+            mpath_cli.get_topology.return_value = []
+            self.assertEqual(
+                (0, 0),
+                mpathcount.get_path_count('3600a098038303973743f486833396d46'))
+            mpath_cli.get_topology.assert_called_once_with(
+                '3600a098038303973743f486833396d46')
+
+    @mock.patch('mpathcount.mpath_cli', autospec=True)
+    def test_get_all_path_counts_json(self, mpath_cli):
+        mpath_cli.map_paths.side_effect = real_mpath_cli.map_paths
+        mpath_cli.get_all_maps.return_value = [
+            {"name": "3600a098038303973743f486833396d44",
+             "uuid": "3600a098038303973743f486833396d44",
+             "path_groups": [
+                 {"paths": [{"dev": "sdr", "chk_st": "ready"},
+                            {"dev": "sdg", "chk_st": "ready"}]},
+                 {"paths": [{"dev": "sdab", "chk_st": "faulty"}]}]},
+            {"name": "mpathb",
+             "uuid": "3600a098038303973743f486833396d45",
+             "path_groups": [{"paths": [{"dev": "sds", "chk_st": "shaky"}]}]}
+        ]
+        self.assertEqual({'3600a098038303973743f486833396d44': (2, 3),
+                          '3600a098038303973743f486833396d45': (0, 1)},
+                         mpathcount.get_all_path_counts())
+        mpath_cli.get_all_topologies.assert_not_called()
+
+    def test_config_update(self):
+        config = {'multipathed': 'true', 'mpath-1': '[1, 2]',
+                  'mpath-2': '[2, 2]'}
+        remove = mock.MagicMock()
+        add = mock.MagicMock()
+
+        update = mpathcount.ConfigUpdate(config)
+        update.remove('multipathed')
+        update.remove('mpath-1')
+        update.add('multipathed', 'true')
+        update.add('mpath-1', '[2, 2]')
+        update.remove('mpath-2')
+        update.remove('mpath-3')
+        update.commit(remove, add)
+
+        remove.assert_has_calls([mock.call('mpath-1'), mock.call('mpath-2')])
+        self.assertEqual(2, remove.call_count)
+        add.assert_called_once_with('mpath-1', '[2, 2]')
+
+    def test_get_supported_SRs(self):
+        session = mock.MagicMock()
+        mpathcount.get_supported_SRs(session)
+        where = session.xenapi.SR.get_all_records_where.call_args[0][0]
+        self.assertIn('field "type" = "lvmoiscsi" or ', where)
+        self.assertEqual(len(mpathcount.supported), where.count('field'))
+
     @mock.patch('mpathcount.get_path_count', return_value=(2, 4))
     def test_update_config(self, get_path_count):
         store = {'fred': ''}
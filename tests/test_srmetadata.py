@@ -8,9 +8,10 @@ import uuid
 import unittest
 import unittest.mock as mock
 
+import srmetadata
 from srmetadata import (LVMMetadataHandler, buildHeader, buildXMLSector,
-                        getMetadataLength, unpackHeader, updateLengthInHeader,
-                        MAX_VDI_NAME_LABEL_DESC_LENGTH)
+                        getMetadataLength, getSector, unpackHeader,
+                        updateLengthInHeader, MAX_VDI_NAME_LABEL_DESC_LENGTH)
 
 
 class TestSRMetadataFunctions(unittest.TestCase):
@@ -375,6 +376,85 @@ class TestLVMMetadataHandler(unittest.TestCase):
         # Then
         self.assertIsNone(caught)
 
+    @with_lvm_test_context
+    def test_previous_layout_converted(self):
+        # Given
+        self.make_handler().writeMetadata(self.make_sr_info(), {})
+        vdi1_uuid = genuuid()
+        vdi2_uuid = genuuid()
+        vdi3_uuid = genuuid()
+
+        def previous_slot(vdi_uuid, label, deleted):
+            return getSector(b"<vdi><name_label>%s</name_label>"
+                             b"<name_description>d</name_description>" %
+                             label) + \
+                getSector(b"<type>user</type><uuid>%s</uuid>"
+                          b"<deleted>%s</deleted></vdi>" %
+                          (vdi_uuid.encode(), deleted))
+
+        content = self.context._metadata_file_content
+        slots = previous_slot(vdi1_uuid, b"one", b"1") + \
+            previous_slot(vdi2_uuid, b"two", b"0")
+        self.context._metadata_file_content = \
+            getSector(buildHeader(2048 + len(slots), 1, 2)) + \
+            content[512:2048] + slots + content[2048 + len(slots):]
+
+        # When
+        self.make_handler().addVdi(self.make_vdi_info(vdi3_uuid))
+
+        # Then
+        self.assertEqual(self.get_metadata_version(),
+                         (1, srmetadata.MD_MINOR_INDEXED))
+        self.assertEqual(self.get_metadata_length(), 2048 + len(slots))
+        _, vdi_info = self.make_handler(False).getMetadata()
+        self.assertEqual(sorted(vdi_info), [2048, 3072])
+        self.assertEqual(vdi_info[2048]["uuid"], vdi3_uuid)
+        self.assertEqual(vdi_info[3072]["uuid"], vdi2_uuid)
+        self.assertEqual(vdi_info[3072]["name_label"], "two")
+        self.assertEqual(vdi_info[3072]["type"], "user")
+
+    @with_lvm_test_context
+    def test_vdi_operations_parse_one_slot(self):
+        # Given
+        vdi_uuids = [genuuid() for _ in range(10)]
+        self.make_handler().writeMetadata(self.make_sr_info(), dict(
+            (vdi_uuid, self.make_vdi_info(vdi_uuid))
+            for vdi_uuid in vdi_uuids))
+        srmetadata._parsedSlots.clear()
+        parse_patcher = mock.patch("srmetadata.metadata._parseXML",
+                                   wraps=srmetadata.metadata._parseXML)
+        mock_parse = parse_patcher.start()
+        self.addCleanup(parse_patcher.stop)
+
+        # When
+        handler = self.make_handler()
+        for _ in range(5):
+            handler.addVdi(self.make_vdi_info(genuuid()))
+        added_parses = mock_parse.call_count
+        handler.updateMetadata({
+            "objtype": "vdi",
+            "uuid": vdi_uuids[3],
+            "name_label": "updated"
+        })
+        del handler
+        self.make_handler().deleteVdiFromMetadata(vdi_uuids[5])
+        self.make_handler().addVdi(self.make_vdi_info(genuuid()))
+
+        # Then
+        self.assertEqual(added_parses, 0)
+        self.assertEqual(mock_parse.call_count, 2)
+        self.assertEqual(self.get_metadata_length(), 2048 + 15 * 1024)
+        _, vdi_info = self.make_handler(False).getMetadata(
+            {"indexByUuid": True})
+        self.assertEqual(len(vdi_info), 15)
+        self.assertNotIn(vdi_uuids[5], vdi_info)
+        self.assertEqual(vdi_info[vdi_uuids[3]]["name_label"], "updated")
+
+        # The parsed slots are cached, only the SR info is parsed again
+        self.assertEqual(mock_parse.call_count, 2 + 1 + 15)
+        self.make_handler(False).getMetadata()
+        self.assertEqual(mock_parse.call_count, 2 + 1 + 15 + 1)
+
     def make_handler(self, *args):
         return LVMMetadataHandler(self.context.METADATA_PATH, *args)
 
@@ -382,6 +462,10 @@ class TestLVMMetadataHandler(unittest.TestCase):
         with open(self.context.METADATA_PATH, "rb") as f:
             return getMetadataLength(f)
 
+    def get_metadata_version(self):
+        hdr = unpackHeader(self.context._metadata_file_content[:512].strip())
+        return (int(hdr[2]), int(hdr[3]))
+
     def make_sr_info(self, label="Test Storage"):
         return {
             "allocation": "thin",
@@ -166,7 +166,7 @@ class TestTestContext(unittest.TestCase):
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            close_fds=True)
+            close_fds=False)
 
         out, err = proc.communicate('in')
         rc = proc.returncode
@@ -184,7 +184,7 @@ class TestTestContext(unittest.TestCase):
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            close_fds=True)
+            close_fds=False)
 
         out, err = proc.communicate('in')
         rc = proc.returncode
@@ -272,7 +272,7 @@ class TestTestContext(unittest.TestCase):
             subprocess.PIPE,
             subprocess.PIPE,
             subprocess.PIPE,
-            True
+            False
         )
 
     def test_glob_requests_logged(self):
@@ -5,6 +5,8 @@ import errno
 import io
 import os
 import socket
+import sys
+import threading
 import unittest
 import unittest.mock as mock
 import uuid
@@ -716,6 +718,328 @@ class TestUtil(unittest.TestCase):
         self.assertEqual(util.unictrunc(t, 0), 0)
 
 
+class TestSMlog(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        syslog_patcher = mock.patch('util.syslog', autospec=True)
+        self.mock_syslog = syslog_patcher.start()
+        self.addCleanup(syslog_patcher.stop)
+        for name, value in (('LOGGING', True), ('LOG_LEVEL', util.LOG_DEBUG),
+                            ('_syslogOpened', None)):
+            patcher = mock.patch('util.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(util.stopAsyncLogging)
+
+    def logged(self):
+        return [call[0][1] for call in self.mock_syslog.syslog.call_args_list]
+
+    def test_connection_kept(self):
+        util.SMlog("first\nsecond")
+        util.SMlog("third")
+        util.SMlog("gc", ident="SMGC")
+
+        self.assertEqual(["[%d] %s" % (os.getpid(), line) for line in
+                          ("first", "second", "third", "gc")], self.logged())
+        self.assertEqual(
+            [mock.call("SM", 0, util._SM_SYSLOG_FACILITY),
+             mock.call("SMGC", 0, util._SM_SYSLOG_FACILITY)],
+            self.mock_syslog.openlog.call_args_list)
+        self.mock_syslog.closelog.assert_not_called()
+
+    @mock.patch('util.LOG_LEVEL', util.LOG_INFO)
+    def test_log_level(self):
+        util.SMlog("debug", priority=util.LOG_DEBUG)
+        util.SMlog("info")
+        util.SMlog("error", priority=util.LOG_ERR)
+
+        self.assertEqual(["[%d] info" % os.getpid(),
+                          "[%d] error" % os.getpid()], self.logged())
+
+    def test_async_logging(self):
+        logged = []
+        taken = threading.Event()
+        release = threading.Event()
+
+        def log(priority, message):
+            taken.set()
+            release.wait(10)
+            logged.append(message)
+        self.mock_syslog.syslog.side_effect = log
+
+        util.startAsyncLogging(maxsize=1)
+        util.SMlog("first")
+        self.assertTrue(taken.wait(10))
+        util.SMlog("second")
+        util.SMlog("dropped")
+        release.set()
+        util.stopAsyncLogging()
+        util.SMlog("sync")
+
+        self.assertIsNone(util._logQueue)
+        self.assertEqual(
+            ["[%d] %s" % (os.getpid(), message) for message in
+             ("first", "1 log messages dropped, queue full", "second",
+              "sync")],
+            logged)
+
+    def test_async_logging_forked(self):
+        """
+        A forked child logs synchronously, with its own syslog lock
+        """
+        util.startAsyncLogging()
+        logQueue, logThread = util._logQueue, util._logThread
+        self.addCleanup(logThread.join)
+        self.addCleanup(logQueue.put, None)
+        syslogLock = util._syslogLock
+
+        with mock.patch('util.os.getpid', autospec=True, return_value=-1):
+            util.SMlog("child")
+
+        self.assertIsNone(util._logQueue)
+        self.assertIsNot(syslogLock, util._syslogLock)
+        self.assertEqual(["[-1] child"], self.logged())
+
+
+class TestDoexec(unittest.TestCase):
+    @mock.patch('util.execstats.record', autospec=True)
+    def test_doexec(self, mock_record):
+        self.assertEqual(
+            (3, "in", ""),
+            util.doexec([sys.executable, "-c",
+                         "import sys; print(sys.stdin.read(), end='');"
+                         "sys.exit(3)"], inputtext="in"))
+
+        mock_record.assert_called_once_with(sys.executable, mock.ANY, 3)
+
+    @mock.patch('util.execstats.record', autospec=True)
+    def test_doexec_timeout(self, mock_record):
+        with self.assertRaises(util.CommandException) as cm:
+            util.doexec([sys.executable, "-c", "import time; time.sleep(30)"],
+                        timeout=0.1)
+
+        self.assertEqual(errno.ETIMEDOUT, cm.exception.code)
+        mock_record.assert_called_once_with(
+            sys.executable, mock.ANY, util.execstats.RC_TIMEOUT)
+        self.assertLess(mock_record.call_args[0][1], 10)
+
+    @mock.patch.dict('util._executables', clear=True)
+    @mock.patch('util.shutil.which', autospec=True)
+    def test_get_executable(self, mock_which):
+        mock_which.side_effect = \
+            lambda name: "/usr/sbin/" + name if name == "lvs" else None
+
+        self.assertEqual("/usr/sbin/lvs", util._getExecutable("lvs"))
+        self.assertEqual("/usr/sbin/lvs", util._getExecutable("lvs"))
+        self.assertEqual("missing", util._getExecutable("missing"))
+        self.assertEqual("./lvs", util._getExecutable("./lvs"))
+        self.assertEqual(2, mock_which.call_count)
+
+
+class TestWaitForEvent(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.addCleanup(mock.patch.stopall)
+        self.now = 0.0
+        time_patcher = mock.patch('util.time', autospec=True)
+        self.mock_time = time_patcher.start()
+        self.mock_time.monotonic.side_effect = lambda: self.now
+        self.mock_time.sleep.side_effect = self.sleep
+
+        log_patcher = mock.patch('util.SMlog', autospec=True)
+        self.mock_log = log_patcher.start()
+
+        self.events, self.listener = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.events.close)
+        self.listener.setblocking(False)
+        self.open_uevent_socket = util._open_uevent_socket
+        open_patcher = mock.patch('util._open_uevent_socket', autospec=True)
+        self.mock_open = open_patcher.start()
+        self.mock_open.return_value = self.listener
+
+        select_patcher = mock.patch('util.select.select', autospec=True)
+        self.mock_select = select_patcher.start()
+        self.mock_select.side_effect = self.select
+
+        glob_patcher = mock.patch('util.glob.glob', autospec=True)
+        self.mock_glob = glob_patcher.start()
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def select(self, rlist, wlist, xlist, timeout):
+        self.sleep(timeout)
+        return [s for s in rlist if s is self.listener], [], []
+
+    def test_wait_for_path_event(self):
+        """
+        The path is checked again on every udev event
+        """
+        def glob(path):
+            if self.mock_glob.call_count == 1:
+                self.events.send(b'add@/devices/virtual/block/dm-1')
+                self.events.send(b'change@/devices/virtual/block/dm-1')
+                return []
+            return ['/dev/disk/by-scsid/360a98000534b4f4e46704f5270674d70']
+
+        self.mock_glob.side_effect = glob
+
+        self.assertTrue(util.wait_for_path('/dev/disk/by-scsid/*', 5))
+
+        self.assertEqual(2, self.mock_glob.call_count)
+        self.mock_select.assert_called_once_with([self.listener], [], [], 1)
+        self.assertEqual(1, self.now)
+        self.assertTrue(self.listener._closed)
+
+    def test_wait_for_path_timeout(self):
+        self.mock_glob.return_value = []
+
+        self.assertFalse(util.wait_for_path('/dev/disk/by-scsid/*', 3))
+
+        self.assertEqual(4, self.mock_glob.call_count)
+        self.assertEqual(3, self.now)
+        self.assertTrue(self.listener._closed)
+
+    def test_wait_for_path_multi_polling(self):
+        """
+        Poll when the udev events are not available
+        """
+        self.mock_open.return_value = None
+        self.mock_glob.side_effect = [[], ['/dev/sdb', '/dev/sdc']]
+
+        self.assertEqual('/dev/sdb', util.wait_for_path_multi('/dev/sd*', 5))
+
+        self.mock_time.sleep.assert_called_once_with(1)
+        self.mock_select.assert_not_called()
+
+    def test_wait_for_path_multi_timeout(self):
+        self.mock_glob.return_value = []
+
+        self.assertEqual('', util.wait_for_path_multi('/dev/sd*', 2))
+
+    @mock.patch('util.os.path.exists', autospec=True)
+    def test_wait_for_nopath(self, mock_exists):
+        mock_exists.side_effect = [True, True, False]
+
+        self.assertTrue(util.wait_for_nopath('/dev/sdb', 5))
+        self.assertEqual(2, self.now)
+
+    @mock.patch('util.socket', autospec=True)
+    def test_open_uevent_socket(self, mock_socket):
+        mock_sock = mock_socket.socket.return_value
+
+        self.assertEqual(mock_sock, self.open_uevent_socket())
+        mock_socket.socket.assert_called_once_with(
+            mock_socket.AF_NETLINK, mock_socket.SOCK_DGRAM,
+            util.NETLINK_KOBJECT_UEVENT)
+        mock_sock.bind.assert_called_once_with((0, util.UEVENT_UDEV_GROUP))
+        mock_sock.setblocking.assert_called_once_with(False)
+
+        mock_sock.bind.side_effect = PermissionError(errno.EPERM, "denied")
+        self.assertIsNone(self.open_uevent_socket())
+        mock_sock.close.assert_called_once_with()
+
+        mock_socket.socket.side_effect = OSError(errno.EAFNOSUPPORT, "no")
+        self.assertIsNone(self.open_uevent_socket())
+
+    @mock.patch('util.pread2', autospec=True)
+    def test_udev_settle(self, mock_pread2):
+        util.udev_settle(2)
+        mock_pread2.assert_called_once_with(
+            ['/usr/sbin/udevadm', 'settle', '--timeout=2'], quiet=True)
+
+        mock_pread2.side_effect = util.CommandException(1)
+        util.udev_settle(2)
+        self.mock_log.assert_called_once_with("udevadm settle failed with 1")
+
+
+class TestCallPluginOnHosts(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.addCleanup(mock.patch.stopall)
+        log_patcher = mock.patch('util.SMlog', autospec=True)
+        self.mock_log = log_patcher.start()
+
+        self.sessions: List[mock.MagicMock] = []
+        session_patcher = mock.patch('util.get_localAPI_session',
+                                     autospec=True)
+        self.mock_get_session = session_patcher.start()
+        self.mock_get_session.side_effect = self.get_session
+        self.failures: Dict[str, Exception] = {}
+        self.unblock = threading.Event()
+        self.addCleanup(self.unblock.set)
+
+    def get_session(self):
+        session = mock.MagicMock()
+        session.xenapi.host.call_plugin.side_effect = self.call_plugin
+        self.sessions.append(session)
+        return session
+
+    def call_plugin(self, host_ref, plugin, fn, args):
+        if host_ref == 'hung-ref':
+            self.unblock.wait()
+        if host_ref in self.failures:
+            raise self.failures[host_ref]
+        return '%s %s on %s' % (plugin, fn, host_ref)
+
+    def test_results_in_order(self):
+        results = util.call_plugin_on_hosts(
+            ['host1-ref', 'host2-ref', 'host3-ref'], 'on-slave', 'multi', {})
+
+        self.assertEqual(['on-slave multi on host1-ref',
+                          'on-slave multi on host2-ref',
+                          'on-slave multi on host3-ref'], results)
+        # One session per thread
+        self.assertEqual(3, len(self.sessions))
+        for session in self.sessions:
+            session.xenapi.session.logout.assert_called_once_with()
+
+    def test_failures(self):
+        """
+        All the hosts are called, the error of the first failing one is
+        raised
+        """
+        self.failures = {'host2-ref': util.CommandException(errno.EIO),
+                         'host3-ref': util.SMException('host3 down')}
+
+        with self.assertRaises(util.CommandException):
+            util.call_plugin_on_hosts(
+                ['host1-ref', 'host2-ref', 'host3-ref'], 'on-slave', 'multi', {})
+
+        self.assertEqual(3, len(self.sessions))
+        self.assertEqual(2, self.mock_log.call_count)
+
+    def test_timeout(self):
+        with self.assertRaisesRegex(util.SMException, 'timed out'):
+            util.call_plugin_on_hosts(
+                ['host1-ref', 'hung-ref'], 'on-slave', 'multi', {}, timeout=0.1)
+
+        self.mock_log.assert_called_once_with(
+            "call-plugin on-slave multi failed on hung-ref: "
+            "on-slave multi timed out after 0 seconds, it may still complete")
+
+    def test_no_timeout(self):
+        """
+        Without a timeout, the calls are waited for
+        """
+        threading.Timer(0.1, self.unblock.set).start()
+
+        results = util.call_plugin_on_hosts(
+            ['host1-ref', 'hung-ref'], 'on-slave', 'multi', {},
+            desc='Refreshing')
+
+        self.assertEqual(['on-slave multi on host1-ref',
+                          'on-slave multi on hung-ref'], results)
+        self.mock_log.assert_has_calls([mock.call('Refreshing on host1-ref'),
+                                        mock.call('Refreshing on hung-ref')])
+
+    def test_no_hosts(self):
+        self.assertEqual([], util.call_plugin_on_hosts([], 'on-slave',
+                                                       'multi', {}))
+        self.mock_get_session.assert_not_called()
+
+
 class TestFistPoints(unittest.TestCase):
     @override
     def setUp(self) -> None:
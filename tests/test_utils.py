@@ -11,14 +11,17 @@ class fake_proc:
     def __init__(self):
         self.returncode = 0
 
-    def communicate(self, inputtext):
+    def communicate(self, inputtext, timeout=None):
         return b"hello", b"hello"
 
 
 class TestCreate(unittest.TestCase):
 
+    @mock.patch.dict('util._executables', clear=True)
+    @mock.patch('util.shutil.which', autospec=True)
     @mock.patch('subprocess.Popen', autospec=True)
-    def test_env_concatenated(self, popen):
+    def test_env_concatenated(self, popen, which):
+        which.return_value = '/usr/sbin/mount.cifs'
         new_env = {"NewVar1": "yadayada", "NewVar2": "blah"}
         popen.return_value = fake_proc()
         with mock.patch.dict('os.environ', {'hello': 'world'}, clear=True):
@@ -27,11 +30,11 @@ class TestCreate(unittest.TestCase):
                         '/var/run/sr-mount/asr_uuid',
                         '-o', 'cache=loose,vers=3.0,actimeo=0,domain=citrix'],
                        new_env=new_env)
-            expected_cmd = ['mount.cifs', '\\aServer',
+            expected_cmd = ['/usr/sbin/mount.cifs', '\\aServer',
                             '/var/run/sr-mount/asr_uuid', '-o',
                             'cache=loose,vers=3.0,actimeo=0,domain=citrix']
             popen.assert_called_with(expected_cmd,
-                                     close_fds=True, stdin=-1, stderr=-1,
+                                     close_fds=False, stdin=-1, stderr=-1,
                                      env={'hello': 'world', 'NewVar2': 'blah',
                                           'NewVar1': 'yadayada'}, stdout=-1,
                                      universal_newlines=True)
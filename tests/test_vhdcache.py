@@ -0,0 +1,252 @@
+from sm_typing import override
+
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import vhdcache
+import vhdutil
+
+
+def make_vhd_info(uuid, path):
+    vhd_info = vhdutil.VHDInfo(uuid)
+    vhd_info.path = path
+    vhd_info.sizeVirt = 10 * 1024 * 1024
+    vhd_info.sizePhys = 4 * 1024 * 1024
+    vhd_info.hidden = 1
+    vhd_info.parentUuid = "parent"
+    vhd_info.parentPath = "parent.vhd"
+    return vhd_info
+
+
+class TestVHDInfoCache(unittest.TestCase):
+    @override
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.sr_dir = os.path.join(self.tmp_dir.name, "sr")
+        os.mkdir(self.sr_dir)
+        cache_dir_patcher = mock.patch(
+            "vhdcache.CACHE_DIR", os.path.join(self.tmp_dir.name, "cache"))
+        cache_dir_patcher.start()
+        self.addCleanup(cache_dir_patcher.stop)
+
+    def make_file(self, name, age=60):
+        path = os.path.join(self.sr_dir, name)
+        with open(path, "w") as f:
+            f.write(name)
+        mtime = os.stat(path).st_mtime - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    # python 3.6 has no time.time_ns
+    @mock.patch("time.time_ns", None, create=True)
+    def test_signature(self):
+        path = self.make_file("old.vhd")
+        st = os.stat(path)
+        self.assertEqual([st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns],
+                         vhdcache.getSignature(path))
+
+        # Not cacheable: too recent, or missing
+        self.assertIsNone(
+            vhdcache.getSignature(self.make_file("new.vhd", age=0)))
+        self.assertIsNone(
+            vhdcache.getSignature(os.path.join(self.sr_dir, "missing.vhd")))
+
+    def test_signature_revalidated(self):
+        """
+        The file is opened rather than just stat'ed, so that NFS does not
+        return cached attributes
+        """
+        path = self.make_file("old.vhd")
+
+        with mock.patch("vhdcache.os.open", wraps=os.open) as mock_open, \
+                mock.patch("vhdcache.os.stat", autospec=True) as mock_stat:
+            self.assertIsNotNone(vhdcache.getSignature(path))
+
+        mock_open.assert_called_once_with(path, os.O_RDONLY)
+        mock_stat.assert_not_called()
+
+    def test_put_get(self):
+        path = self.make_file("a.vhd")
+        signature = vhdcache.getSignature(path)
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        cache.put(path, signature, make_vhd_info("a", path))
+        cache.save()
+
+        # Another process
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        vhd_info = cache.get(path, signature, vhdutil.VHDInfo)
+        self.assertEqual("a", vhd_info.uuid)
+        self.assertEqual(path, vhd_info.path)
+        self.assertEqual(10 * 1024 * 1024, vhd_info.sizeVirt)
+        self.assertEqual(4 * 1024 * 1024, vhd_info.sizePhys)
+        self.assertEqual(1, vhd_info.hidden)
+        self.assertEqual("parent", vhd_info.parentUuid)
+
+        # The file was written to
+        with open(path, "a") as f:
+            f.write("more")
+        self.assertIsNone(
+            cache.get(path, vhdcache.getSignature(path), vhdutil.VHDInfo))
+        self.assertIsNone(cache.get(path, None, vhdutil.VHDInfo))
+
+    def test_save_merges(self):
+        paths = [self.make_file(name) for name in ("a.vhd", "b.vhd")]
+        signatures = [vhdcache.getSignature(path) for path in paths]
+        cache1 = vhdcache.VHDInfoCache(self.sr_dir)
+        cache1.put(paths[0], signatures[0], make_vhd_info("a", paths[0]))
+        cache2 = vhdcache.VHDInfoCache(self.sr_dir)
+        cache2.put(paths[1], signatures[1], make_vhd_info("b", paths[1]))
+        cache1.save()
+        cache2.save()
+
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        for path, signature in zip(paths, signatures):
+            self.assertIsNotNone(cache.get(path, signature, vhdutil.VHDInfo))
+
+        # Invalidated by a modification, pruned on deletion
+        vhdcache.invalidate(paths[0])
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        cache.prune(paths[0:1])
+        cache.save()
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        for path, signature in zip(paths, signatures):
+            self.assertIsNone(cache.get(path, signature, vhdutil.VHDInfo))
+
+    def test_errors_not_cached(self):
+        path = self.make_file("a.vhd")
+        signature = vhdcache.getSignature(path)
+        vhd_info = make_vhd_info("a", path)
+        vhd_info.error = "scan-error"
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        cache.put(path, signature, vhd_info)
+        cache.save()
+
+        self.assertFalse(cache.exists())
+
+    def test_corrupted_cache(self):
+        path = self.make_file("a.vhd")
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        os.makedirs(vhdcache.CACHE_DIR)
+        with open(cache.cacheFile, "w") as f:
+            f.write("[")
+
+        self.assertIsNone(
+            cache.get(path, vhdcache.getSignature(path), vhdutil.VHDInfo))
+
+    @mock.patch("vhdutil.getVHDInfo", autospec=True)
+    @mock.patch("vhdutil.getAllVHDs", autospec=True)
+    def test_get_all_vhds_cached(self, mock_get_all, mock_get_info):
+        paths = [self.make_file("%d.vhd" % i) for i in range(3)]
+        extract_uuid = lambda path: os.path.basename(path)[:-4]
+        mock_get_info.side_effect = \
+            lambda path, extract, resolveParent: \
+            make_vhd_info(extract(path), path)
+        pattern = os.path.join(self.sr_dir, "*.vhd")
+
+        # Cold: queried one by one
+        vhds = vhdutil.getAllVHDsCached(pattern, extract_uuid)
+        self.assertEqual(["0", "1", "2"], sorted(vhds))
+        self.assertEqual(3, mock_get_info.call_count)
+
+        # Warm: only the modified one
+        mock_get_info.reset_mock()
+        with open(paths[1], "a") as f:
+            f.write("more")
+        os.utime(paths[1], (0, 0))
+        vhds = vhdutil.getAllVHDsCached(pattern, extract_uuid)
+        self.assertEqual(["0", "1", "2"], sorted(vhds))
+        mock_get_info.assert_called_once_with(
+            paths[1], extract_uuid, resolveParent=False)
+        self.assertEqual(paths[1], vhdutil.getCachedVHDInfo(paths[1]).path)
+        mock_get_all.assert_not_called()
+
+    @mock.patch("vhdutil.getVHDInfo", autospec=True)
+    @mock.patch("vhdutil.getAllVHDs", autospec=True)
+    def test_get_all_vhds_cached_scan(self, mock_get_all, mock_get_info):
+        paths = [self.make_file("%d.vhd" % i) for i in range(3)]
+        extract_uuid = lambda path: os.path.basename(path)[:-4]
+        mock_get_all.return_value = dict(
+            (extract_uuid(path), make_vhd_info(extract_uuid(path), path))
+            for path in paths)
+        pattern = os.path.join(self.sr_dir, "*.vhd")
+
+        with mock.patch("vhdutil.MAX_CACHE_MISS_QUERIES", 2):
+            vhds = vhdutil.getAllVHDsCached(pattern, extract_uuid)
+
+        self.assertEqual(["0", "1", "2"], sorted(vhds))
+        mock_get_all.assert_called_once_with(pattern, extract_uuid)
+        mock_get_info.assert_not_called()
+        for path in paths:
+            self.assertIsNotNone(vhdutil.getCachedVHDInfo(path))
+
+    @mock.patch("vhdutil.getVHDInfo", autospec=True)
+    def test_get_all_vhds_cached_error(self, mock_get_info):
+        path = self.make_file("0.vhd")
+        extract_uuid = lambda path: os.path.basename(path)[:-4]
+        mock_get_info.side_effect = vhdutil.util.CommandException(22)
+        pattern = os.path.join(self.sr_dir, "*.vhd")
+
+        vhds = vhdutil.getAllVHDsCached(pattern, extract_uuid)
+
+        self.assertTrue(vhds["0"].error)
+        self.assertIsNone(vhdutil.getCachedVHDInfo(path))
+
+    @mock.patch("vhdutil.ioretry", autospec=True)
+    def test_mutator_invalidates(self, mock_ioretry):
+        path = self.make_file("a.vhd")
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        cache.put(path, vhdcache.getSignature(path), make_vhd_info("a", path))
+        cache.save()
+
+        vhdutil.setHidden(path)
+
+        self.assertIsNone(vhdutil.getCachedVHDInfo(path))
+
+    def cache_files(self, *names):
+        paths = [self.make_file(name) for name in names]
+        cache = vhdcache.VHDInfoCache(self.sr_dir)
+        for path in paths:
+            cache.put(path, vhdcache.getSignature(path),
+                      make_vhd_info(os.path.basename(path), path))
+        cache.save()
+        return paths
+
+    @mock.patch("vhdutil.getParentPath", autospec=True)
+    @mock.patch("vhdutil.ioretry", autospec=True)
+    def test_coalesce_invalidates_parent(self, mock_ioretry,
+                                         mock_get_parent_path):
+        parent, child, other = self.cache_files("p.vhd", "c.vhd", "o.vhd")
+        mock_get_parent_path.return_value = parent
+        mock_ioretry.return_value = "Coalesced 0 sectors"
+
+        vhdutil.coalesce(child)
+
+        mock_get_parent_path.assert_called_once_with(child)
+        self.assertIsNone(vhdutil.getCachedVHDInfo(parent))
+        self.assertIsNone(vhdutil.getCachedVHDInfo(child))
+        self.assertIsNotNone(vhdutil.getCachedVHDInfo(other))
+
+    @mock.patch("vhdutil.getParentPath", autospec=True)
+    @mock.patch("vhdutil.ioretry", autospec=True)
+    def test_coalesce_unknown_parent(self, mock_ioretry,
+                                     mock_get_parent_path):
+        parent, child = self.cache_files("p.vhd", "c.vhd")
+        mock_get_parent_path.side_effect = vhdutil.util.SMException("corrupt")
+        mock_ioretry.return_value = "Coalesced 0 sectors"
+
+        vhdutil.coalesce(child)
+
+        self.assertFalse(vhdcache.isCached(parent))
+
+    @mock.patch("vhdutil.ioretry", autospec=True)
+    def test_set_parent_invalidates_parent(self, mock_ioretry):
+        parent, child, other = self.cache_files("p.vhd", "c.vhd", "o.vhd")
+
+        vhdutil.setParent(child, parent, False)
+
+        self.assertIsNone(vhdutil.getCachedVHDInfo(parent))
+        self.assertIsNone(vhdutil.getCachedVHDInfo(child))
+        self.assertIsNotNone(vhdutil.getCachedVHDInfo(other))
@@ -1,8 +1,15 @@
 
+import errno
+import os
+import struct
+import tempfile
 import unittest
+import unittest.mock as mock
 import zlib
 
+import FileSR
 import lvhdutil
+import util
 import vhdutil
 import xs_errors
 
@@ -14,6 +21,75 @@ TEST_VHD_NAME = "/test/path/test-vdi.vhd"
 
 VHD_UTIL = '/usr/bin/vhd-util'
 
+TEST_VDI_UUID = "d90f890c-d173-4eaf-ba09-fc2d6e50f6c0"
+
+TEST_PARENT_UUID = "a9a3a0ad-1c6c-4b49-9dee-3e1fb4c2ec5b"
+
+
+def vhd_checksum(data, offset):
+    return ~(sum(data) - sum(data[offset:offset + 4])) & 0xffffffff
+
+
+def write_vhd(path, size_mb=6, blocks=(), hidden=0, parent=None,
+              parent_raw=False, key_hash=None, batmap=True, footer=True):
+    """
+    Write the metadata of a dynamic (or differencing, if 'parent' is the
+    location of the parent) VHD with the given allocated blocks. The layout is
+    the one of tapdisk: footer copy, header, BAT, batmap header, batmap,
+    parent locator, data blocks and footer
+    """
+    max_bat_size = size_mb // 2
+    block_secs = 1 + 4096
+    data_start = 3584
+    end = data_start + len(blocks) * block_secs * 512
+
+    vhd_footer = bytearray(512)
+    struct.pack_into(">8sIIQ", vhd_footer, 0, b"conectix", 2, 0x00010000,
+                     512)
+    struct.pack_into(">QQ", vhd_footer, 40, size_mb << 20, size_mb << 20)
+    struct.pack_into(">I", vhd_footer, 60, 4 if parent else 3)
+    vhd_footer[68:84] = b"\x11" * 16
+    vhd_footer[85] = hidden
+    struct.pack_into(">I", vhd_footer, 64, vhd_checksum(vhd_footer, 64))
+
+    header = bytearray(1024)
+    struct.pack_into(">8sQQIII", header, 0, b"cxsparse", 0xffffffffffffffff,
+                     1536, 0x00010000, max_bat_size, 2 * 1024 * 1024)
+    if parent:
+        if not parent_raw:
+            header[40:56] = b"\x22" * 16
+        location = ("file://" + parent).encode("utf-8")
+        struct.pack_into(">4sIIIQ", header, 576, b"MacX", 512,
+                         len(location), 0, 3072)
+    struct.pack_into(">I", header, 36, vhd_checksum(header, 36))
+
+    bat = [0xffffffff] * max_bat_size
+    for i, block in enumerate(blocks):
+        bat[block] = (data_start // 512) + i * block_secs
+
+    batmap_header = bytearray(512)
+    if batmap:
+        struct.pack_into(">8sQI", batmap_header, 0, b"tdbatmap", 2560, 1)
+    if key_hash:
+        batmap_header[29] = 1
+        batmap_header[30:62] = b"\x01" * 32
+        batmap_header[62:94] = bytes.fromhex(key_hash)
+
+    with open(path, "wb") as f:
+        f.write(vhd_footer)
+        f.write(header)
+        f.write(struct.pack(">%dI" % max_bat_size, *bat))
+        f.seek(2048)
+        f.write(batmap_header)
+        if parent:
+            f.seek(3072)
+            f.write(location)
+        f.seek(end)
+        if footer:
+            f.write(vhd_footer)
+        else:
+            f.write(bytes(512))
+
 
 class TestVhdUtil(unittest.TestCase):
 
@@ -363,6 +439,39 @@ class TestVhdUtil(unittest.TestCase):
         # Act/Assert
         self.assertEqual(25, vhdutil.coalesce(TEST_VHD_PATH))
 
+    @testlib.with_context
+    def test_coalesce_onto_ancestor(self, context):
+        """
+        Call vhd-util.coalesce onto an ancestor of the parent
+        """
+        # Arrange
+        call_args = None
+
+        def test_function(args, inp):
+            nonlocal call_args
+            call_args = args
+            return 0, "Coalesced 25 sectors", ""
+
+        context.add_executable(VHD_UTIL, test_function)
+
+        # Act/Assert
+        self.assertEqual(25, vhdutil.coalesce(TEST_VHD_PATH,
+                                              "/test/path/test-anc.vhd"))
+        self.assertEqual(
+            [VHD_UTIL, "coalesce", "--debug", "-n", TEST_VHD_PATH,
+             "-a", "/test/path/test-anc.vhd"],
+            call_args)
+
+    def test_coalesce_run(self):
+        """
+        The vhd-util coalesce command is run by the caller
+        """
+        run = mock.Mock(return_value="Coalesced 25 sectors")
+
+        self.assertEqual(25, vhdutil.coalesce(TEST_VHD_PATH, run=run))
+        run.assert_called_once_with(
+            [VHD_UTIL, "coalesce", "--debug", "-n", TEST_VHD_PATH])
+
     @testlib.with_context
     def test_get_vhd_info_allocated_size(self, context):
         """
@@ -402,3 +511,147 @@ class TestVhdUtil(unittest.TestCase):
             [VHD_UTIL, "query", "--debug", "-a",
              "-n", TEST_VHD_NAME],
             call_args)
+
+    @mock.patch('vhdutil.getKeyHash', autospec=True)
+    def test_get_key_hashes(self, mock_get_key_hash):
+        """
+        Test that vhdutil.getKeyHashes reads the key hashes from the VHD
+        headers and falls back to vhd-util for other layouts
+        """
+        # Arrange
+        key_hash = "ab" * 32
+        mock_get_key_hash.return_value = None
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, "%d.vhd" % i) for i in range(3)]
+            write_vhd(paths[0], key_hash=key_hash)
+            write_vhd(paths[1])
+            write_vhd(paths[2], batmap=False)
+
+            # Act
+            result = vhdutil.getKeyHashes(paths)
+
+        # Assert
+        self.assertEqual(
+            {paths[0]: key_hash, paths[1]: None, paths[2]: None}, result)
+        mock_get_key_hash.assert_called_once_with(paths[2])
+
+    @mock.patch('vhdutil.getKeyHash', autospec=True)
+    def test_get_key_hashes_read_error(self, mock_get_key_hash):
+        """
+        I/O errors of the direct read go through the retried vhd-util query
+        """
+        mock_get_key_hash.side_effect = util.CommandException(errno.ENOENT)
+
+        with self.assertRaises(util.CommandException):
+            vhdutil.getKeyHashes(["/nonexistent/test-vdi.vhd"])
+        mock_get_key_hash.assert_called_once_with("/nonexistent/test-vdi.vhd")
+
+    def test_native_queries(self):
+        """
+        Test that the read-only queries parse the VHD metadata without
+        running vhd-util, nor os.preadv which python 3.6 does not have
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch("vhdutil.ioretry") as mock_ioretry, \
+                mock.patch("os.preadv", None, create=True):
+            path = os.path.join(tmp_dir, "%s.vhd" % TEST_VDI_UUID)
+            write_vhd(path, blocks=(0, 2), hidden=1)
+
+            # Act/Assert
+            self.assertEqual(6 * 1024 * 1024, vhdutil.getSizeVirt(path))
+            self.assertEqual(1, vhdutil.getHidden(path))
+            self.assertFalse(vhdutil.hasParent(path))
+            self.assertIsNone(vhdutil.getParent(path, FileSR.FileVDI.extractUuid))
+            self.assertEqual(1, vhdutil.getDepth(path))
+            self.assertEqual(2 * 2 * 1024 * 1024,
+                             vhdutil.getAllocatedSize(path))
+            size_phys = 3584 + 2 * (1 + 4096) * 512 + 512
+            self.assertEqual(size_phys, vhdutil.getSizePhys(path))
+
+            info = vhdutil.getVHDInfo(path, FileSR.FileVDI.extractUuid)
+            self.assertEqual(TEST_VDI_UUID, info.uuid)
+            self.assertEqual(path, info.path)
+            self.assertEqual(6 * 1024 * 1024, info.sizeVirt)
+            self.assertEqual(size_phys, info.sizePhys)
+            self.assertEqual(2 * 2 * 1024 * 1024, info.sizeAllocated)
+            self.assertEqual(1, info.hidden)
+            self.assertEqual("", info.parentUuid)
+
+        mock_ioretry.assert_not_called()
+
+    def test_native_queries_parent(self):
+        """
+        Test that the parent locator is resolved relatively to the directory
+        of the child
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch("vhdutil.ioretry") as mock_ioretry:
+            parent_path = os.path.join(tmp_dir, "%s.vhd" % TEST_PARENT_UUID)
+            write_vhd(parent_path, blocks=(1,))
+            path = os.path.join(tmp_dir, "%s.vhd" % TEST_VDI_UUID)
+            write_vhd(path, parent="./%s.vhd" % TEST_PARENT_UUID)
+
+            # Act/Assert
+            self.assertTrue(vhdutil.hasParent(path))
+            self.assertEqual(TEST_PARENT_UUID,
+                             vhdutil.getParent(path, FileSR.FileVDI.extractUuid))
+            self.assertEqual(2, vhdutil.getDepth(path))
+            self.assertEqual(3584 + 512, vhdutil.getSizePhys(path))
+            info = vhdutil.getVHDInfo(path, FileSR.FileVDI.extractUuid)
+            self.assertEqual(parent_path, info.parentPath)
+            self.assertEqual(TEST_PARENT_UUID, info.parentUuid)
+
+        mock_ioretry.assert_not_called()
+
+    def test_native_depth_raw_parent(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "%s.vhd" % TEST_VDI_UUID)
+            write_vhd(path, parent="/dev/VG/LV-%s" % TEST_PARENT_UUID,
+                      parent_raw=True)
+
+            # Act/Assert
+            self.assertEqual(2, vhdutil.getDepth(path))
+
+    def test_native_footer_copy(self):
+        """
+        Test that the copy of the footer is used when there is no valid
+        footer at the end, as for a VHD in an inflated LV
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "%s.vhd" % TEST_VDI_UUID)
+            write_vhd(path, hidden=1, footer=False)
+
+            # Act/Assert
+            self.assertEqual(1, vhdutil.getHidden(path))
+
+    @mock.patch("vhdutil.ioretry", autospec=True)
+    def test_native_fallback(self, mock_ioretry):
+        """
+        Test that vhd-util is used for the VHDs the native backend cannot
+        handle
+        """
+        mock_ioretry.return_value = "chain depth: 3"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "%s.vhd" % TEST_VDI_UUID)
+            write_vhd(path, parent="./missing.vhd")
+
+            # Act/Assert
+            self.assertEqual(3, vhdutil.getDepth(path))
+
+        mock_ioretry.assert_called_once_with(
+            [VHD_UTIL, "query", "--debug", "-d", "-n", path])
+
+    @mock.patch("vhdutil.QUERY_BACKEND", vhdutil.QUERY_BACKEND_VHD_UTIL)
+    @mock.patch("vhdutil.ioretry", autospec=True)
+    def test_vhd_util_backend(self, mock_ioretry):
+        mock_ioretry.return_value = "hidden: 1"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "%s.vhd" % TEST_VDI_UUID)
+            write_vhd(path)
+
+            # Act/Assert
+            self.assertEqual(1, vhdutil.getHidden(path))
+
+        mock_ioretry.assert_called_once_with(
+            [VHD_UTIL, "query", "--debug", "-f", "-n", path])
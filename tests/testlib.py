@@ -78,7 +78,7 @@ class Subprocess(object):
         self.executable = executable
         self.args = args
 
-    def communicate(self, data):
+    def communicate(self, data, timeout=None):
         self.returncode, out, err = self.executable.run(self.args, data)
         return out, err
 
@@ -132,6 +132,7 @@ class TestContext(object):
         self.patch('os.stat', new=self.fake_stat)
 
         self.setup_modinfo()
+        self.setup_udevadm()
 
     def fake_fcntl(self, fd, cmd, arg):
         assert(self.mock_fcntl)
@@ -161,6 +162,13 @@ class TestContext(object):
     def setup_modinfo(self):
         self.add_executable('/sbin/modinfo', self.fake_modinfo)
 
+    def setup_udevadm(self):
+        self.add_executable('/usr/sbin/udevadm', self.fake_udevadm)
+
+    def fake_udevadm(self, args, stdin_data):
+        assert args[1] == 'settle'
+        return 0, '', ''
+
     def fake_modinfo(self, args, stdin_data):
         assert len(args) == 3
         assert args[1] == '-d'
@@ -171,7 +179,7 @@ class TestContext(object):
         assert stdin == subprocess.PIPE
         assert stdout == subprocess.PIPE
         assert stderr == subprocess.PIPE
-        assert close_fds is True
+        assert close_fds is False
 
         path_to_executable = args[0]
 